@@ -187,8 +187,21 @@ class UResNet(BaseNet):
             _, _ = self.build_base_net(self.image_placeholder,
                                          is_training=is_training,
                                          reuse=reuse, scope=scope)
+        self.build_decoder(is_training=is_training, reuse=reuse, scope=scope)
+
+    def build_decoder(self, is_training=True, reuse=False, scope="uresnet"):
+        """
+        Decoding path on top of the encoder built by `build_base_net`, with
+        segmentation outputs, loss and summary. Called after PPN built its
+        base network, it shares the encoder with PPN.
+        """
+        with slim.arg_scope([self.fn_conv,
+                             self.fn_conv_transpose,
+                             slim.fully_connected],
+                            normalizer_fn=slim.batch_norm,
+                            trainable=is_training):
             net = self.net
-            with tf.variable_scope(scope, reuse=self.reuse):
+            with tf.variable_scope(scope, reuse=reuse):
                 # Decoding steps
                 for step in xrange(self._num_strides):
                     num_outputs = net.get_shape()[-1].value / 2
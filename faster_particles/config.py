@@ -6,6 +6,7 @@ import tensorflow as tf
 
 from demo_ppn import inference
 from train_net import train
+from data.sparsedata import convert
 
 
 os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
@@ -24,8 +25,12 @@ class PPNConfig(object):
     CORE_SIZE = 32
     ENABLE_CROP = False
     CROP_ALGO = "proba"
-    MAX_PATCHES = 500  # for proba algo
+    MAX_PATCHES = 500  # for proba and budget algo
+    CROP_TIME_BUDGET = 0  # ms per event for budget algo, 0 = no limit
     MIN_OVERLAP = 2  # for proba algo
+    RECONCILE = 'average'  # Blending of overlapping crops: average or core
+    CORE_CONFIDENCE = 0.9  # Min softmax score of confident core predictions
+    MIN_CORE_COVERAGE = 1  # Confident cores needed to ignore other patches
 
     # General settings
     OUTPUT_DIR = "output"
@@ -59,7 +64,7 @@ class PPNConfig(object):
     BASE_NET = 'vgg'
     WEIGHT_LOSS = False
     MIN_SCORE = 0.0
-    POSTPROCESSING = 'nms'  # Postprocessing: use either NMS or DBSCAN
+    POSTPROCESSING = 'nms'  # Postprocessing: use either NMS (nms_tf for in-graph NMS) or DBSCAN
 
     # UResNet
     URESNET_WEIGHTING = False  # Use pixel-weighting scheme in UResNet
@@ -77,6 +82,16 @@ class PPNConfig(object):
     DATA = "/data/dlprod_ppn_v08_p01/test.root"
     TEST_DATA = ""
     DATA_3D = False
+    SHUFFLE = False  # Shuffle events at each epoch (HDF5)
+    HDF5_CHUNK_SIZE = 4  # Number of contiguous HDF5 rows read at once
+    CSV_CACHE = False  # Save/reuse parsed CSV index in a .npz next to it
+    SPARSE_BLOB = False  # Generators emit only voxels, densify crops lazily
+    PREFETCH_DEPTH = 0  # Max number of blobs built ahead of time, 0 = off
+    PREFETCH_WORKERS = 1  # Number of prefetching threads
+    PREFETCH_TIMEOUT = None  # Max wait (s) for a prefetched blob
+    SHARED_BASE = False  # Single graph for base and PPN (demo, NET full)
+    RESULT_CACHE = None  # Directory of the inference results cache (demo)
+    RESULT_CACHE_SIZE = 1024  # Max size of the results cache in MB
 
     # Track configuration
     MAX_TRACKS = 5
@@ -128,15 +143,22 @@ class PPNConfig(object):
         self.train_parser.add_argument("-f", "--freeze", default=self.FREEZE, action='store_true', help="Freeze the base net weights.")
 
         self.demo_parser = subparsers.add_parser("demo", help="Run Pixel Proposal Network demo.")
+        self.demo_parser.add_argument("-shb", "--shared-base", default=self.SHARED_BASE, action='store_true', help="With --net full, build UResNet segmentation and PPN on a single shared backbone and get both outputs from one run. Backbone weights come from the base checkpoint, so PPN must have been trained with --freeze on top of it.")
+        self.demo_parser.add_argument("-rc", "--result-cache", default=self.RESULT_CACHE, type=str, help="Directory where network outputs for each crop are cached and reused (keyed by entry, crop and checkpoint).")
+        self.demo_parser.add_argument("-rcs", "--result-cache-size", default=self.RESULT_CACHE_SIZE, type=float, help="Max size of the result cache in MB (least recently used results are evicted).")
         # self.demo_full_parser = subparsers.add_parser("demo-full", help="Run Pixel Proposal Network combined with base UResNet demo.")
+        self.convert_parser = subparsers.add_parser("convert", help="Convert data to the binary sparse format (DATA_TYPE sparse).")
+        self.convert_parser.add_argument("-o", "--output-dir", action='store', type=str, required=True, help="Path to output directory.")
 
         self.common_arguments(self.train_parser)
         self.common_arguments(self.demo_parser)
+        self.common_arguments(self.convert_parser)
         # self.common_arguments(self.demo_full_parser)
 
         self.demo_parser.set_defaults(func=inference)
         # self.demo_full_parser.set_defaults(func=inference_full)
         self.train_parser.set_defaults(func=train)
+        self.convert_parser.set_defaults(func=convert)
 
     def common_arguments(self, parser):
         parser.add_argument("-m", "--max-steps", default=self.MAX_STEPS, type=int, help="Maximum number of training iterations.")
@@ -147,7 +169,7 @@ class PPNConfig(object):
         parser.add_argument("-3d", "--data-3d", default=self.DATA_3D, action='store_true', help="Use 3D instead of 2D.")
         parser.add_argument("-data", "--data", default=self.DATA, type=str, help="Path to data files. Can use ls regex format.")
         parser.add_argument("-tdata", "--test-data", default=self.TEST_DATA, type=str, help="Path to test data files. Can use ls regex format.")
-        parser.add_argument("-dt", "--data-type", default=self.DATA_TYPE, type=str, choices=['toydata', 'larcv', 'hdf5', 'csv'], help="Type of the data file (toydata, larcv, hdf5, csv).")
+        parser.add_argument("-dt", "--data-type", default=self.DATA_TYPE, type=str, choices=['toydata', 'larcv', 'hdf5', 'csv', 'sparse'], help="Type of the data file (toydata, larcv, hdf5, csv, sparse).")
         parser.add_argument("-bn", "--base-net", default=self.BASE_NET, type=str, help="Base network of PPN (e.g. VGG)")
         parser.add_argument("-n", "--net", default=self.NET, type=str, choices=['ppn', 'base', 'full', 'small_uresnet', 'ppn_ext'], help="Whether to use base net or PPN net or both.")
         parser.add_argument("-N", "--image-size", action='store', default=self.IMAGE_SIZE, type=int, help="Width (and height) of image.")
@@ -173,19 +195,30 @@ class PPNConfig(object):
         parser.add_argument("-ss", "--slice-size", action='store', default=self.SLICE_SIZE, type=int, help="Width (and height) of cropped slice from image.")
         parser.add_argument("-cos", "--core-size", action='store', default=self.CORE_SIZE, type=int, help="Width (and height) of the core of a cropped slice from image.")
         parser.add_argument("-cs", "--crop-size", action='store', default=self.CROP_SIZE, type=int, help="Width (and height) of cropped region for small UResNet.")
-        parser.add_argument("-pp", "--postprocessing", default=self.POSTPROCESSING, type=str, choices=['nms', 'dbscan'], help="Choice of postprocessing method for PPN (either NMS or DBSCAN).")
-        parser.add_argument("-ca", "--crop-algo", default=self.CROP_ALGO, type=str, choices=['proba', 'octree'], help="Choice of cropping method (either probablistic or octree algorithm).")
+        parser.add_argument("-pp", "--postprocessing", default=self.POSTPROCESSING, type=str, choices=['nms', 'nms_tf', 'dbscan'], help="Choice of postprocessing method for PPN (either NMS or DBSCAN). nms_tf is NMS with native Tensorflow ops only, e.g. to freeze the graph.")
+        parser.add_argument("-ca", "--crop-algo", default=self.CROP_ALGO, type=str, choices=['proba', 'octree', 'grid', 'budget'], help="Choice of cropping method (probablistic, octree, deterministic grid or budget-aware greedy algorithm).")
+        parser.add_argument("-rec", "--reconcile", default=self.RECONCILE, type=str, choices=['average', 'core'], help="Blending of UResNet predictions of overlapping crops (plain average or weighted by distance to the patch core).")
+        parser.add_argument("-cconf", "--core-confidence", action='store', default=self.CORE_CONFIDENCE, type=float, help="Min softmax score of a core prediction for core blending to ignore other patches (reconcile core).")
+        parser.add_argument("-mcc", "--min-core-coverage", action='store', default=self.MIN_CORE_COVERAGE, type=int, help="Number of patches with a confident core prediction needed to ignore other patches (reconcile core).")
         parser.add_argument("-uw", "--uresnet-weighting", action='store_true', default=self.URESNET_WEIGHTING, help="Use pixel-wise weighting in UResNet.")
         parser.add_argument("-ua", "--uresnet-add", action='store_true', default=self.URESNET_ADD, help="Use add instead of concat in UResNet.")
         parser.add_argument("-bno", "--base-num-outputs", action='store', default=self.BASE_NUM_OUTPUTS, type=int, help="Base number of filters for UResNet.")
         parser.add_argument("-ns", "--num-strides", action='store', default=self.NUM_STRIDES, type=int, help="Number of strides (spatial depth) for UResNet.")
-        parser.add_argument("-mp", "--max-patches", action='store', default=self.MAX_PATCHES, type=int, help="Max number of patches for cropping algo (probabilistic).")
+        parser.add_argument("-mp", "--max-patches", action='store', default=self.MAX_PATCHES, type=int, help="Max number of patches for cropping algo (probabilistic and budget).")
+        parser.add_argument("-ctb", "--crop-time-budget", action='store', default=self.CROP_TIME_BUDGET, type=float, help="Time budget in ms per event for budget cropping algo (0 = no limit).")
         parser.add_argument("-mo", "--min-overlap", action='store', default=self.MIN_OVERLAP, type=int, help="Min number of overlap for cropping algo (probabilistic).")
         parser.add_argument("-ppn1i", "--ppn1-index", action='store', default=self.PPN1_INDEX, type=int, help="Index of intermediate feature map for PPN1.")
         parser.add_argument("-ppn2i", "--ppn2-index", action='store', default=self.PPN2_INDEX, type=int, help="Index of last feature map for PPN2.")
         parser.add_argument("-p", "--profile", action='store_true', default=self.PROFILE, help="Profile TF model.")
         parser.add_argument("-pn", "--profile-timeline", action='store', default=self.PROFILE_TIMELINE, type=str, help="Timeline name (profiling).")
         parser.add_argument("-dl", "--detail-log", default=self.DETAIL_LOG, action='store_true', help="Keep all training weights and save at least one every 30min.")
+        parser.add_argument("-sh", "--shuffle", default=self.SHUFFLE, action='store_true', help="Shuffle events at each epoch (deterministic given the seed, HDF5 only).")
+        parser.add_argument("-hc", "--hdf5-chunk-size", action='store', default=self.HDF5_CHUNK_SIZE, type=int, help="Number of contiguous rows read at once from HDF5 files.")
+        parser.add_argument("-cc", "--csv-cache", default=self.CSV_CACHE, action='store_true', help="Cache the parsed CSV event index to a .npz file next to the CSV file.")
+        parser.add_argument("-sb", "--sparse-blob", default=self.SPARSE_BLOB, action='store_true', help="Keep data sparse (voxels only) and densify only the crops fed to the network.")
+        parser.add_argument("-pd", "--prefetch-depth", action='store', default=self.PREFETCH_DEPTH, type=int, help="Number of blobs prepared in background (0 to disable prefetching).")
+        parser.add_argument("-pw", "--prefetch-workers", action='store', default=self.PREFETCH_WORKERS, type=int, help="Number of background threads preparing blobs.")
+        parser.add_argument("-pt", "--prefetch-timeout", action='store', default=self.PREFETCH_TIMEOUT, type=float, help="Max time (in seconds) to wait for a prefetched blob.")
         parser.add_argument("-sparse", "--sparse", default=self.SPARSE, action='store_true', help="Use sparse UResNet.")
 
     def parse_args(self):
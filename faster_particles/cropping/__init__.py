@@ -1,7 +1,12 @@
+from budget import Budget
+from coverage import voxel_coverage, coverage_metrics
+from grid import Grid
 from octree import Octree
 from probabilistic import Probabilistic
 
 cropping_algorithms = {
     "proba": Probabilistic,
-    "octree": Octree
+    "octree": Octree,
+    "grid": Grid,
+    "budget": Budget
 }
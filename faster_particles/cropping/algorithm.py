@@ -1,7 +1,9 @@
 import numpy as np
-from sklearn.cluster import DBSCAN
-from faster_particles.ppn_utils import crop as crop_util
+from scipy import ndimage
+from faster_particles.ppn_utils import crop as crop_util, crop_sparse
 from faster_particles.display_utils import extract_voxels
+from spatial_index import SpatialIndex
+from coverage import voxel_coverage
 
 
 class CroppingAlgorithm(object):
@@ -16,6 +18,11 @@ class CroppingAlgorithm(object):
         self.a = cfg.CORE_SIZE  # Core size
         self.N = cfg.IMAGE_SIZE
         self._debug = debug
+        # For core blending in reconcile: a voxel covered by the core of
+        # `min_core_coverage` patches with a softmax score above
+        # `core_confidence` ignores the predictions of other patches
+        self.core_confidence = cfg.CORE_CONFIDENCE
+        self.min_core_coverage = cfg.MIN_CORE_COVERAGE
 
     def crop(self, coords):
         """
@@ -30,59 +37,117 @@ class CroppingAlgorithm(object):
         patch_centers, patch_sizes = self.crop(original_blob['voxels'])
         return self.extract(patch_centers, patch_sizes, original_blob)
 
+    def crop_sparse(self, patch_centers, voxels, values, index=None):
+        """
+        Densify only the patches centered at patch_centers (data coordinates,
+        shape (num_patches, dim)) from sparse voxels and values
+        (see cfg.SPARSE_BLOB).
+        Voxel coordinates are reversed with respect to data coordinates and
+        may carry a batch index as last column. index is an optional
+        SpatialIndex of the voxels in data coordinates.
+        """
+        dim = patch_centers.shape[1]
+        return crop_sparse(patch_centers, self.cfg.SLICE_SIZE,
+                           np.flip(voxels[:, :dim], axis=1),
+                           values[:, np.newaxis], index=index)
+
+    def spatial_index(self, voxels, dim):
+        """
+        Index voxels (reversed coordinates) in data coordinates.
+        """
+        return SpatialIndex(np.flip(voxels[:, :dim], axis=1).astype(int),
+                            self.cfg.SLICE_SIZE)
+
     def extract(self, patch_centers, patch_sizes, original_blob):
+        """
+        Cut all patches at once for each field of original_blob into
+        preallocated arrays, then select gt pixels and voxels of each patch
+        among the ones of the neighbouring cells of a spatial index.
+        """
+        is_sparse = 'data' not in original_blob
         batch_blobs = []
-        for i in range(len(patch_centers)):
-            patch_center, patch_size = patch_centers[i], patch_sizes[i]
-            blob = {}
+        if len(patch_centers) == 0:
+            return batch_blobs, patch_centers, patch_sizes
 
-            # Flip patch_center coordinates
-            # because gt_pixels coordinates are reversed
-            # FIXME here or before blob['data'] ??
-            patch_center = np.flipud(patch_center)
-
-            blob['data'], _ = crop_util(np.array([patch_center]),
-                                        self.cfg.SLICE_SIZE,
-                                        original_blob['data'], return_labels=False)
-            patch_center = patch_center.astype(int)
-            # print(patch_center, original_blob['data'][0, patch_center[0], patch_center[1], patch_center[2], 0], np.count_nonzero(blob['data']))
-            # assert np.count_nonzero(blob['data']) > 0
+        # Flip patch_center coordinates
+        # because gt_pixels coordinates are reversed
+        # FIXME here or before blob['data'] ??
+        centers = np.flip(np.asarray(patch_centers), axis=1)
+        int_centers = centers.astype(int)
+        dim = centers.shape[1]
+
+        crops = {}
+        if 'voxels' in original_blob:
+            voxels_index = self.spatial_index(original_blob['voxels'], dim)
+        if is_sparse:
+            # Densify only the crops
+            crops['data'] = self.crop_sparse(centers,
+                                             original_blob['voxels'],
+                                             original_blob['voxels_value'],
+                                             index=voxels_index)
+            if 'voxels_labels' in original_blob:
+                crops['labels'] = self.crop_sparse(
+                    int_centers, original_blob['voxels'],
+                    original_blob['voxels_labels'], index=voxels_index)[..., 0]
+            if 'weight_voxels' in original_blob:
+                crops['weight'] = self.crop_sparse(
+                    int_centers, original_blob['weight_voxels'],
+                    original_blob['weight_value'],
+                    index=self.spatial_index(original_blob['weight_voxels'], dim))
+        else:
+            crops['data'], _ = crop_util(centers, self.cfg.SLICE_SIZE,
+                                         original_blob['data'], return_labels=False)
             if 'labels' in original_blob:
-                blob['labels'], _ = crop_util(np.array([patch_center]),
-                                              self.cfg.SLICE_SIZE,
-                                              original_blob['labels'][..., np.newaxis], return_labels=False)
-                blob['labels'] = blob['labels'][..., 0]
-            # print(np.nonzero(blob['data']))
-            # print(np.nonzero(blob['labels']))
-            # assert np.array_equal(np.nonzero(blob['data']), np.nonzero(blob['labels']))
+                crops['labels'], _ = crop_util(int_centers,
+                                               self.cfg.SLICE_SIZE,
+                                               original_blob['labels'][..., np.newaxis], return_labels=False)
+                crops['labels'] = crops['labels'][..., 0]
             if 'weight' in original_blob:
-                blob['weight'], _ = crop_util(np.array([patch_center]),
-                                              self.cfg.SLICE_SIZE,
-                                              original_blob['weight'][..., np.newaxis], return_labels=False)
-                blob['weight'][blob['weight'] == 0.0] = 0.1
-                blob['weight'] = blob['weight'][..., 0]
+                crops['weight'], _ = crop_util(int_centers,
+                                               self.cfg.SLICE_SIZE,
+                                               original_blob['weight'][..., np.newaxis], return_labels=False)
+        if 'labels' in crops:
+            crops['labels'] = crops['labels'].astype(np.int32)
+        if 'weight' in crops:
+            crops['weight'][crops['weight'] == 0.0] = 0.1
+            crops['weight'] = crops['weight'][..., 0]
+
+        kept = []
+        if 'gt_pixels' in original_blob:
+            gt_index = SpatialIndex(original_blob['gt_pixels'][:, :-1],
+                                    self.cfg.SLICE_SIZE)
+            # Artificial gt pixels
+            artificial_gt_pixels = self.add_gt_pixels(crops['data'],
+                                                      int_centers,
+                                                      self.cfg.SLICE_SIZE)
 
+        for i in range(len(centers)):
+            patch_center, patch_size = int_centers[i], patch_sizes[i]
+            blob = {}
+            for key in crops:
+                blob[key] = crops[key][i:i+1]
+            low = patch_center - patch_size/2.0
+            high = patch_center + patch_size/2.0
 
             # Select gt pixels
             if 'gt_pixels' in original_blob:
-                indices = np.where(np.all(np.logical_and(
-                    original_blob['gt_pixels'][:, :-1] >= patch_center - patch_size/2.0,
-                    original_blob['gt_pixels'][:, :-1] < patch_center + patch_size/2.0), axis=1))
-                blob['gt_pixels'] = original_blob['gt_pixels'][indices]
-                blob['gt_pixels'][:, :-1] = blob['gt_pixels'][:, :-1] - (patch_center - patch_size / 2.0)
+                gt_pixels = original_blob['gt_pixels'][gt_index.candidates(low, high)]
+                blob['gt_pixels'] = gt_pixels[np.all(np.logical_and(
+                    gt_pixels[:, :-1] >= low,
+                    gt_pixels[:, :-1] < high), axis=1)]
+                blob['gt_pixels'][:, :-1] = blob['gt_pixels'][:, :-1] - low
                 # Add artificial gt pixels
-                artificial_gt_pixels = self.add_gt_pixels(original_blob, blob, patch_center, self.cfg.SLICE_SIZE)
-                if artificial_gt_pixels.shape[0]:
-                    blob['gt_pixels'] = np.concatenate([blob['gt_pixels'], artificial_gt_pixels], axis=0)
+                if artificial_gt_pixels[i].shape[0]:
+                    blob['gt_pixels'] = np.concatenate([blob['gt_pixels'], artificial_gt_pixels[i]], axis=0)
             # Select voxels
             # Flip patch_center coordinates back to normal
-            patch_center = np.flipud(patch_center)
             if 'voxels' in original_blob:
-                voxels = original_blob['voxels']
+                voxels = original_blob['voxels'][voxels_index.candidates(low, high)]
+                low, high = np.flipud(low), np.flipud(high)
                 blob['voxels'] = voxels[np.all(np.logical_and(
-                    voxels >= patch_center - patch_size / 2.0,
-                    voxels < patch_center + patch_size / 2.0), axis=1)]
-                blob['voxels'] = blob['voxels'] - (patch_center - patch_size / 2.0)
+                    voxels >= low,
+                    voxels < high), axis=1)]
+                blob['voxels'] = blob['voxels'] - low
                 blob['entries'] = original_blob['entries']
 
             # Crops for small UResNet
@@ -95,52 +160,80 @@ class CroppingAlgorithm(object):
             # Make sure there is at least one ground truth pixel in the patch (for training)
             if self.cfg.NET not in ['ppn', 'ppn_ext', 'full'] or len(blob['gt_pixels']) > 0:
                 batch_blobs.append(blob)
-        return batch_blobs, patch_centers, patch_sizes
+                kept.append(i)
+        # Return geometry of kept patches only, aligned with batch_blobs
+        return batch_blobs, np.asarray(patch_centers)[kept], np.asarray(patch_sizes)[kept]
 
     def compute_overlap(self, coords, patch_centers, sizes=None):
         """
         Compute overlap dict: dict[x] gives the number of voxels which belong
-        to x patches.
+        to x patches. sizes are half sizes of the patches.
         """
         if sizes is None:
             sizes = self.d/2.0
-        overlap = []
-        for voxel in coords:
-            overlap.append(np.sum(np.all(np.logical_and(
-                patch_centers-sizes <= voxel,
-                patch_centers + sizes >= voxel
-                ), axis=1)))
+        overlap, _ = voxel_coverage(coords, patch_centers, 2.0 * np.asarray(sizes))
         return dict(zip(*np.unique(overlap, return_counts=True)))
 
-    def add_gt_pixels(self, original_blob, blob, patch_center, patch_size):
+    def add_gt_pixels(self, crops, patch_centers, patch_size):
         """
-        Add artificial pixels after cropping
+        Add artificial pixels after cropping, for all patches at once.
+        Candidates are nonzero voxels:
+        - on the faces of a patch (crop boundaries intersecting with data)
+        - close to the boundaries of the original image (crop partially
+        outside of original data, thus padded)
+        They are grouped in connected components (on the patch faces), and
+        the voxel of maximal charge of each component becomes a gt pixel.
+        crops has shape (num_patches,) + (N,) * dim + (1,) and patch_centers
+        are in data coordinates.
+        Returns a list of arrays of shape (None, dim + 1), one per patch.
         """
-        # Case 1: crop boundaries is intersecting with data
-        nonzero_idx = np.array(np.where(blob['data'][0, ..., 0] > 0.0)).T  # N x 3
-        border_idx = nonzero_idx[np.any(np.logical_or(nonzero_idx == 0, nonzero_idx == self.cfg.IMAGE_SIZE - 1), axis=1)]
-
-        # Case 2: crop is partially outside of original data (thus padded)
-        # if patch_center is within patch_size of boundaries of original blob
-        # boundary intesecting with data
-        padded_idx = nonzero_idx[np.any(np.logical_or(nonzero_idx + patch_center - patch_size / 2.0 >= self.cfg.IMAGE_SIZE - 2, nonzero_idx + patch_center - patch_size / 2.0 <= 1), axis=1)]
-        # dbscan on all found voxels from case 1 and 2
-        coords = np.concatenate([border_idx, padded_idx], axis=0)
-        artificial_gt_pixels = []
-        if coords.shape[0]:
-            db = DBSCAN(eps=10, min_samples=3).fit_predict(coords)
-            for v in np.unique(db):
-                cluster = coords[db == v]
-                artificial_gt_pixels.append(cluster[np.argmax(blob['data'][0, ..., 0][cluster.T[0], cluster.T[1], cluster.T[2]]), :])
-
-            artificial_gt_pixels = np.concatenate([artificial_gt_pixels, np.ones((len(artificial_gt_pixels), 1))], axis=1)
-
-        return np.array(artificial_gt_pixels)
-
-    def reconcile(self, batch_results, patch_centers, patch_sizes):
+        data = crops[..., 0]
+        num_patches, dim, N = data.shape[0], data.ndim - 1, data.shape[1]
+        corners = patch_centers - patch_size / 2.0
+        local = np.arange(N)
+        selection = np.zeros(data.shape, dtype=np.bool_)
+        for axis in range(dim):
+            # Case 1: crop boundaries is intersecting with data
+            border = np.logical_or(local == 0, local == N - 1)[np.newaxis, :]
+            # Case 2: crop is partially outside of original data (thus padded)
+            coords = local[np.newaxis, :] + corners[:, axis, np.newaxis]
+            border = np.logical_or(border, np.logical_or(
+                coords >= self.N - 2, coords <= 1))
+            shape = [num_patches] + [1] * dim
+            shape[axis + 1] = N
+            selection = np.logical_or(selection, np.reshape(border, shape))
+        selection = np.logical_and(selection, data > 0.0)
+
+        # Connected components inside each patch (no connection between patches)
+        structure = np.zeros((3,) * (dim + 1), dtype=np.bool_)
+        structure[1] = True
+        components, _ = ndimage.label(selection, structure=structure)
+        indices = np.flatnonzero(components)
+        labels = components.ravel()[indices]
+        # Voxel of maximal charge of each component
+        order = np.lexsort((-data.ravel()[indices], labels))
+        first = np.concatenate([[True], labels[order][1:] != labels[order][:-1]])
+        coords = np.stack(np.unravel_index(indices[order[first]], data.shape), axis=1)
+        # Components are labeled in order, hence sorted by patch
+        bounds = np.searchsorted(coords[:, 0], np.arange(num_patches + 1))
+        coords = np.concatenate([coords[:, 1:], np.ones((coords.shape[0], 1))], axis=1)
+        return [coords[bounds[i]:bounds[i+1]] for i in range(num_patches)]
+
+    def reconcile(self, batch_results, patch_centers, patch_sizes, dense=False):
         """
         Reconcile slices result together
         using batch_results, batch_blobs, patch_centers and patch_sizes
+
+        UResNet softmax scores of voxels seen by several patches are
+        averaged (cfg.RECONCILE = 'average'), or weighted by the distance of
+        the voxel to the patch core (cfg.RECONCILE = 'core'): weight is 1 in
+        the core and decreases linearly towards the patch border. In the
+        latter case voxels confidently predicted (cfg.CORE_CONFIDENCE) in
+        enough cores (cfg.MIN_CORE_COVERAGE) only keep core predictions. Voxel coordinates are linearized to int64 keys so
+        that scores of all patches are accumulated in one pass. Outputs are sparse:
+        `voxels` (original blob coordinates), `voxels_predictions`,
+        `voxels_scores` and `voxels_softmax`, unless `dense` is True: then
+        dense `predictions`, `scores` and `softmax` arrays are returned.
         """
         final_results = {}
         if len(batch_results) == 0:  # Empty batch
@@ -148,40 +241,68 @@ class CroppingAlgorithm(object):
 
         # UResNet predictions
         if 'predictions' and 'scores' and 'softmax' in batch_results[0]:
-            final_voxels = np.array([], dtype=np.int32).reshape(0, 3)  # Shape N_voxels x dim
-            final_scores = np.array([], dtype=np.float32).reshape(0, self.cfg.NUM_CLASSES)  # Shape N_voxels x num_classes
-            final_counts = np.array([], dtype=np.int32).reshape(0,)  # Shape N_voxels x 1
+            dim = batch_results[0]['predictions'].ndim
+            shape = (self.N,) * dim
+            voxels, softmax, offsets = [], [], []
             for i, result in enumerate(batch_results):
                 # Extract voxel and voxel values
                 # Shape N_voxels x dim
-                v, values = extract_voxels(result['predictions'])
+                v, _ = extract_voxels(result['predictions'])
                 # Extract corresponding softmax scores
                 # Shape N_voxels x num_classes
-                scores = result['softmax'][v[:, 0], v[:, 1], v[:, 2], :]
+                softmax.append(result['softmax'][tuple(v.T)])
+                # Position with respect to the patch center
+                offsets.append(v - patch_sizes[i] / 2.0)
                 # Restore original blob coordinates
                 v = (v + np.flipud(patch_centers[i]) - patch_sizes[i] / 2.0).astype(np.int64)
-                v = np.clip(v, 0, self.cfg.IMAGE_SIZE-1)
-                # indices are  indices of the *first* occurrences of the unique values
-                # hence for doublons they are indices in final_voxels
-                # We assume the only overlap that can occur is between
-                # final_voxels and v, not inside these arrays themselves
-                n = final_voxels.shape[0]
-                final_voxels, indices, counts = np.unique(np.concatenate([final_voxels, v], axis=0), axis=0, return_index=True, return_counts=True)
-                final_scores = np.concatenate([final_scores, scores], axis=0)[indices]
-                lower_indices = indices[indices < n]
-                upper_indices = indices[indices >= n]
-                final_counts[lower_indices] += counts[lower_indices] - 1
-                final_counts = np.concatenate([final_counts, np.ones((upper_indices.shape[0],))], axis=0)
-
-            final_scores = final_scores / final_counts[:, np.newaxis]  # Compute average
+                voxels.append(np.clip(v, 0, self.N-1))
+            voxels = np.concatenate(voxels, axis=0)
+            softmax = np.concatenate(softmax, axis=0)
+
+            keys, inverse = np.unique(np.ravel_multi_index(voxels.T, shape),
+                                      return_inverse=True)
+            inverse = inverse.reshape((-1,))
+            num_voxels, num_classes = keys.shape[0], softmax.shape[1]
+            if self.cfg.RECONCILE == 'core':
+                # Distance (L-inf) to the core [-a/2, a/2) of each patch
+                offsets = np.concatenate(offsets, axis=0)
+                distances = np.amax(np.maximum(np.maximum(
+                    -self.a/2.0 - offsets, offsets - (self.a/2.0 - 1)), 0), axis=1)
+                margin = (self.d - self.a) / 2.0 + 1
+                weights = np.maximum(margin - distances, 1) / margin
+                # Skip voxels already confidently predicted in enough cores
+                confident = np.logical_and(distances == 0,
+                                           np.amax(softmax, axis=1) >= self.core_confidence)
+                coverage = np.bincount(inverse[confident], minlength=num_voxels)
+                keep = np.logical_or(distances == 0,
+                                     coverage[inverse] < self.min_core_coverage)
+                inverse, softmax, weights = inverse[keep], softmax[keep], weights[keep]
+            else:
+                weights = np.ones((inverse.shape[0],))
+            counts = np.bincount(inverse, weights=weights, minlength=num_voxels)
+            # Weighted sum of softmax scores, for all classes at once
+            final_scores = np.bincount(
+                (inverse[:, np.newaxis] * num_classes + np.arange(num_classes)).reshape((-1,)),
+                weights=(softmax * weights[:, np.newaxis]).reshape((-1,)),
+                minlength=num_voxels * num_classes).reshape((num_voxels, num_classes))
+            final_scores = final_scores / counts[:, np.newaxis]  # Compute average
             final_predictions = np.argmax(final_scores, axis=1)
-            final_results['predictions'] = np.zeros((self.cfg.IMAGE_SIZE,) * 3)
-            final_results['predictions'][final_voxels.T[0], final_voxels.T[1], final_voxels.T[2]] = final_predictions
-            final_results['scores'] = np.zeros((self.cfg.IMAGE_SIZE,) * 3)
-            final_results['scores'][final_voxels.T[0], final_voxels.T[1], final_voxels.T[2]] = final_scores[np.arange(final_scores.shape[0]), final_predictions]
-            final_results['softmax'] = np.zeros((self.cfg.IMAGE_SIZE,) * 3 + (self.cfg.NUM_CLASSES,))
-            final_results['softmax'][final_voxels.T[0], final_voxels.T[1], final_voxels.T[2], :] = final_scores
-            final_results['predictions'] = final_results['predictions'][np.newaxis, ...]
+            final_voxels = np.stack(np.unravel_index(keys, shape), axis=1)
+
+            final_scores_max = final_scores[np.arange(final_scores.shape[0]), final_predictions]
+            if dense:
+                final_results['predictions'] = np.zeros(shape)
+                final_results['predictions'][tuple(final_voxels.T)] = final_predictions
+                final_results['scores'] = np.zeros(shape)
+                final_results['scores'][tuple(final_voxels.T)] = final_scores_max
+                final_results['softmax'] = np.zeros(shape + (num_classes,))
+                final_results['softmax'][tuple(final_voxels.T)] = final_scores
+                final_results['predictions'] = final_results['predictions'][np.newaxis, ...]
+            else:
+                final_results['voxels'] = final_voxels
+                final_results['voxels_predictions'] = final_predictions
+                final_results['voxels_scores'] = final_scores_max
+                final_results['voxels_softmax'] = final_scores
 
         # PPN
         if 'im_proposals' and 'im_scores' and 'im_labels' and 'rois' in batch_results[0]:
@@ -192,13 +313,13 @@ class CroppingAlgorithm(object):
             final_rois = np.array([], dtype=np.float32).reshape(0, 3)
             for i, result in enumerate(batch_results):
                 im_proposals = result['im_proposals'] + np.flipud(patch_centers[i]) - patch_sizes[i] / 2.0
-                im_proposals = np.clip(im_proposals, 0, self.cfg.IMAGE_SIZE-1)
+                im_proposals = np.clip(im_proposals, 0, self.N-1)
                 # print(final_im_proposals, im_proposals)
                 final_im_proposals = np.concatenate([final_im_proposals, im_proposals], axis=0)
                 final_im_scores = np.concatenate([final_im_scores, result['im_scores']], axis=0)
                 final_im_labels = np.concatenate([final_im_labels, result['im_labels']], axis=0)
                 rois = result['rois'] + (np.flipud(patch_centers[i]) - patch_sizes[i] / 2.0) / (self.cfg.dim1 * self.cfg.dim2)
-                rois = np.clip(rois, 0, self.cfg.IMAGE_SIZE-1)
+                rois = np.clip(rois, 0, self.N-1)
                 final_rois = np.concatenate([final_rois, rois], axis=0)
             final_results['im_proposals'] = np.array(final_im_proposals)
             final_results['im_scores'] = np.array(final_im_scores)
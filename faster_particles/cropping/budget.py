@@ -0,0 +1,96 @@
+from algorithm import CroppingAlgorithm
+import itertools
+import numpy as np
+import threading
+import time
+
+
+class Budget(CroppingAlgorithm):
+    """
+    Budget-aware greedy cropping algorithm.
+    =======================================
+    Patch cores are aligned on a grid of cells of size CORE_SIZE/2: a
+    candidate patch is centered on a corner of this grid, its core covers
+    the 2^dim cells around that corner.
+
+    1. Count voxels in each cell.
+    2. Select the candidate whose core contains the most voxels which are
+    not in any core yet.
+    3. Mark the cells of its core as covered and update the gains of the
+    neighbouring candidates only.
+    4. Start from 2. again until all voxels are in a core or the budget is
+    exhausted: MAX_PATCHES patches or CROP_TIME_BUDGET milliseconds per
+    event (0 = no time limit).
+
+    Selecting the best patch first is a greedy approximation of maximal
+    coverage for the budget. The fraction of voxels inside a core for the
+    last event is stored in self.coverage, statistics over all events are
+    reported by `summary`. Statistics are updated under a lock since `crop`
+    may run in several prefetching threads.
+    """
+
+    def __init__(self, cfg):
+        super(Budget, self).__init__(cfg)
+        self.max_patches = cfg.MAX_PATCHES
+        self.time_budget = cfg.CROP_TIME_BUDGET
+        self.cell_size = max(1, self.a // 2)
+        self.coverage = 1.0
+
+        # Statistics
+        self._lock = threading.Lock()
+        self.num_events = 0
+        self.num_exhausted = 0  # Events not fully covered
+        self.total_coverage = 0.0
+
+    def crop(self, coords):
+        start = time.time()
+        n, dim = coords.shape
+        cells = np.floor_divide(coords, self.cell_size).astype(np.int64)
+        shape = cells.max(axis=0) + 1 if n > 0 else np.ones((dim,), dtype=np.int64)
+        # Number of uncovered voxels per cell, padded with one empty cell
+        # on each side: candidate q covers cells q and q + 1
+        uncovered = np.zeros(tuple(shape + 2), dtype=np.int64)
+        np.add.at(uncovered, tuple((cells + 1).T), 1)
+        shifts = list(itertools.product([0, 1], repeat=dim))
+
+        def compute_gains(low, high):
+            gains = 0
+            for shift in shifts:
+                gains = gains + uncovered[tuple(slice(l + s, h + s) for l, h, s in zip(low, high, shift))]
+            return gains
+
+        gains = compute_gains(np.zeros((dim,), dtype=np.int64), shape + 1)
+        patches = []  # List of center coordinates of patches
+        num_covered = 0
+        while len(patches) < self.max_patches:
+            q = np.unravel_index(np.argmax(gains), gains.shape)
+            if gains[q] == 0:
+                break
+            num_covered += gains[q]
+            patches.append(np.array(q) * self.cell_size)
+            q = np.array(q)
+            uncovered[tuple(slice(k, k + 2) for k in q)] = 0
+            # Only candidates sharing a cell with q have a different gain
+            low, high = np.maximum(q - 1, 0), np.minimum(q + 2, shape + 1)
+            gains[tuple(slice(l, h) for l, h in zip(low, high))] = compute_gains(low, high)
+            if self.time_budget > 0 and (time.time() - start) * 1000.0 > self.time_budget:
+                break
+
+        coverage = num_covered / float(n) if n > 0 else 1.0
+        with self._lock:
+            self.coverage = coverage
+            self.num_events += 1
+            self.total_coverage += coverage
+            if coverage < 1.0:
+                self.num_exhausted += 1
+
+        return np.array(patches), np.array([self.cfg.SLICE_SIZE] * len(patches))
+
+    def summary(self):
+        """
+        One-line report of coverage statistics.
+        """
+        with self._lock:
+            n = max(1, self.num_events)
+            return "Budget cropping - %d events, average coverage %f, budget exhausted for %d events" % (
+                self.num_events, self.total_coverage / n, self.num_exhausted)
@@ -0,0 +1,64 @@
+import numpy as np
+from spatial_index import SpatialIndex
+
+
+def voxel_coverage(coords, patch_centers, patch_sizes, core_size=None):
+    """
+    Coverage of voxels coords (None, dim) by patches of size patch_sizes
+    (scalar or one size per patch) centered at patch_centers (None, dim).
+    A voxel belongs to a patch if center - size/2 <= voxel <= center + size/2.
+    Returns for each voxel the number of patches to which it belongs
+    (overlap) and, if core_size is given, whether it belongs to the core
+    of at least one patch (None otherwise).
+
+    Voxels are bucketed once with a grid hash, then each patch only visits
+    the voxels of the cells it intersects: O(V log V + P * S^dim) at worst.
+    """
+    coords = np.asarray(coords)
+    num_patches = len(patch_centers)
+    overlap = np.zeros((coords.shape[0],), dtype=np.int64)
+    core = None if core_size is None else np.zeros((coords.shape[0],), dtype=np.bool_)
+    if coords.shape[0] == 0 or num_patches == 0:
+        return overlap, core
+
+    patch_centers = np.reshape(patch_centers, (num_patches, -1))
+    half_sizes = np.broadcast_to(np.reshape(patch_sizes, (-1,)), (num_patches,)) / 2.0
+    half_core = 0.0 if core_size is None else core_size / 2.0
+    index = SpatialIndex(coords, max(1, int(np.ceil(2 * np.amax(half_sizes)))))
+    inside_indices, core_indices = [], []
+    for center, half_size in zip(patch_centers, half_sizes):
+        half = max(half_size, half_core)
+        candidates = index.candidates(center - half, center + half)
+        voxels = coords[candidates]
+        inside_indices.append(candidates[np.all(np.logical_and(
+            center - half_size <= voxels,
+            center + half_size >= voxels
+            ), axis=1)])
+        if core_size is not None:
+            core_indices.append(candidates[np.all(np.logical_and(
+                center - half_core <= voxels,
+                center + half_core >= voxels
+                ), axis=1)])
+    overlap += np.bincount(np.concatenate(inside_indices),
+                           minlength=coords.shape[0])
+    if core_size is not None:
+        core[np.concatenate(core_indices)] = True
+    return overlap, core
+
+
+def coverage_metrics(coords, patch_centers, patch_sizes, core_size):
+    """
+    Cheap per-event summary of the coverage of voxels by patches.
+    Returns a dict with the number of patches, the fraction of voxels
+    in at least one patch / one core, and the mean / max overlap.
+    """
+    overlap, core = voxel_coverage(coords, patch_centers, patch_sizes,
+                                   core_size=core_size)
+    num_voxels = max(1, overlap.shape[0])
+    return {
+        'num_patches': len(patch_centers),
+        'coverage': np.count_nonzero(overlap) / float(num_voxels),
+        'core_coverage': np.count_nonzero(core) / float(num_voxels),
+        'mean_overlap': np.sum(overlap) / float(num_voxels),
+        'max_overlap': int(np.amax(overlap)) if overlap.shape[0] > 0 else 0
+    }
@@ -0,0 +1,30 @@
+from algorithm import CroppingAlgorithm
+import numpy as np
+
+
+class Grid(CroppingAlgorithm):
+    """
+    Deterministic grid cropping algorithm.
+    ======================================
+    Split the image in a regular grid of cores of size CORE_SIZE. Each
+    occupied core is the center of a patch of size SLICE_SIZE (patches are
+    placed with a stride CORE_SIZE).
+
+    Each voxel belongs to exactly one core. Occupied cores are found by
+    scattering voxels into a grid of cells in a single pass, so that the
+    cost is linear in the number of voxels and the number of patches scales
+    with the occupied volume.
+    """
+
+    def crop(self, coords):
+        dim = coords.shape[1]
+        cells = np.floor_divide(coords, self.a).astype(np.int64)
+        if cells.shape[0] > 0:
+            grid_shape = np.maximum(cells.max(axis=0) + 1,
+                                    int(np.ceil(self.N / float(self.a))))
+        else:
+            grid_shape = (0,) * dim
+        occupied = np.zeros(grid_shape, dtype=np.bool_)
+        occupied[tuple(cells.T)] = True
+        patches = np.argwhere(occupied) * self.a + self.a / 2.0
+        return patches, np.array([self.cfg.SLICE_SIZE] * len(patches))
@@ -20,57 +20,45 @@ class Octree(CroppingAlgorithm):
         super(Octree, self).__init__(cfg)
         self.num_choice = 6
         self.final_size = 0.7 * cfg.CROP_SIZE
+        # Directions of the 8 sub-cubes, in order of priority
+        self.children = np.array([
+            [1, 1, -1], [-1, 1, -1], [1, -1, -1], [-1, -1, -1],
+            [1, 1, 1], [-1, 1, 1], [1, -1, 1], [-1, -1, 1]
+        ])
+        # Child index given bits (x > x0) + 2 * (y > y0) + 4 * (z > z0)
+        self.child_index = np.zeros((8,), dtype=np.int64)
+        self.child_index[np.dot(self.children > 0, [1, 2, 4])] = np.arange(8)
 
     def crop(self, coords):
-        heap = [([self.N/2, self.N/2, self.N/2], self.N/2, coords)]  # List
-        patches = []
-        sizes = []
-        while len(heap) > 0:
-            coordinates, size, voxels = heap.pop(0)
-            x0, y0, z0 = coordinates
+        """
+        All voxels go down the tree together: at each level every voxel
+        is assigned to the child cube containing it in one vectorized step
+        (ties go to the first child in `self.children` order), its cube
+        center is updated in place and the child index is appended to its
+        key. Sorting the keys of final cubes gives them in the same order as
+        a breadth first traversal of the tree.
+        Random sub-cubes selection uses numpy global random state.
+        """
+        centers = np.full(coords.shape, self.N/2, dtype=np.float64)
+        keys = np.zeros((coords.shape[0],), dtype=np.int64)
+        size = self.N/2
+        while size > self.final_size:
             new_size = size/2
-            if size > self.final_size:
-                new_cubes = [
-                    ([x0 + new_size, y0 + new_size, z0 - new_size], new_size),
-                    ([x0 - new_size, y0 + new_size, z0 - new_size], new_size),
-                    ([x0 + new_size, y0 - new_size, z0 - new_size], new_size),
-                    ([x0 - new_size, y0 - new_size, z0 - new_size], new_size),
-                    ([x0 + new_size, y0 + new_size, z0 + new_size], new_size),
-                    ([x0 - new_size, y0 + new_size, z0 + new_size], new_size),
-                    ([x0 + new_size, y0 - new_size, z0 + new_size], new_size),
-                    ([x0 - new_size, y0 - new_size, z0 + new_size], new_size)
-                ]
-                new_voxel_sets = []
-                for cube, new_size in new_cubes:
-                    if voxels.shape[0] > 0:
-                        cube = np.array(cube)
-                        indices = np.all(np.logical_and(
-                            voxels >= cube - new_size,
-                            voxels <= cube + new_size
-                            ), axis=1)
-                        new_voxel_sets.append(voxels[indices])
-                        voxels = np.delete(voxels, indices, axis=0)
+            # Ties go to + side for x, y and to - side for z
+            plus = np.concatenate([coords[:, :2] >= centers[:, :2],
+                                   coords[:, 2:] > centers[:, 2:]], axis=1)
+            child = self.child_index[np.dot(plus, [1, 2, 4])]
+            centers += self.children[child] * new_size
+            keys = keys * 8 + child
+            size = new_size
 
-                for i, voxel_set in enumerate(new_voxel_sets):
-                    if len(voxel_set) > 0:
-                        heap.append(new_cubes[i] + (voxel_set,))
-            else:
-                # patches.append(coordinates)
-                # sizes.append(size)
-                new_cubes = [
-                    [x0 + new_size, y0 + new_size, z0 - new_size],
-                    [x0 - new_size, y0 + new_size, z0 - new_size],
-                    [x0 + new_size, y0 - new_size, z0 - new_size],
-                    [x0 - new_size, y0 - new_size, z0 - new_size],
-                    [x0 + new_size, y0 + new_size, z0 + new_size],
-                    [x0 - new_size, y0 + new_size, z0 + new_size],
-                    [x0 + new_size, y0 - new_size, z0 + new_size],
-                    [x0 - new_size, y0 - new_size, z0 + new_size],
-                ]
-                our_choice = np.unique(np.random.choice(np.arange(8),
-                                                        size=self.num_choice))
-                new_cubes = np.take(new_cubes, our_choice, axis=0)
-                patches.extend(new_cubes)
-                # sizes.extend([size] * our_choice.shape[0])
-                sizes.extend([self.d/2] * our_choice.shape[0])
-        return np.array(patches), np.array(sizes)[:, None]
+        _, leaves = np.unique(keys, return_index=True)
+        # For each leaf, choose sub-cubes shifted of size/2 around its center
+        our_choice = np.random.choice(np.arange(8),
+                                      size=(len(leaves), self.num_choice))
+        selected = np.zeros((len(leaves), 8), dtype=np.bool_)
+        selected[np.arange(len(leaves))[:, None], our_choice] = True
+        leaf_index, sub_cube = np.nonzero(selected)
+        patches = centers[leaves][leaf_index] + self.children[sub_cube] * size/2
+        sizes = np.full((len(patches), 1), self.d/2)
+        return patches, sizes
@@ -1,4 +1,5 @@
 from algorithm import CroppingAlgorithm
+from spatial_index import SpatialIndex
 import numpy as np
 
 
@@ -17,6 +18,11 @@ class Probabilistic(CroppingAlgorithm):
     (i.e. any voxel is either in a core or overlapped at least xx times)
 
     Guarantees a minimum coverage.
+
+    Voxels are indexed once per event with a voxel grid hash, so that each
+    iteration only touches the voxels near the sampled center. Probabilities
+    and coverage counts are updated incrementally. Patches are the same as
+    with the brute force version (`crop_bruteforce`) for the same random state.
     """
 
     def __init__(self, cfg):
@@ -25,6 +31,50 @@ class Probabilistic(CroppingAlgorithm):
         self.min_overlap = cfg.MIN_OVERLAP
 
     def crop(self, coords):
+        n = coords.shape[0]
+        index = SpatialIndex(coords, self.d)
+        proba = np.ones((n)) / n
+        i = 0
+        patches = []  # List of center coordinates of patches dxd
+        voxel_num_boxes = np.zeros_like(proba)
+        voxel_num_cores = np.zeros_like(proba)
+        # Number of voxels with voxel_num_cores < min_overlap
+        num_uncovered = n if self.min_overlap > 0 else 0
+        while num_uncovered > 0 and i < self.max_patches:
+            indices = np.random.choice(n, p=proba)
+            indices_inside = index.query_box(coords[indices] - self.d/2,
+                                             coords[indices] + self.d/2)
+            distances_to_center = np.sqrt(np.sum(
+                np.power(coords[indices_inside] - coords[indices], 2),
+                axis=-1))
+
+            core_indices = distances_to_center <= self.a
+            side_indices = np.logical_and(np.logical_not(core_indices),
+                                          distances_to_center <= self.d)
+            proba[indices_inside[core_indices]] *= 0.01
+            proba[indices_inside[side_indices]] *= 0.4
+
+            # Update voxel_num_boxes: increment all voxels inside box
+            voxel_num_boxes[indices_inside] += 1
+            voxel_num_cores[indices_inside[core_indices]] += 1
+            num_uncovered -= np.count_nonzero(
+                voxel_num_cores[indices_inside[core_indices]] == self.min_overlap)
+            patches.append(coords[indices])
+            i += 1
+            total = np.sum(proba)
+            if total == 0.0:
+                break
+            proba = proba / total
+
+        if i == self.max_patches:
+            print("WARNING -- Reached the max number of patches in cropping algo.")
+
+        return np.array(patches), np.array([self.cfg.SLICE_SIZE] * len(patches))
+
+    def crop_bruteforce(self, coords):
+        """
+        Reference version testing all voxels at each iteration.
+        """
         n = coords.shape[0]
         proba = np.ones((n)) / n
         i = 0
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class SpatialIndex(object):
+    """
+    Voxel grid hash: voxels are bucketed into cubic cells of size `cell_size`
+    and sorted by cell, so that finding voxels inside a box only needs to
+    look at the few cells overlapping this box.
+    Built once per event in O(n log n).
+    """
+
+    def __init__(self, coords, cell_size):
+        self.coords = coords
+        self.dim = coords.shape[1]
+        self.cell_size = cell_size
+        cells = np.floor_divide(coords, cell_size).astype(np.int64)
+        if coords.shape[0] > 0:
+            self.origin = cells.min(axis=0)
+            self.grid_shape = cells.max(axis=0) - self.origin + 1
+        else:
+            self.origin = np.zeros((self.dim,), dtype=np.int64)
+            self.grid_shape = np.ones((self.dim,), dtype=np.int64)
+        keys = np.ravel_multi_index((cells - self.origin).T, self.grid_shape)
+        self.order = np.argsort(keys, kind='mergesort')
+        self.keys, self.starts, counts = np.unique(keys[self.order],
+                                                   return_index=True,
+                                                   return_counts=True)
+        self.ends = self.starts + counts
+
+    def candidates(self, low, high):
+        """
+        Returns sorted indices of voxels in the cells overlapping the box
+        low <= coords <= high (superset of the voxels inside the box).
+        """
+        cell_low = np.maximum(np.floor_divide(low, self.cell_size) - self.origin, 0).astype(np.int64)
+        cell_high = np.minimum(np.floor_divide(high, self.cell_size) - self.origin,
+                               self.grid_shape - 1).astype(np.int64)
+        if np.any(cell_high < cell_low):
+            return np.zeros((0,), dtype=np.int64)
+        cells = np.stack(np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(cell_low, cell_high)],
+                                     indexing='ij'), axis=-1).reshape((-1, self.dim))
+        keys = np.ravel_multi_index(cells.T, self.grid_shape)
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        positions, keys = positions[found], keys[found]
+        positions = positions[self.keys[positions] == keys]  # Non empty cells
+        if len(positions) == 0:
+            return np.zeros((0,), dtype=np.int64)
+        return np.sort(np.concatenate([self.order[self.starts[p]:self.ends[p]] for p in positions]))
+
+    def query_box(self, low, high):
+        """
+        Returns indices of voxels such that low <= coords <= high on all axes.
+        """
+        candidates = self.candidates(low, high)
+        inside = np.all(np.logical_and(
+            self.coords[candidates] >= low,
+            self.coords[candidates] <= high
+            ), axis=-1)
+        return candidates[inside]
@@ -2,3 +2,5 @@ from hdf5data import HDF5Generator
 from larcvdata import LarcvGenerator
 from toydata import ToydataGenerator
 from csvdata import CSVGenerator
+from sparsedata import SparseGenerator, SparseWriter
+from prefetcher import Prefetcher
@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import os
 import pandas as pd
 
 
@@ -20,7 +21,14 @@ class CSVGenerator(object):
     0,2.0,0.017397273,140,71,184
     0,2.0,0.586628,140,71,185
     /!\ Supports only 3D data.
+
+    The file is parsed once, sorted by event and stored as flat column
+    arrays with per-event offsets, so that fetching an event is a mere
+    slice. Event numbers do not need to be contiguous.
+    If `CSV_CACHE` is set, these arrays are saved to a `.npz` file next to
+    the CSV file and reused by subsequent runs.
     """
+    COLUMNS = ['x', 'y', 'z', 'val', 'label']
 
     def __init__(self, cfg, filelist=""):
         self.N = cfg.IMAGE_SIZE  # shape of canvas
@@ -30,25 +38,68 @@ class CSVGenerator(object):
         np.random.seed(cfg.SEED)
         self.index = 0
 
+        cache_file = filelist + '.npz'
+        if cfg.CSV_CACHE and os.path.isfile(cache_file) and \
+                os.path.getmtime(cache_file) >= os.path.getmtime(filelist):
+            columns = dict(np.load(cache_file))
+        else:
+            columns = self.build_index(filelist)
+            if cfg.CSV_CACHE:
+                try:
+                    np.savez(cache_file, **columns)
+                except (IOError, OSError) as e:
+                    print("WARNING Could not write CSV index cache: %s" % e)
+
+        self.events = columns['events']
+        self.offsets = columns['offsets']
+        self.x, self.y, self.z = columns['x'], columns['y'], columns['z']
+        self.val = columns['val']
+        self.label = columns['label'] if 'label' in columns else None
+        self.n = len(self.events)
+
+    def build_index(self, filelist):
+        """
+        Parse the CSV file and sort it by event.
+        Returns flat column arrays, the sorted list of event numbers and
+        offsets such that event events[i] spans rows offsets[i]:offsets[i+1].
+        """
         df = pd.read_csv(filelist, delimiter=',')
-        self.data = df.groupby('event')
-        self.n = len(self.data)
+        order = np.argsort(df.event.values, kind='mergesort')  # stable
+        columns = {}
+        for c in self.COLUMNS:
+            if c in df:
+                columns[c] = df[c].values[order]
+        events, counts = np.unique(df.event.values, return_counts=True)
+        columns['events'] = events
+        columns['offsets'] = np.concatenate([[0], np.cumsum(counts)])
+        return columns
 
     def forward(self):
-        group = self.data.get_group(self.index)
-        is_testing = 'label' not in group
+        start, end = self.offsets[self.index], self.offsets[self.index + 1]
+        x, y, z = self.x[start:end], self.y[start:end], self.z[start:end]
+        is_testing = self.label is None
         blob = {}
+        if self.cfg.SPARSE_BLOB:
+            # Voxels in reversed order with respect to dense axes
+            blob['voxels'] = np.stack([z, y, x], axis=-1)
+            blob['voxels_value'] = self.val[start:end].astype(np.float32)
+            if not is_testing:
+                blob['voxels_labels'] = self.label[start:end].astype(np.int32)
+            blob['entries'] = [int(self.events[self.index])]
+            self.index = (self.index + 1) % self.n
+            return blob
+
         blob['data'] = np.zeros((1,) + (self.N,) * self.dim + (1,),
                                 dtype=np.float32)
         if not is_testing:
             blob['labels'] = np.zeros((1,) + (self.N,) * self.dim,
                                       dtype=np.int32)
 
-        blob['voxels'] = np.stack([group.x.values, group.y.values, group.z.values], axis=-1)
-        blob['voxels_value'] = group.val.values
-        blob['data'][0, group.x.values, group.y.values, group.z.values, 0] = blob['voxels_value']
+        blob['voxels'] = np.stack([x, y, z], axis=-1)
+        blob['voxels_value'] = self.val[start:end]
+        blob['data'][0, x, y, z, 0] = blob['voxels_value']
         if not is_testing:
-            blob['labels'][0, group.x.values, group.y.values, group.z.values] = group.label.values
-        blob['entries'] = [self.index]
+            blob['labels'][0, x, y, z] = self.label[start:end]
+        blob['entries'] = [int(self.events[self.index])]
         self.index = (self.index + 1) % self.n
         return blob
@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import glob
 import tables
 from faster_particles.display_utils import extract_voxels
 
@@ -11,6 +12,14 @@ class HDF5Generator(object):
     """
     Read HDF5 data files.
     Expecting at least a `data` column, possibly a `label` column.
+    Sparse files are also supported: they hold variable length arrays
+    `voxels` (flattened coordinates, in the same axis order as dense data),
+    `voxels_value` and possibly `voxels_labels`, one row per event.
+
+    `filelist` can be a path, a glob pattern or a list of them. Events of all
+    files share a global index and are read by chunks of `HDF5_CHUNK_SIZE`
+    contiguous rows. If `SHUFFLE` is set, the order of chunks and of events
+    inside each chunk changes at every epoch, deterministically given `SEED`.
     """
 
     def __init__(self, cfg, filelist="", is_testing=False):
@@ -18,18 +27,118 @@ class HDF5Generator(object):
         self.cfg = cfg
         self.dim = 3 if cfg.DATA_3D else 2
         self.is_testing = is_testing
+        self.chunk_size = max(1, cfg.HDF5_CHUNK_SIZE)
+        self.shuffle = cfg.SHUFFLE
 
         np.random.seed(cfg.SEED)
-        self.file = tables.open_file(filelist, 'r')
-        self.index = 0
-        self.n = len(self.file.root.data)
+        if not isinstance(filelist, (list, tuple)):
+            filelist = [filelist]
+        filenames = []
+        for pattern in filelist:
+            matches = sorted(glob.glob(pattern))
+            if len(matches) == 0:
+                raise Exception("Datafile %s not found!" % pattern)
+            filenames.extend(matches)
+        self.files = [tables.open_file(f, 'r') for f in filenames]
+        self.is_sparse = '/voxels' in self.files[0]
+
+        # Global index: event i is row i - offsets[k] of file k
+        sizes = [len(self.data_node(f)) for f in self.files]
+        self.offsets = np.cumsum([0] + sizes)
+        self.n = self.offsets[-1]
+        self.chunks = [(k, start, min(start + self.chunk_size, size))
+                       for k, size in enumerate(sizes)
+                       for start in range(0, size, self.chunk_size)]
+
+        self.epoch = -1
+        self.new_epoch()
+
+    def __del__(self):
+        for f in self.files:
+            f.close()
+
+    def data_node(self, f):
+        return f.root.voxels if self.is_sparse else f.root.data
+
+    def new_epoch(self):
+        """
+        Define the order in which chunks are read during next epoch.
+        """
+        self.epoch += 1
+        self.random = np.random.RandomState(self.cfg.SEED + self.epoch)
+        self.chunk_order = np.arange(len(self.chunks))
+        if self.shuffle:
+            self.random.shuffle(self.chunk_order)
+        self.chunk_index = 0
+        self.buffer = []
+
+    def read_chunk(self):
+        """
+        Read next chunk of contiguous rows in a single call per column.
+        Fills self.buffer with (entry, data, labels) tuples.
+        """
+        if self.chunk_index == len(self.chunk_order):
+            self.new_epoch()
+        k, start, stop = self.chunks[self.chunk_order[self.chunk_index]]
+        self.chunk_index += 1
+        f = self.files[k]
+        with_labels = not self.is_testing
+        if self.is_sparse:
+            voxels = f.root.voxels[start:stop]
+            values = f.root.voxels_value[start:stop]
+            data = [(np.reshape(v, (-1, self.dim)), val)
+                    for v, val in zip(voxels, values)]
+            with_labels = with_labels and '/voxels_labels' in f
+            labels = f.root.voxels_labels[start:stop] if with_labels else None
+        else:
+            data = f.root.data[start:stop]
+            with_labels = with_labels and '/label' in f
+            labels = f.root.label[start:stop] if with_labels else None
+
+        order = np.arange(stop - start)
+        if self.shuffle:
+            self.random.shuffle(order)
+        self.buffer = [(int(self.offsets[k] + start + i),
+                        data[i],
+                        labels[i] if labels is not None else None)
+                       for i in order[::-1]]  # buffer is popped from the end
 
     def forward(self):
+        if len(self.buffer) == 0:
+            self.read_chunk()
+        entry, data, labels = self.buffer.pop()
         blob = {}
-        blob['data'] = np.reshape(self.file.root.data[self.index], (1,) + (self.N,) * self.dim + (1,))
-        if not self.is_testing:
-            blob['labels'] = np.reshape(self.file.root.label[self.index], (1,) + (self.N,) * self.dim)
-        blob['voxels'], blob['voxels_value'] = extract_voxels(blob['data'][0, ..., 0])
-        blob['entries'] = [self.index]
-        self.index = (self.index + 1) % self.n
+        if self.is_sparse:
+            voxels, values = data
+            voxels = voxels.astype(np.int32)
+            if self.cfg.SPARSE_BLOB:
+                # Voxels in reversed order with respect to dense axes
+                blob['voxels'] = np.flip(voxels, axis=1)
+                blob['voxels_value'] = values.astype(np.float32)
+                if labels is not None:
+                    blob['voxels_labels'] = labels.astype(np.int32)
+            else:
+                blob['data'] = np.zeros((1,) + (self.N,) * self.dim + (1,),
+                                        dtype=np.float32)
+                blob['data'][(0,) + tuple(voxels.T) + (0,)] = values
+                if labels is not None:
+                    blob['labels'] = np.zeros((1,) + (self.N,) * self.dim,
+                                              dtype=np.int32)
+                    blob['labels'][(0,) + tuple(voxels.T)] = labels
+                blob['voxels'], blob['voxels_value'] = voxels, values
+        else:
+            data = np.reshape(data, (self.N,) * self.dim)
+            if self.cfg.SPARSE_BLOB:
+                voxels, blob['voxels_value'] = extract_voxels(data)
+                # Voxels in reversed order with respect to dense axes
+                blob['voxels'] = np.flip(voxels, axis=1)
+                if labels is not None:
+                    labels = np.reshape(labels, (self.N,) * self.dim)
+                    blob['voxels_labels'] = labels[tuple(voxels.T)].astype(np.int32)
+            else:
+                blob['data'] = np.reshape(data, (1,) + (self.N,) * self.dim + (1,))
+                if labels is not None:
+                    blob['labels'] = np.reshape(labels, (1,) + (self.N,) * self.dim)
+                blob['voxels'], blob['voxels_value'] = extract_voxels(blob['data'][0, ..., 0])
+        blob['entries'] = [entry]
         return blob
@@ -11,7 +11,7 @@ from larcv import larcv
 larcv.ThreadProcessor
 from larcv.dataloader2 import larcv_threadio
 import tempfile
-from faster_particles.ppn_utils import crop
+from faster_particles.ppn_utils import crop, densify_blob
 
 
 class LarcvGenerator(object):
@@ -85,57 +85,60 @@ class LarcvGenerator(object):
         self.proc.start_manager(self.cfg.BATCH_SIZE)
         self.proc.next()
 
-    def extract_voxels(self, image):
-        voxels, voxels_value = [], []
-        indices = np.nonzero(image)[0]
-        for i in indices:
-            voxels_value.append(image[i])
-            x = i % self.N
-            i = (i-x)/self.N
-            y = i % self.N
-            i = (i-y)/self.N
-            z = i % self.N
-            voxels.append([x, y, z])
+    def extract_voxels(self, batch_image):
+        """
+        Extract non-zero voxels of a whole batch of flat images at once.
+        batch_image has shape (BATCH_SIZE, N**dim), flat index being
+        z * N**2 + y * N + x (or y * N + x in 2D).
+        Returns int32 coordinates (x, y[, z]) of shape (None, dim) - with an
+        additional batch index column in SPARSE mode - and float32 values.
+        """
+        batch_image = np.reshape(batch_image, (-1, self.N ** self.dim))
+        batch_index, indices = np.nonzero(batch_image)
+        voxels_value = batch_image[batch_index, indices].astype(np.float32)
+        columns = list(np.unravel_index(indices, (self.N,) * self.dim)[::-1])
+        if self.cfg.BATCH_SIZE > 1 and (self.cfg.SPARSE or self.cfg.SPARSE_BLOB):
+            columns.append(batch_index)
+        voxels = np.stack(columns, axis=-1).astype(np.int32)
         return voxels, voxels_value
 
-    def extract_pixels(self, image):
-        pixels, pixels_value = [], []
-        indices = np.nonzero(image)[0]
-        for i in indices:
-            pixels_value.append(image[i])
-            x = i % self.N
-            i = (i-x)/self.N
-            y = i % self.N
-            pixels.append([x, y])
-        return pixels, pixels_value
+    def extract_values(self, batch_array, voxels):
+        """
+        Values of another flat batch array (e.g. labels) at the voxels
+        returned by extract_voxels.
+        """
+        batch_array = np.reshape(batch_array, (-1, self.N ** self.dim))
+        if voxels.shape[1] > self.dim:
+            batch_index = voxels[:, self.dim]
+        else:
+            batch_index = np.zeros((voxels.shape[0],), dtype=np.int32)
+        indices = np.ravel_multi_index(tuple(voxels[:, self.dim-1::-1].T),
+                                       (self.N,) * self.dim)
+        return batch_array[batch_index, indices]
+
+    def decode_points(self, points, label):
+        """
+        Decode a flat buffer of points (x, y[, z]) ended by a negative
+        sentinel value (or by the end of buffer).
+        Returns float32 array of shape (M, dim+1) with reversed coordinates
+        ((z, y, x) or (y, x)) and label as last column.
+        """
+        points = np.asarray(points, dtype=np.float32)
+        points = np.reshape(points[:len(points) - len(points) % self.dim],
+                            (-1, self.dim))
+        sentinel = points[:, 0] < 0
+        if sentinel.any():
+            points = points[:np.argmax(sentinel)]
+        labels = np.full((len(points), 1), label, dtype=np.float32)
+        return np.concatenate([points[:, ::-1], labels], axis=1)
 
     def extract_gt_pixels(self, t_points, s_points):
-        gt_pixels = []
-        if self.cfg.DATA_3D:
-            for pt_index in np.arange(int(len(t_points)/3)):
-                x = t_points[ 3*pt_index     ]
-                y = t_points[ 3*pt_index + 1 ]
-                z = t_points[ 3*pt_index + 2 ]
-                if x < 0: break
-                gt_pixels.append([z, y, x, 1])
-            for pt_index in np.arange(int(len(s_points)/3)):
-                x = s_points[ 3*pt_index     ]
-                y = s_points[ 3*pt_index + 1 ]
-                z = s_points[ 3*pt_index + 2 ]
-                if x < 0: break
-                gt_pixels.append([z, y, x, 2])
-        else:
-            for pt_index in np.arange(int(len(t_points)/2)):
-                x = t_points[ 2*pt_index     ]
-                y = t_points[ 2*pt_index + 1 ]
-                if x < 0: break
-                gt_pixels.append([y, x, 1])
-            for pt_index in np.arange(int(len(s_points)/2)):
-                x = s_points[ 2*pt_index     ]
-                y = s_points[ 2*pt_index + 1 ]
-                if x < 0: break
-                gt_pixels.append([y, x, 2])
-        return gt_pixels
+        """
+        Returns float32 array of shape (M, dim+1) of track (label 1) and
+        shower (label 2) ground truth points.
+        """
+        return np.concatenate([self.decode_points(t_points, 1),
+                               self.decode_points(s_points, 2)], axis=0)
 
     def forward(self, extract_voxels=True):
         # Boolean: whether to include labels information
@@ -156,86 +159,62 @@ class LarcvGenerator(object):
         # batch_entries = self.proc.fetch_entries()
         # batch_event_ids = self.proc.fetch_event_ids()
 
-        gt_pixels, output, output_labels, output_weight, final_entries = [], [], [], [], []
-        output_voxels, output_voxels_value, batch_index = [], [], []
+        gt_pixels, kept_indices, final_entries = [], [], []
         img_shape = (self.cfg.BATCH_SIZE,) + (self.N,) * self.dim + (1,)
         labels_shape = (self.cfg.BATCH_SIZE,) + (self.N,) * self.dim
         weight_shape = labels_shape
-        voxels_shape = (self.cfg.BATCH_SIZE, -1, self.dim)
-        voxels_value_shape = (self.cfg.BATCH_SIZE, -1)
 
         for index in np.arange(self.cfg.BATCH_SIZE):
-            image = batch_image.data()[index]
-            if include_labels:
-                labels = batch_labels.data()[index]
-            if self.cfg.URESNET_WEIGHTING:
-                weight = batch_weight.data()[index]
-            if include_ppn:
-                t_points = batch_track.data()[index]
-                s_points = batch_shower.data()[index]
             entry_id = entries.data()[index]
-
             final_entries.append(entry_id)
-            if extract_voxels:
-                voxels, voxels_value = self.extract_voxels(image) if self.cfg.DATA_3D else self.extract_pixels(image)
-
-            image = image.reshape(img_shape[1:])
-            if include_labels:
-                labels = labels.reshape(labels_shape[1:])
-            if self.cfg.URESNET_WEIGHTING:
-                weight = weight.reshape(weight_shape[1:])
 
             # TODO set N from this
             # TODO For now we only consider batch size 1
             if include_ppn:
-                gt_pixels.extend(self.extract_gt_pixels(t_points, s_points))
+                t_points = batch_track.data()[index]
+                s_points = batch_shower.data()[index]
+                gt_pixels.append(self.extract_gt_pixels(t_points, s_points))
 
-            if not include_ppn or len(gt_pixels) > 0:
-                output.append(image)
-                if include_labels:
-                    output_labels.append(labels)
-                if self.cfg.URESNET_WEIGHTING:
-                    output_weight.append(weight)
-            if extract_voxels:
-                voxels = np.array(voxels)
-                voxels_value = np.array(voxels_value)
-                if self.cfg.BATCH_SIZE > 1 and self.cfg.SPARSE:
-                    output_voxels.append(np.pad(voxels, [(0, 0), (0, 1)], 'constant', constant_values=index))
-                else:
-                    output_voxels.append(voxels)
-                output_voxels_value.append(voxels_value)
+            if not include_ppn or sum([len(g) for g in gt_pixels]) > 0:
+                kept_indices.append(index)
 
-        if len(output) == 0:  # No gt pixels in this batch - try next batch
+        if len(kept_indices) == 0:  # No gt pixels in this batch - try next batch
             print("DUMP - no gt pixels in this batch, try next batch")
             return self.forward()
 
-        output = np.reshape(np.array(output), img_shape)
-        if include_labels:
-            output_labels = np.reshape(np.array(output_labels), labels_shape)
-        if self.cfg.URESNET_WEIGHTING:
-            output_weight = np.reshape(np.array(output_weight), weight_shape)
-        if extract_voxels:
-            output_voxels = np.vstack(output_voxels)
-            output_voxels_value = np.hstack(output_voxels_value)
-
         blob = {}
-        blob['data'] = output.astype(np.float32)
-        if include_labels:
-            blob['labels'] = output_labels.astype(np.int32)
-        if self.cfg.URESNET_WEIGHTING:
-            blob['weight'] = output_weight.astype(np.float32)
+        if self.cfg.SPARSE_BLOB:
+            # Only coordinates and values, dense arrays are never built
+            blob['voxels'], blob['voxels_value'] = self.extract_voxels(batch_image.data())
+            if include_labels:
+                blob['voxels_labels'] = self.extract_values(
+                    batch_labels.data(), blob['voxels']).astype(np.int32)
+            if self.cfg.URESNET_WEIGHTING:
+                blob['weight_voxels'], blob['weight_value'] = self.extract_voxels(batch_weight.data())
+        else:
+            blob['data'] = np.reshape(
+                np.asarray(batch_image.data())[kept_indices],
+                img_shape).astype(np.float32)
+            if include_labels:
+                blob['labels'] = np.reshape(
+                    np.asarray(batch_labels.data())[kept_indices],
+                    labels_shape).astype(np.int32)
+            if self.cfg.URESNET_WEIGHTING:
+                blob['weight'] = np.reshape(
+                    np.asarray(batch_weight.data())[kept_indices],
+                    weight_shape).astype(np.float32)
+            if extract_voxels:
+                blob['voxels'], blob['voxels_value'] = self.extract_voxels(batch_image.data())
         if include_ppn:
-            blob['gt_pixels'] = np.array(gt_pixels)
-        if extract_voxels:
-            blob['voxels'] = output_voxels  # np.array(voxels)
-            blob['voxels_value'] = output_voxels_value  # np.array(voxels_value)
+            blob['gt_pixels'] = np.concatenate(gt_pixels, axis=0)
         blob['entries'] = final_entries
         # Crop regions around gt points for small UResNet
         if self.cfg.NET == 'small_uresnet':
+            data = blob['data'] if 'data' in blob else densify_blob(blob, self.N, self.dim)['data']
             blob['crops'], blob['crops_labels'] = crop(
                 blob['gt_pixels'][:, :-1],
                 self.cfg.CROP_SIZE,
-                blob['data'],
+                data,
                 use_smear=True)
 
         return blob
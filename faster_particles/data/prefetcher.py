@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import threading
+import traceback
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class Prefetcher(object):
+    """
+    Wrap any data generator exposing `forward()` and build blobs ahead of
+    time in background threads, so that blob creation (reading, voxel
+    extraction, optional cropping through `process`) overlaps with the
+    session runs.
+
+    - `cfg.PREFETCH_DEPTH` is the maximum number of blobs waiting in the
+    queue. 0 disables prefetching: `forward` then runs synchronously.
+    - `cfg.PREFETCH_WORKERS` is the number of worker threads. Calls to the
+    wrapped generator are serialized, only `process` runs concurrently.
+    With more than one worker the order of blobs is not deterministic.
+    - `cfg.PREFETCH_TIMEOUT` is the maximum time (in seconds) `forward` waits
+    for a blob before raising an exception (None = wait forever).
+
+    `forward` returns `process(generator.forward())`. Any other attribute
+    (e.g. `n`, `reset`) is looked up on the wrapped generator.
+    """
+
+    def __init__(self, generator, cfg, process=None):
+        self.generator = generator
+        self.process = process
+        self.depth = cfg.PREFETCH_DEPTH
+        self.num_workers = max(1, cfg.PREFETCH_WORKERS)
+        self.timeout = cfg.PREFETCH_TIMEOUT
+
+        self._queue = queue.Queue(maxsize=max(1, self.depth))
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._workers = []
+
+        # Statistics
+        self.num_blobs = 0
+        self.wait_time = 0.0  # Time spent by consumer waiting for a blob
+        self.build_time = 0.0  # Time spent by workers building blobs
+
+    def __getattr__(self, name):
+        # Only called if attribute was not found on the Prefetcher itself
+        if name == 'generator':
+            raise AttributeError(name)
+        return getattr(self.generator, name)
+
+    def __del__(self):
+        self.stop()
+
+    def _build(self):
+        start = time.time()
+        with self._lock:
+            blob = self.generator.forward()
+        if self.process is not None:
+            blob = self.process(blob)
+        with self._stats_lock:
+            self.build_time += time.time() - start
+        return blob
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                item = (self._build(), None)
+            except Exception as e:
+                traceback.print_exc()
+                item = (None, e)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if item[1] is not None:
+                return
+
+    def start(self):
+        """
+        Start worker threads. Called lazily by the first `forward` so that
+        configuration changes made after construction are taken into account.
+        """
+        if self.depth <= 0 or len(self._workers) > 0:
+            return
+        print("Prefetching up to %d blobs with %d worker(s)..." % (
+            self.depth, self.num_workers))
+        self._stop.clear()
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._work,
+                                      name="prefetcher-%d" % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        """
+        Stop worker threads and discard prefetched blobs.
+        """
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def forward(self):
+        if self.depth <= 0:
+            self.num_blobs += 1
+            return self._build()
+
+        self.start()
+        start = time.time()
+        try:
+            blob, error = self._queue.get(timeout=self.timeout)
+        except queue.Empty:
+            raise Exception("Prefetcher: no blob ready after %s s."
+                            % self.timeout)
+        self.wait_time += time.time() - start
+        self.num_blobs += 1
+        if error is not None:
+            self.stop()
+            raise error
+        return blob
+
+    def summary(self):
+        """
+        One-line report of prefetching statistics.
+        """
+        n = max(1, self.num_blobs)
+        return "Prefetch depth %d, workers %d, queue %d/%d - average wait %f s, average build %f s" % (
+            self.depth, self.num_workers, self._queue.qsize(),
+            max(1, self.depth), self.wait_time / n, self.build_time / n)
@@ -0,0 +1,4 @@
+from sparsedata_generator import SparseGenerator
+from sparsedata_converter import SparseWriter, convert
+
+__all__ = ['sparsedata_generator', 'sparsedata_converter']
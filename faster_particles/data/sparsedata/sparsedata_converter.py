@@ -0,0 +1,120 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import os
+import time
+
+
+class SparseWriter(object):
+    """
+    Write events to the binary sparse format read by SparseGenerator.
+    `output_dir` will contain one raw binary file per blob key (rows of all
+    events appended one after the other) and an `index.npz` file holding
+    the per-event offset table in each of these files.
+
+    - `voxels` and `weight_voxels`: uint16 coordinates in reversed order
+    with respect to dense axes (LArCV convention), shape (None, dim)
+    - `voxels_value` and `weight_value`: float32
+    - `voxels_labels`: uint8
+    - `gt_pixels`: float32, shape (None, dim + 1)
+
+    Blobs to write must be sparse blobs with a single event (as generated
+    with SPARSE_BLOB on and BATCH_SIZE = 1).
+    """
+    DTYPES = {
+        'voxels': np.uint16,
+        'voxels_value': np.float32,
+        'voxels_labels': np.uint8,
+        'gt_pixels': np.float32,
+        'weight_voxels': np.uint16,
+        'weight_value': np.float32
+    }
+
+    def __init__(self, output_dir, N, dim, data_order=False):
+        """
+        data_order: whether the source generator returns voxels in the same
+        order as dense axes when SPARSE_BLOB is off (CSV and HDF5 data).
+        """
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        self.output_dir = output_dir
+        self.N = N
+        self.dim = dim
+        self.data_order = data_order
+        self.keys = None
+        self.files = {}
+        self.counts = {}
+        self.entries = []
+
+    def write(self, blob):
+        if 'data' in blob:
+            raise Exception("SparseWriter expects sparse blobs (SPARSE_BLOB).")
+        if len(blob['entries']) != 1:
+            raise Exception("SparseWriter expects one event per blob.")
+        keys = sorted([k for k in self.DTYPES if k in blob])
+        if self.keys is None:
+            self.keys = keys
+            for k in keys:
+                self.files[k] = open(os.path.join(self.output_dir, k + '.bin'), 'wb')
+                self.counts[k] = []
+        elif keys != self.keys:
+            raise Exception("Inconsistent blob keys: %s instead of %s" % (keys, self.keys))
+
+        for k in self.keys:
+            array = np.asarray(blob[k])
+            if k in ['voxels', 'weight_voxels'] and array.size > 0 and \
+                    (array.min() < 0 or array.max() > np.iinfo(np.uint16).max):
+                raise Exception("Coordinates out of uint16 range in %s." % k)
+            if k == 'voxels_labels' and array.size > 0 and \
+                    (array.min() < 0 or array.max() > np.iinfo(np.uint8).max):
+                raise Exception("Labels out of uint8 range.")
+            array.astype(self.DTYPES[k]).tofile(self.files[k])
+            self.counts[k].append(len(array))
+        self.entries.append(blob['entries'][0])
+
+    def close(self):
+        if self.keys is None:
+            raise Exception("No event was written.")
+        for f in self.files.values():
+            f.close()
+        index = {'offsets_' + k: np.concatenate([[0], np.cumsum(self.counts[k])]).astype(np.int64)
+                 for k in self.keys}
+        np.savez(os.path.join(self.output_dir, 'index.npz'),
+                 entries=np.array(self.entries, dtype=np.int64),
+                 keys=np.array(self.keys),
+                 image_size=self.N,
+                 dim=self.dim,
+                 data_order=self.data_order,
+                 **index)
+
+
+def convert(cfg):
+    """
+    Convert cfg.MAX_STEPS events (at most) of cfg.DATA (LArCV, HDF5 or CSV
+    as given by cfg.DATA_TYPE) to the binary sparse format in
+    cfg.OUTPUT_DIR. Use DATA_TYPE = 'sparse' to read them afterwards.
+    """
+    from faster_particles.demo_ppn import get_data
+
+    if cfg.DATA_TYPE not in ['larcv', 'hdf5', 'csv']:
+        raise Exception("Cannot convert %s data." % cfg.DATA_TYPE)
+    cfg.SPARSE_BLOB = True
+    cfg.BATCH_SIZE = 1
+    data, _ = get_data(cfg)
+    num_events = cfg.MAX_STEPS
+    if hasattr(data, 'n'):
+        num_events = min(num_events, data.n)
+
+    writer = SparseWriter(cfg.OUTPUT_DIR, cfg.IMAGE_SIZE,
+                          3 if cfg.DATA_3D else 2,
+                          data_order=cfg.DATA_TYPE != 'larcv')
+    start = time.time()
+    for i in range(num_events):
+        writer.write(data.forward())
+        if i % 100 == 0:
+            print("Converted %d / %d events" % (i, num_events))
+    writer.close()
+    print("Converted %d events to %s in %f s" % (
+        num_events, cfg.OUTPUT_DIR, time.time() - start))
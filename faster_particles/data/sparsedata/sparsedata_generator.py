@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import os
+from faster_particles.ppn_utils import crop, densify_blob
+from faster_particles.data.sparsedata.sparsedata_converter import SparseWriter
+
+
+class SparseGenerator(object):
+    """
+    Read events written by SparseWriter (see `ppn convert`).
+    Files are memory-mapped: an event is read by slicing them with the
+    offset table, nothing else is loaded in memory.
+    Blobs are the same as those of the generator the data was converted
+    from, dense arrays being built only when SPARSE_BLOB is off.
+    """
+
+    def __init__(self, cfg, filelist=""):
+        self.N = cfg.IMAGE_SIZE  # shape of canvas
+        self.cfg = cfg
+        self.dim = 3 if cfg.DATA_3D else 2
+
+        np.random.seed(cfg.SEED)
+        self.index = 0
+
+        if not os.path.isfile(os.path.join(filelist, 'index.npz')):
+            raise Exception("Sparse data directory %s not found!" % filelist)
+        index = np.load(os.path.join(filelist, 'index.npz'))
+        if int(index['image_size']) != self.N or int(index['dim']) != self.dim:
+            raise Exception("Sparse data has image size %d in %dD, expected %d in %dD." % (
+                index['image_size'], index['dim'], self.N, self.dim))
+        self.entries = index['entries']
+        self.data_order = bool(index['data_order'])
+        self.n = len(self.entries)
+
+        self.offsets, self.arrays = {}, {}
+        for k in index['keys']:
+            k = str(k)
+            self.offsets[k] = index['offsets_' + k]
+            filename = os.path.join(filelist, k + '.bin')
+            dtype = SparseWriter.DTYPES[k]
+            if os.path.getsize(filename) == 0:  # cannot mmap an empty file
+                array = np.zeros((0,), dtype=dtype)
+            else:
+                array = np.memmap(filename, dtype=dtype, mode='r')
+            if k in ['voxels', 'weight_voxels']:
+                array = array.reshape((-1, self.dim))
+            elif k == 'gt_pixels':
+                array = array.reshape((-1, self.dim + 1))
+            self.arrays[k] = array
+
+    def get(self, key):
+        start, end = self.offsets[key][self.index:self.index+2]
+        return self.arrays[key][start:end]
+
+    def forward(self):
+        blob = {}
+        blob['voxels'] = self.get('voxels').astype(np.int32)
+        blob['voxels_value'] = self.get('voxels_value').astype(np.float32)
+        if 'voxels_labels' in self.arrays:
+            blob['voxels_labels'] = self.get('voxels_labels').astype(np.int32)
+        if 'weight_voxels' in self.arrays:
+            blob['weight_voxels'] = self.get('weight_voxels').astype(np.int32)
+            blob['weight_value'] = self.get('weight_value').astype(np.float32)
+        if 'gt_pixels' in self.arrays:
+            blob['gt_pixels'] = self.get('gt_pixels').astype(np.float32)
+        blob['entries'] = [int(self.entries[self.index])]
+        self.index = (self.index + 1) % self.n
+
+        if not self.cfg.SPARSE_BLOB:
+            blob = densify_blob(blob, self.N, self.dim)
+            for k in ['voxels_labels', 'weight_voxels', 'weight_value']:
+                blob.pop(k, None)
+            if self.data_order:
+                blob['voxels'] = np.flip(blob['voxels'], axis=1)
+        # Crop regions around gt points for small UResNet
+        if self.cfg.NET == 'small_uresnet':
+            data = blob['data'] if 'data' in blob else densify_blob(blob, self.N, self.dim)['data']
+            blob['crops'], blob['crops_labels'] = crop(
+                blob['gt_pixels'][:, :-1],
+                self.cfg.CROP_SIZE,
+                data,
+                use_smear=True)
+        return blob
@@ -49,10 +49,10 @@ class ToydataGenerator(object):
             #print(shower_image)
             #plt.imshow(shower_image)
             #plt.savefig(self.cfg.DISPLAY_DIR + "/shower%d.png" % i)
-            before_1 = np.random.randint(self.cfg.IMAGE_SIZE - shower_image.shape[0])
-            after_1 = self.cfg.IMAGE_SIZE - before_1 - shower_image.shape[0]
-            before_2 = np.random.randint(self.cfg.IMAGE_SIZE - shower_image.shape[1])
-            after_2 = self.cfg.IMAGE_SIZE - before_2 - shower_image.shape[1]
+            before_1 = np.random.randint(self.N - shower_image.shape[0])
+            after_1 = self.N - before_1 - shower_image.shape[0]
+            before_2 = np.random.randint(self.N - shower_image.shape[1])
+            after_2 = self.N - before_2 - shower_image.shape[1]
             #print(before_1, after_1, before_2, after_2)
             output_showers = output_showers + np.pad(shower_image, ((before_1, after_1), (before_2, after_2)), 'constant', constant_values=0)
             shower_start_points.append((int(shower_start_points_i[0]*scale) + before_1, int(shower_start_points_i[1]*scale) + before_2))
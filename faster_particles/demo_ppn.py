@@ -11,8 +11,8 @@ from tensorflow.python.client import timeline
 import os
 import glob
 import time
+import copy
 import re
-from sklearn.cluster import DBSCAN
 
 from faster_particles.display_utils import display, display_uresnet, \
                                             display_ppn_uresnet, display_blob
@@ -21,9 +21,14 @@ from faster_particles.base_net.uresnet import UResNet
 from faster_particles.base_net import basenets
 from faster_particles.metrics import PPNMetrics, UResNetMetrics
 from faster_particles.data import ToydataGenerator, LarcvGenerator, \
-                                HDF5Generator, CSVGenerator
+                                HDF5Generator, CSVGenerator, SparseGenerator, \
+                                Prefetcher
 from faster_particles.cropping import cropping_algorithms
 from faster_particles.display_utils import extract_voxels
+from faster_particles.ppn_utils import densify_blob
+from faster_particles.result_cache import ResultCache, checkpoint_hash, \
+    cache_keys
+from faster_particles.ppn_postprocessing import voxel_graph, dbscan_graph
 
 
 def get_data(cfg):
@@ -41,6 +46,9 @@ def get_data(cfg):
     elif cfg.DATA_TYPE == 'csv':
         train_data = CSVGenerator(cfg, filelist=cfg.DATA)
         test_data = CSVGenerator(cfg, filelist=cfg.TEST_DATA)
+    elif cfg.DATA_TYPE == 'sparse':
+        train_data = SparseGenerator(cfg, filelist=cfg.DATA)
+        test_data = SparseGenerator(cfg, filelist=cfg.TEST_DATA)
     else:  # default is LArCV data
         train_data = LarcvGenerator(cfg, ioname="train",
                                     filelist=get_filelist(cfg.DATA))
@@ -55,12 +63,19 @@ def load_weights(cfg, sess):
     """
     print("Restoring checkpoint file...")
     scopes = []
-    if cfg.WEIGHTS_FILE_PPN is not None:
+    if cfg.NET == 'full' and cfg.SHARED_BASE:
+        # Shared backbone and segmentation from base net checkpoint,
+        # PPN layers from PPN checkpoint
+        if cfg.WEIGHTS_FILE_BASE is not None:
+            scopes.append((lambda x: cfg.BASE_NET in x, cfg.WEIGHTS_FILE_BASE))
+        if cfg.WEIGHTS_FILE_PPN is not None:
+            scopes.append((lambda x: cfg.BASE_NET not in x, cfg.WEIGHTS_FILE_PPN))
+    elif cfg.WEIGHTS_FILE_PPN is not None:
         scopes.append((lambda x: 'small_uresnet' not in x, cfg.WEIGHTS_FILE_PPN))
     # Restore variables for base net if given checkpoint file
     elif cfg.WEIGHTS_FILE_BASE is not None:
         if cfg.NET in ['ppn', 'ppn_ext', 'full']: # load only relevant layers of base network
-		    scopes.append((lambda x: cfg.BASE_NET in x and "optimizer" not in x, cfg.WEIGHTS_FILE_BASE))
+            scopes.append((lambda x: cfg.BASE_NET in x and "optimizer" not in x, cfg.WEIGHTS_FILE_BASE))
             #scopes.append((lambda x: cfg.BASE_NET in x, cfg.WEIGHTS_FILE_BASE))
         else: # load for full base network
             scopes.append((lambda x: cfg.BASE_NET in x, cfg.WEIGHTS_FILE_BASE))
@@ -164,41 +179,123 @@ def inference_detail_log(cfg, blobs, weights_dir, net, num_tests):
         metrics_ppn.plot_snapshot()
 
 
+class StreamingNetwork(object):
+    """
+    Network living in its own graph and session, so that several networks
+    (e.g. base and PPN, which share variable names) stay loaded side by side
+    and can all run on each event in turn.
+    The session is only opened and weights restored at first use: events
+    fully served by the result cache never need them.
+    """
+
+    def __init__(self, cfg, build, name, weights_files, weights_file_ppn=None,
+                 cache=None):
+        """
+        build() creates the network in the current default graph and returns
+        test_image(sess, blob) -> (summary, results).
+        `weights_file_ppn` is the value of cfg.WEIGHTS_FILE_PPN when
+        restoring weights (see `load_weights`).
+        """
+        self.cfg = cfg
+        self.name = name
+        self.weights_file_ppn = weights_file_ppn
+        self.cache = cache
+        self.weights_hash = checkpoint_hash(weights_files) if cache is not None else None
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.test_image = build()
+        self.sess = None
+        self.duration = []
+
+    def start(self):
+        with self.graph.as_default():
+            self.sess = tf.Session(graph=self.graph)
+            self.sess.run(tf.global_variables_initializer())
+            self.sess.run(tf.local_variables_initializer())
+            weights_file_ppn = self.cfg.WEIGHTS_FILE_PPN
+            self.cfg.WEIGHTS_FILE_PPN = self.weights_file_ppn
+            load_weights(self.cfg, self.sess)
+            self.cfg.WEIGHTS_FILE_PPN = weights_file_ppn
+
+    def run(self, batch_blobs, patch_centers=None, patch_sizes=None):
+        """
+        Returns the list of results for each crop of one event.
+        """
+        keys = None
+        if self.cache is not None:
+            keys = cache_keys(self.cfg, batch_blobs, self.name,
+                              self.weights_hash, patch_centers, patch_sizes)
+        results = []
+        for j, blob in enumerate(batch_blobs):
+            r = self.cache.get(keys[j]) if self.cache is not None else None
+            if r is None:
+                if self.sess is None:
+                    self.start()
+                start = time.time()
+                summary, r = self.test_image(self.sess, blob)
+                self.duration.append(time.time() - start)
+                if self.cache is not None:
+                    self.cache.put(keys[j], r)
+            results.append(r)
+        return results
+
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
+        if len(self.duration):
+            print("%s - average duration of inference = %f s" % (
+                self.name, np.array(self.duration).mean()))
+
+
 def inference(cfg):
     """
-    Inference for `ppn`, `base`, `full`.
-    Retrieves in a loop all the data first and stores it.
-    Memory issues could arise if too many steps are requested.
+    Inference for `ppn`, `base`, `full`, `ppn_ext`.
+    See `stream_inference`.
     """
-    # if cfg.WEIGHTS_FILE_BASE is None or cfg.WEIGHTS_FILE_PPN is None:
-    #     raise Exception("Need both weights files for full inference.")
+    for _ in stream_inference(cfg):
+        pass
+
 
+def stream_inference(cfg):
+    """
+    Streaming inference: events are read (and cropped) one at a time, all
+    the requested networks run on each of them, then results are displayed,
+    added to the metrics and reconciled before moving on to the next event.
+    Only the current event (and the few prefetched ones, see
+    `cfg.PREFETCH_DEPTH`) stays in memory, whatever the number of steps.
+    Yields (index, list of blobs, final results) for each event.
+    """
     if not os.path.isdir(cfg.DISPLAY_DIR):
         os.makedirs(cfg.DISPLAY_DIR)
 
     num_test = cfg.MAX_STEPS
-    inference_base, inference_ppn, blobs = [], [], []
     weights_file_ppn = cfg.WEIGHTS_FILE_PPN
     crop_algorithm = cropping_algorithms[cfg.CROP_ALGO](cfg)
 
-    # 0. Loop to retrieve all the data first
-    # --------------------------------------
-    # Memory issues could arise here if we ask for too many steps.
-    print("Retrieving data...")
     train_data, data = get_data(cfg)
-    patch_centers_list, patch_sizes_list = [], []
-    for i in range(num_test):
-        blob = data.forward()
+
+    def prepare(blob):
         # Cropping pre-processing
-        patch_centers, patch_sizes = None, None
         if cfg.ENABLE_CROP:
-            batch_blobs, patch_centers, patch_sizes = crop_algorithm.process(blob)
-            patch_centers_list.append(patch_centers)
-            patch_sizes_list.append(patch_sizes)
+            return crop_algorithm.process(blob)
+        if cfg.SPARSE_BLOB:
+            blob = densify_blob(blob, cfg.IMAGE_SIZE, 3 if cfg.DATA_3D else 2)
+        return [blob], None, None
+
+    data = Prefetcher(data, cfg, process=prepare)
+
+    if cfg.DETAIL_LOG:
+        # Runs every checkpoint on the same events: they are all kept.
+        blobs = [data.forward()[0] for i in range(num_test)]
+        data.stop()
+        if cfg.NET in ['full', 'base']:
+            inference_detail_log(cfg, blobs, cfg.WEIGHTS_FILE_BASE,
+                                 basenets[cfg.BASE_NET](cfg=cfg), num_test)
         else:
-            batch_blobs = [blob]
-        blobs.append(batch_blobs)
-    print("Done.")
+            inference_detail_log(cfg, blobs, cfg.WEIGHTS_FILE_PPN,
+                                 PPN(cfg=cfg, base_net=basenets[cfg.BASE_NET]),
+                                 num_test)
+        return
 
     if cfg.PROFILE:
         print('WARNING PROFILING ENABLED')
@@ -209,98 +306,132 @@ def inference(cfg):
         new_run = lambda self, fetches, feed_dict=None: old_run(self, fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
         tf.Session.run = new_run
 
-    # 1. Run inference of all the networks.
-    # -------------------------------------
-    # Depending on cfg.NET value, build and run the networks inferences.
+    # 1. Build all the networks.
+    # --------------------------
+    # Depending on cfg.NET value, each network gets its own graph.
+    # Results of each crop are reused from the result cache if enabled.
+    cache = None
+    if cfg.RESULT_CACHE is not None:
+        cache = ResultCache(cfg.RESULT_CACHE, max_size=cfg.RESULT_CACHE_SIZE)
+
+    networks = []
+    shared_base = cfg.NET == 'full' and cfg.SHARED_BASE
+    # Base and PPN on a single backbone
+    if shared_base:
+        print("Base network + PPN...")
+        net_ppn = PPN(cfg=cfg, base_net=basenets[cfg.BASE_NET])
+
+        def build_full():
+            net_ppn.init_placeholders()
+            net_ppn.create_architecture(is_training=False)
+            net_ppn.create_segmentation()
+            return net_ppn.test_image_full
+
+        networks.append(StreamingNetwork(cfg, build_full,
+                                         'full_shared_' + cfg.BASE_NET,
+                                         [cfg.WEIGHTS_FILE_BASE,
+                                          weights_file_ppn],
+                                         weights_file_ppn=weights_file_ppn,
+                                         cache=cache))
+        print("Done.")
 
     # First base
-    inference_base = None
-    if cfg.NET in ['full', 'base']:
+    if cfg.NET in ['full', 'base'] and not shared_base:
         print("Base network...")
-        cfg.WEIGHTS_FILE_PPN = None
         net_base = basenets[cfg.BASE_NET](cfg=cfg)
-        if cfg.DETAIL_LOG:
-            return inference_detail_log(cfg, blobs, cfg.WEIGHTS_FILE_BASE, net_base, num_test)
-        inference_base = inference_simple(cfg, blobs, net_base, num_test=num_test)
-        print("Done.")
 
-    tf.reset_default_graph()
+        def build_base():
+            net_base.init_placeholders()
+            net_base.create_architecture(is_training=False)
+            return net_base.test_image
+
+        networks.append(StreamingNetwork(cfg, build_base,
+                                         'base_' + cfg.BASE_NET,
+                                         [cfg.WEIGHTS_FILE_BASE],
+                                         cache=cache))
+        print("Done.")
 
     # Then PPN
-    inference_ppn = None
-    if cfg.NET in ['full', 'ppn', 'ppn_ext']:
+    if cfg.NET in ['full', 'ppn', 'ppn_ext'] and not shared_base:
         print("PPN network...")
-        cfg.WEIGHTS_FILE_PPN = weights_file_ppn
         net_ppn = PPN(cfg=cfg, base_net=basenets[cfg.BASE_NET])
-        if cfg.DETAIL_LOG:
-            return inference_detail_log(cfg, blobs, cfg.WEIGHTS_FILE_PPN, net_ppn, num_test)
-        inference_ppn = inference_simple(cfg, blobs, net_ppn, num_test=num_test)
-        print("Done.")
 
-    # Small UResNet (try to get better precision after PPN?)
-    inference_small_uresnet = None
-    if cfg.NET == 'ppn_ext':
-        print("Small UResNet + PPN network...")
-        # FIXME better way to control the number of crops here?
-        crops = crop_proposals(cfg, net_ppn.image_placeholder, net_ppn._predictions['im_proposals'])[:512]
-        print(crops)
-        # Cannot use tf.train.batch because the call to tf.train.start_queue_runners
-        # requires image placeholder to be fed already
-        #crops = tf.train.batch([crops], 1, shapes=[tf.TensorShape((cfg.CROP_SIZE, cfg.CROP_SIZE))], dynamic_pad=True, allow_smaller_final_batch=False, enqueue_many=True)
-        net_uresnet = UResNet(cfg=cfg, N=cfg.CROP_SIZE)
-        # FIXME remove dependency on labels at test time
-        net_args = {
-            'image': tf.reshape(crops, (-1, cfg.CROP_SIZE, cfg.CROP_SIZE, 1)),
-            'labels': tf.cast(tf.reshape(crops, (-1, cfg.CROP_SIZE, cfg.CROP_SIZE)),
-                           dtype=tf.int32)
-        }
-
-        def test_image_small_uresnet(sess, blob):
-            results = sess.run([
-                crops,
-                net_uresnet._predictions,
-                net_uresnet._scores
-            ], feed_dict={net_ppn.image_placeholder: blob['data'], net_ppn.gt_pixels_placeholder: blob['gt_pixels']})
-            return None, {'crops': results[0], 'predictions_small': results[1], 'scores_small': results[2]}
-
-        inference_small_uresnet = inference_simple(cfg, blobs, net_uresnet,
-                                                   num_test=num_test,
-                                                   scope='small_uresnet',
-                                                   test_image=test_image_small_uresnet,
-                                                   **net_args)
+        def build_ppn():
+            net_ppn.init_placeholders()
+            net_ppn.create_architecture(is_training=False)
+            if cfg.NET != 'ppn_ext':
+                return net_ppn.test_image
+
+            # Small UResNet (try to get better precision after PPN?)
+            # FIXME better way to control the number of crops here?
+            crops = crop_proposals(cfg, net_ppn.image_placeholder, net_ppn._predictions['im_proposals'])[:512]
+            # Cannot use tf.train.batch because the call to tf.train.start_queue_runners
+            # requires image placeholder to be fed already
+            #crops = tf.train.batch([crops], 1, shapes=[tf.TensorShape((cfg.CROP_SIZE, cfg.CROP_SIZE))], dynamic_pad=True, allow_smaller_final_batch=False, enqueue_many=True)
+            net_uresnet = UResNet(cfg=cfg, N=cfg.CROP_SIZE)
+            # FIXME remove dependency on labels at test time
+            net_uresnet.init_placeholders(
+                image=tf.reshape(crops, (-1, cfg.CROP_SIZE, cfg.CROP_SIZE, 1)),
+                labels=tf.cast(tf.reshape(crops, (-1, cfg.CROP_SIZE, cfg.CROP_SIZE)),
+                               dtype=tf.int32))
+            net_uresnet.create_architecture(is_training=False, scope='small_uresnet')
+
+            def test_image_ppn_ext(sess, blob):
+                summary, results = net_ppn.test_image(sess, blob)
+                small = sess.run([
+                    crops,
+                    net_uresnet._predictions,
+                    net_uresnet._scores
+                ], feed_dict=net_ppn.feed_dict(blob))
+                results.update({'crops': small[0], 'predictions_small': small[1], 'scores_small': small[2]})
+                return summary, results
+
+            return test_image_ppn_ext
+
+        weights_files = [weights_file_ppn, cfg.WEIGHTS_FILE_BASE]
+        if cfg.NET == 'ppn_ext':
+            weights_files.append(cfg.WEIGHTS_FILE_SMALL)
+        networks.append(StreamingNetwork(cfg, build_ppn,
+                                         cfg.NET + '_' + cfg.BASE_NET,
+                                         weights_files,
+                                         weights_file_ppn=weights_file_ppn,
+                                         cache=cache))
         print("Done.")
 
-    # 2. Display all inference results
-    # --------------------------------
-    # Also computes associated metrics if relevant.
-
-    print("Saving displays...")
-    if inference_ppn is not None:
+    if cfg.NET in ['full', 'ppn', 'ppn_ext']:
         metrics_ppn = PPNMetrics(cfg, dim1=net_ppn.dim1, dim2=net_ppn.dim2)
-    if inference_base is not None and cfg.BASE_NET == 'uresnet':
+    if cfg.NET in ['full', 'base'] and cfg.BASE_NET == 'uresnet':
         metrics_uresnet = UResNetMetrics(cfg)
 
+    # 2. Loop over events
+    # -------------------
+    # Run all networks, display results and compute associated metrics.
+    # Displays of crops need their own image size. Use copies of cfg rather
+    # than modifying cfg.IMAGE_SIZE, which prefetching threads are reading.
+    display_cfg = copy.copy(cfg)
+    if cfg.ENABLE_CROP:
+        display_cfg.IMAGE_SIZE = cfg.SLICE_SIZE
+    small_cfg = copy.copy(cfg)
+    small_cfg.IMAGE_SIZE = cfg.CROP_SIZE
     real_step = 0
-    final_results = []
     for i in range(num_test):
-        if cfg.ENABLE_CROP:
-            N = cfg.IMAGE_SIZE
-            cfg.IMAGE_SIZE = cfg.SLICE_SIZE
-        final_blob_results = []
-        for j, blob in enumerate(blobs[i]):
-            print("%d - %d/%d" % (i, j, len(blobs[i])))
+        batch_blobs, patch_centers, patch_sizes = data.forward()
+        batch_results = [{} for blob in batch_blobs]
+        for network in networks:
+            for results, r in zip(batch_results, network.run(batch_blobs,
+                                                             patch_centers,
+                                                             patch_sizes)):
+                results.update(r)
+
+        for j, blob in enumerate(batch_blobs):
+            print("%d - %d/%d" % (i, j, len(batch_blobs)))
             real_step += 1
-            results = {}
-            if inference_base is not None:
-                results.update(inference_base[i][j])
-            if inference_ppn is not None:
-                results.update(inference_ppn[i][j])
-            final_blob_results.append(results)
+            results = batch_results[j]
 
             if cfg.NET == 'full':
                 display_ppn_uresnet(
                     blob,
-                    cfg,
+                    display_cfg,
                     index=i,
                     directory=os.path.join(cfg.DISPLAY_DIR, 'demo_full'),
                     **results
@@ -310,7 +441,7 @@ def inference(cfg):
             elif cfg.NET in ['ppn', 'ppn_ext']:
                 display(
                     blob,
-                    cfg,
+                    display_cfg,
                     index=real_step,
                     dim1=net_ppn.dim1,
                     dim2=net_ppn.dim2,
@@ -319,7 +450,7 @@ def inference(cfg):
                 )
                 metrics_ppn.add(blob, results)
             elif cfg.NET == 'base' and cfg.BASE_NET == 'uresnet':
-                display_uresnet(blob, cfg,
+                display_uresnet(blob, display_cfg,
                                 index=real_step,
                                 directory=os.path.join(cfg.DISPLAY_DIR, 'demo'),
                                 **results)
@@ -327,15 +458,13 @@ def inference(cfg):
             else:  # No display function available, just print results.
                 print(blob, results)
             if cfg.NET == 'ppn_ext':
-                N = cfg.IMAGE_SIZE
-                cfg.IMAGE_SIZE = cfg.CROP_SIZE
                 for k, crop in enumerate(results['crops']):
                     blob_j = {'data': np.reshape(crop, (1, cfg.CROP_SIZE, cfg.CROP_SIZE, 1))}
                     # FIXME generate labels from gt ?
                     blob_j['labels'] = blob_j['data'][:, :, :, 0]
                     pred = np.reshape(results['predictions_small'][k], (1, cfg.CROP_SIZE, cfg.CROP_SIZE))
                     scores = np.reshape(results['scores_small'][k], (1, cfg.CROP_SIZE, cfg.CROP_SIZE))
-                    display_uresnet(blob_j, cfg,
+                    display_uresnet(blob_j, small_cfg,
                                     index=real_step*100+k,
                                     name='display_small',
                                     directory=os.path.join(cfg.DISPLAY_DIR, 'demo_small'),
@@ -344,20 +473,17 @@ def inference(cfg):
                                     predictions=pred,
                                     scores=scores)
 
-                cfg.IMAGE_SIZE = N
-
             # 3. Ad-hoc clustering
             # --------------------
             # FIXME why is this reshape necessary?
             results['predictions'] = results['predictions'][np.newaxis, ...]
             if cfg.NET != 'base':
-                cluster(cfg, blob, results, i, name='cluster_full', directory=os.path.join(cfg.DISPLAY_DIR, 'cluster_full'))
+                cluster(display_cfg, blob, results, i, name='cluster_full', directory=os.path.join(cfg.DISPLAY_DIR, 'cluster_full'))
 
         if cfg.ENABLE_CROP:
-            cfg.IMAGE_SIZE = N
-            final_blob_results = crop_algorithm.reconcile(final_blob_results,
-                                                     patch_centers_list[i],
-                                                     patch_sizes_list[i])
+            final_results = crop_algorithm.reconcile(batch_results,
+                                                     patch_centers,
+                                                     patch_sizes)
 
             # display(blob,
             #          cfg,
@@ -367,9 +493,17 @@ def inference(cfg):
             #                                 'train'),
             #          **final_results)
         else:
-            final_blob_results = final_blob_results[0]
-        final_results.append(final_blob_results)
-
+            final_results = batch_results[0]
+        yield i, batch_blobs, final_results
+
+    data.stop()
+    print(data.summary())
+    if cfg.ENABLE_CROP and hasattr(crop_algorithm, 'summary'):
+        print(crop_algorithm.summary())
+    for network in networks:
+        network.close()
+    if cache is not None:
+        print(cache.summary())
 
     print('Plot metrics...')
     if (cfg.NET == 'base' and cfg.BASE_NET == 'uresnet') or cfg.NET == 'full':
@@ -407,7 +541,6 @@ def inference(cfg):
         #     options=tf.profiler.ProfileOptionBuilder.time_and_memory())
     del train_data
     del data
-    return blobs, final_results
 
 
 def crop_step(crops, coords0, coords1, data, N):
@@ -442,46 +575,63 @@ def crop_proposals(cfg, data, proposals):
     return crops
 
 
+def hide_windows(image, proposals, window_size):
+    """
+    Sets to 0 a window of side `window_size` around each proposal, in a
+    single indexing operation. Windows span image[p1:p2] on each axis with
+    p1, p2 = (p -/+ window_size/2).astype(int), with Python slicing rules.
+    """
+    proposals = np.reshape(proposals, (-1, image.ndim))
+    if proposals.shape[0] == 0:
+        return
+    shape = np.array(image.shape)
+    bounds = []
+    for p in [proposals - window_size/2, proposals + window_size/2]:
+        p = p.astype(int)
+        p = np.where(p < 0, p + shape, p)  # negative slice bounds
+        bounds.append(np.clip(p, 0, shape))
+    extent = np.maximum(bounds[1] - bounds[0], 0)
+    offsets = np.stack(np.meshgrid(*([np.arange(np.amax(extent))] * image.ndim),
+                                   indexing='ij'), axis=-1).reshape((-1, image.ndim))
+    inside = np.all(offsets[np.newaxis, ...] < extent[:, np.newaxis, :], axis=-1)
+    pixels = (bounds[0][:, np.newaxis, :] + offsets[np.newaxis, ...])[inside]
+    image[tuple(pixels.T)] = 0.0
+
+
 def cluster(cfg, blob, results, index, name='cluster', directory=None):
     """
     Ad-hoc clustering algorithm. Can use UResNet predictions as a mask for
     to cluster track and shower separately, if results includes `predictions`
     key. Erases a 7x7 window around each point predicted by PPN in the data,
     then applies DBSCAN algorithm to perform rough clustering of track/shower
-    instances.
+    instances. The voxels neighbourhood graph is built once per event and
+    restricted to each class (same labels as sklearn DBSCAN).
     """
+    start = time.time()
     data = blob['data']
     WINDOW_SIZE = 7
+    eps, min_samples = (2.5 if cfg.DATA_3D else 2.0), 10
     # Hide window around each proposal
-    for p in results['im_proposals']:
-        p1 = (p - WINDOW_SIZE/2).astype(int)
-        p2 = (p + WINDOW_SIZE/2).astype(int)
-        if cfg.DATA_3D:
-            data[0, p1[0]:p2[0], p1[1]:p2[1], p1[2]:p2[2], 0] = 0.0
-        else:
-            data[0, p1[0]:p2[0], p1[1]:p2[1], 0] = 0.0
+    hide_windows(data[0, ..., 0], results['im_proposals'], WINDOW_SIZE)
 
     if 'predictions' in results:  # UResNet mask
         predictions = results['predictions'][0, ...]
         predictions[data[0, ..., 0] == 0.0] = 0.0  # mask with data
         track_voxels = np.argwhere(predictions == 1)  # track
-        shower_voxels = np.argwhere(predictions == 2)  # track
-        db_track, db_shower = [], []
-        if track_voxels.shape[0]:
-            db_track = DBSCAN(eps=2.5 if cfg.DATA_3D else 2.0,
-                              min_samples=10).fit_predict(track_voxels)
-        if shower_voxels.shape[0]:
-            db_shower = DBSCAN(eps=2.5 if cfg.DATA_3D else 2.0,
-                               min_samples=10).fit_predict(shower_voxels)
-            db_shower = db_shower + len(np.unique(db_track))  # offset labels
+        shower_voxels = np.argwhere(predictions == 2)  # shower
         voxels = np.concatenate([track_voxels, shower_voxels], axis=0)
+        graph = voxel_graph(voxels, eps)
+        num_track = track_voxels.shape[0]
+        db_track = dbscan_graph(graph[:num_track, :num_track], min_samples)
+        db_shower = dbscan_graph(graph[num_track:, num_track:], min_samples)
+        db_shower = db_shower + len(np.unique(db_track))  # offset labels
         voxels = np.flip(voxels, axis=1)
         db = np.concatenate([db_track, db_shower], axis=0)
     else:
         voxels, _ = extract_voxels(data[0, ..., 0])
         voxels = np.flip(voxels, axis=1)
-        db = DBSCAN(eps=2.5 if cfg.DATA_3D else 2.0,
-                    min_samples=10).fit_predict(voxels)
+        db = dbscan_graph(voxel_graph(voxels, eps), min_samples)
+    print("Clustering duration = %f s" % (time.time() - start))
 
     print("Clusters: ", np.unique(db))
     new_blob = {}
@@ -199,7 +199,7 @@ def display_uresnet(blob, cfg, index=0, predictions=None, scores=None,
 
 
 def display(blob, cfg, im_proposals=None, rois=None, im_labels=None, im_scores=None,
-            index=0, dim1=8, dim2=4, name='display', directory=''):
+            index=0, dim1=8, dim2=4, name='display', directory='', **kwargs):
     print("gt_pixels: ", blob['gt_pixels'])
     print("im_proposals: ", im_proposals)
     print("im_scores: ", im_scores)
@@ -308,7 +308,7 @@ def display_blob_rois(blob, cfg, rois, dim1, dim2, directory=None, name='display
 
 def display_ppn_uresnet(blob, cfg, im_proposals=None, rois=None, im_scores=None,
     index=0, dim1=8, dim2=4, predictions=None, im_labels=None, name='display',
-    directory=None, softmax=None, scores=None):
+    directory=None, softmax=None, scores=None, **kwargs):
     if directory == '':
         directory = cfg.DISPLAY_DIR
     else:
@@ -351,26 +351,17 @@ def compute_voxel_overlap(coords, patch_centers, patch_sizes):
     """
     Returns overlap value for each voxel.
     """
-    overlap = []
-    for voxel in coords:
-        overlap.append(np.sum(np.all(np.logical_and(
-            patch_centers-patch_sizes/2.0 <= voxel,
-            patch_centers + patch_sizes/2.0 >= voxel
-            ), axis=1)))
-    return overlap
+    # Imported here to avoid a circular import (cropping uses display_utils)
+    from faster_particles.cropping.coverage import voxel_coverage
+    return voxel_coverage(coords, patch_centers, patch_sizes)[0]
 
 
 def compute_voxel_core(coords, patch_centers, core_size):
     """
     Returns for each voxel whether it belongs to a core region.
     """
-    overlap = []
-    for voxel in coords:
-        overlap.append(np.any(np.all(np.logical_and(
-            patch_centers - core_size/2.0 <= voxel,
-            patch_centers + core_size/2.0 >= voxel
-            ), axis=1)))
-    return overlap
+    from faster_particles.cropping.coverage import voxel_coverage
+    return voxel_coverage(coords, patch_centers, core_size)[0] > 0
 
 
 def draw_slicing(blob, cfg, patch_centers, patch_sizes,
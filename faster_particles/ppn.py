@@ -14,7 +14,7 @@ from faster_particles.ppn_utils import include_gt_pixels, \
     compute_positives_ppn2, compute_positives_ppn1, \
     assign_gt_pixels, generate_anchors, \
     predicted_pixels, top_R_pixels, slice_rois, crop_pool_layer
-from faster_particles.ppn_postprocessing import filter_points, nms
+from faster_particles.ppn_postprocessing import filter_points, nms, nms_tf
 from faster_particles.base_net.vgg import VGG
 
 
@@ -42,43 +42,84 @@ class PPN(object):
         self.base_net = base_net(cfg=cfg, **base_net_args)
         self.cfg = cfg
 
-    def test_image(self, sess, blob):
-        feed_dict = {
+    def feed_dict(self, blob):
+        """
+        gt_pixels without batch index column (single event) are assigned
+        to event 0.
+        """
+        gt_pixels = blob['gt_pixels']
+        if gt_pixels.shape[-1] == self.gt_pixels_placeholder.get_shape().as_list()[-1] - 1:
+            gt_pixels = np.concatenate([gt_pixels, np.zeros((gt_pixels.shape[0], 1))], axis=1)
+        return {
             self.image_placeholder: blob['data'],
-            self.gt_pixels_placeholder: blob['gt_pixels']
+            self.gt_pixels_placeholder: gt_pixels
             }
-        im_proposals, im_labels, im_scores, rois, x, summary = sess.run([
+
+    def test_image(self, sess, blob):
+        im_proposals, im_labels, im_scores, im_batch, rois, rois_batch, x, summary = sess.run([
             self._predictions['im_proposals'],
             self._predictions['im_labels'],
             self._predictions['im_scores'],
+            self._predictions['im_batch'],
             self._predictions['rois'],
+            self._predictions['rois_batch'],
             self.x,
             self.summary_op
-            ], feed_dict=feed_dict)
+            ], feed_dict=self.feed_dict(blob))
         return summary, {
             'im_proposals': im_proposals,
             'im_labels': im_labels,
             'im_scores': im_scores,
-            'rois': rois
+            'im_batch': im_batch,
+            'rois': rois,
+            'rois_batch': rois_batch
             }
 
+    def test_image_full(self, sess, blob):
+        """
+        PPN and segmentation outputs in a single run, once
+        `create_segmentation` has been called.
+        """
+        results, summary = sess.run([{
+            'im_proposals': self._predictions['im_proposals'],
+            'im_labels': self._predictions['im_labels'],
+            'im_scores': self._predictions['im_scores'],
+            'im_batch': self._predictions['im_batch'],
+            'rois': self._predictions['rois'],
+            'rois_batch': self._predictions['rois_batch'],
+            'predictions': self.base_net._predictions,
+            'scores': self.base_net._scores,
+            'softmax': self.base_net._softmax
+            }, self.summary_op], feed_dict=self.feed_dict(blob))
+        return summary, results
+
+    def create_segmentation(self, scope="uresnet"):
+        """
+        Builds the decoder of the base network (UResNet) on top of the
+        backbone already built by `create_architecture`, so that both PPN
+        and segmentation are computed with a single forward pass of the
+        backbone. Inference only.
+        """
+        if not hasattr(self.base_net, 'build_decoder'):
+            raise Exception("Base network %s has no segmentation decoder." % self.cfg.BASE_NET)
+        self.base_net.init_placeholders(image=self.image_placeholder)
+        self.base_net.build_decoder(is_training=False, scope=scope)
+
     def train_step(self, sess, blobs):
-        feed_dict = {
-            self.image_placeholder: blobs['data'],
-            self.gt_pixels_placeholder: blobs['gt_pixels']
-            }
-        _, ppn1_closest_gt_distance, rois, \
-            im_labels, im_scores, im_proposals, loss, x, summary = sess.run([
+        _, ppn1_closest_gt_distance, rois, rois_batch, \
+            im_labels, im_scores, im_proposals, im_batch, loss, x, summary = sess.run([
                 self.train_op,
                 self._predictions['ppn1_closest_gt_distance'],
                 self._predictions['rois'],
+                self._predictions['rois_batch'],
                 self._predictions['im_labels'],
                 self._predictions['im_scores'],
                 self._predictions['im_proposals'],
+                self._predictions['im_batch'],
                 self._losses['total_loss'],
                 self.x,
                 self.summary_op
-                ], feed_dict=feed_dict)
+                ], feed_dict=self.feed_dict(blobs))
         if np.isnan(loss):
             print("loss: ", loss)
             print("gt_pixels: ", blobs['gt_pixels'])
@@ -88,22 +129,23 @@ class PPN(object):
 
         return summary, {
             'rois': rois,
+            'rois_batch': rois_batch,
             'im_labels': im_labels,
             'im_proposals': im_proposals,
-            'im_scores': im_scores
+            'im_scores': im_scores,
+            'im_batch': im_batch
             }
 
     def init_placeholders(self):
         # Define placeholders
-        # FIXME Assuming batch size of 1 currently
         if self.cfg.DATA_3D:
-            self.image_placeholder       = tf.placeholder(name="image", shape=(1, self.N, self.N, self.N, 1), dtype=tf.float32)
-            # Shape of gt_pixels_placeholder = nb_gt_pixels, 3 coordinates + 1 class label in [0, num_classes)
-            self.gt_pixels_placeholder   = tf.placeholder(name="gt_pixels", shape=(None, 4), dtype=tf.float32)
+            self.image_placeholder       = tf.placeholder(name="image", shape=(None, self.N, self.N, self.N, 1), dtype=tf.float32)
+            # Shape of gt_pixels_placeholder = nb_gt_pixels, 3 coordinates + 1 class label in [0, num_classes) + 1 batch index
+            self.gt_pixels_placeholder   = tf.placeholder(name="gt_pixels", shape=(None, 5), dtype=tf.float32)
         else:
-            self.image_placeholder       = tf.placeholder(name="image", shape=(1, self.N, self.N, 1), dtype=tf.float32)
-            # Shape of gt_pixels_placeholder = nb_gt_pixels, 2 coordinates + 1 class label in [0, num_classes)
-            self.gt_pixels_placeholder   = tf.placeholder(name="gt_pixels", shape=(None, 3), dtype=tf.float32)
+            self.image_placeholder       = tf.placeholder(name="image", shape=(None, self.N, self.N, 1), dtype=tf.float32)
+            # Shape of gt_pixels_placeholder = nb_gt_pixels, 2 coordinates + 1 class label in [0, num_classes) + 1 batch index
+            self.gt_pixels_placeholder   = tf.placeholder(name="gt_pixels", shape=(None, 4), dtype=tf.float32)
         return [("image_placeholder", "image"), ("gt_pixels_placeholder", "gt_pixels")]
 
     def restore_placeholder(self, names):
@@ -157,26 +199,31 @@ class PPN(object):
                 self.set3d()
 
                 # Build PPN1
-                rois = self.build_ppn1(net2)
-                rois = slice_rois(rois, self.dim2)
+                # rois_batch = index in the batch of the event of each ROI
+                rois, rois_batch = self.build_ppn1(net2)
+                rois, rois_batch = slice_rois(rois, self.dim2,
+                                              batch_index=rois_batch)
 
                 if self.is_training:
                     # During training time, check if all
                     # ground truth pixels are covered by ROIs
                     # If not, add relevant ROIs on F3
-                    rois = include_gt_pixels(rois,
-                                             self.get_gt_pixels(),
-                                             self.dim1, self.dim2)
+                    rois, rois_batch = include_gt_pixels(
+                        rois, self.get_gt_pixels(), self.dim1, self.dim2,
+                        rois_batch=rois_batch, gt_batch=self.get_gt_batch())
                     assert rois.get_shape().as_list() == [None, self.dim]
 
                 self._predictions['rois'] = rois
+                self._predictions['rois_batch'] = rois_batch
 
                 # Pool to Pixels of Interest of intermediate layer
                 # Shape of rpn_pooling = nb_rois, 1, 1, 256
-                rpn_pooling = crop_pool_layer(net, rois, self.dim2, self.dim)
+                rpn_pooling = crop_pool_layer(net, rois, self.dim2, self.dim,
+                                              batch_index=rois_batch)
                 self.rpn_pooling = rpn_pooling
 
-                proposals2, scores2 = self.build_ppn2(rpn_pooling, rois)
+                proposals2, scores2 = self.build_ppn2(rpn_pooling, rois,
+                                                      rois_batch)
 
                 # Testing time
                 # Turn predicted positions (float) into original image positions
@@ -198,28 +245,38 @@ class PPN(object):
                     keep = tf.reshape(keep, (-1, 1))
                     im_proposals = tf.gather_nd(im_proposals, keep,
                                                 name="im_proposals")
-                    # im_labels = tf.gather_nd(im_labels, keep, name="im_labels")
+                    im_labels = tf.gather_nd(im_labels, keep, name="im_labels")
                     im_scores = tf.gather_nd(im_scores, keep, name="im_scores")
+                    im_batch = tf.gather_nd(rois_batch, keep, name="im_batch")
                     self.before_nms = im_proposals
-                    # Postprocessing of proposals
-                    if self.cfg.POSTPROCESSING == 'nms':  # Pixel NMS equivalent
-                        im_proposals, keep = nms(im_proposals, im_scores)
+                    # Postprocessing of proposals, separately for each event:
+                    # shift events far away from each other beforehand.
+                    shift = tf.cast(tf.expand_dims(im_batch, axis=1), tf.float32) * 2.0 * self.N
+                    if self.cfg.POSTPROCESSING in ['nms', 'nms_tf']:  # Pixel NMS equivalent
+                        if self.cfg.POSTPROCESSING == 'nms':
+                            _, keep = nms(im_proposals + shift, im_scores)
+                        else:  # In-graph, no tf.py_func
+                            keep = nms_tf(im_proposals + shift, im_scores)
                         im_proposals = tf.gather(im_proposals, keep)
-                        # im_labels = tf.gather(im_labels, keep)
+                        im_labels = tf.gather(im_labels, keep)
                         im_scores = tf.gather(im_scores, keep)
+                        im_batch = tf.gather(im_batch, keep)
                         self.after_nms = im_proposals
                     else:  # Use DBSCAN
                         im_proposals, im_scores, keep = tf.py_func(
                             filter_points,
-                            [im_proposals,
+                            [im_proposals + shift,
                              im_scores,
                              15.0 if self.cfg.DATA_3D else 20.0],
                             [tf.float32, tf.float32, tf.int64])
                         im_labels = tf.gather(im_labels, keep)
+                        im_batch = tf.gather(im_batch, keep)
+                        im_proposals = im_proposals - tf.gather(shift, keep)
 
                     self._predictions['im_proposals'] = im_proposals
                     self._predictions['im_labels'] = im_labels
                     self._predictions['im_scores'] = im_scores
+                    self._predictions['im_batch'] = im_batch
 
                 if self.is_training:
                     distances = tf.zeros((tf.shape(im_proposals)[0], tf.shape(self.gt_pixels_placeholder)[0]))
@@ -227,6 +284,11 @@ class PPN(object):
                         x1, x2 = tf.meshgrid(self.gt_pixels_placeholder[:, i], im_proposals[:, i])
                         distances = distances + tf.pow(x1 - x2, 2)
                     distances = tf.sqrt(distances, name="final_distances")
+                    # Only compare to gt pixels of the same event
+                    gt_batch, proposals_batch = tf.meshgrid(self.get_gt_batch(), im_batch)
+                    distances = tf.where(tf.equal(gt_batch, proposals_batch),
+                                         distances,
+                                         tf.fill(tf.shape(distances), np.inf))
                     closest_distance = tf.reduce_min(distances,
                                                      axis=1,
                                                      name="final_closest_distance")
@@ -328,11 +390,18 @@ class PPN(object):
                                                  ppn1_pixel_pred,
                                                  anchors,
                                                  (self.N2,) * self.dim)
-            rois, roi_scores = top_R_pixels(proposals, scores,
-                                            R=self.R,
-                                            threshold=self.ppn1_score_threshold)
-            assert proposals.get_shape().as_list() == [self.N3**self.dim, self.dim]
-            assert scores.get_shape().as_list() == [self.N3**self.dim, 1]
+            batch_size = tf.shape(net2)[0]
+            rois, roi_scores, rois_batch = top_R_pixels(
+                proposals, scores,
+                R=self.R,
+                threshold=self.ppn1_score_threshold,
+                batch_size=batch_size)
+            assert proposals.get_shape().as_list() == [None, self.dim]
+            assert scores.get_shape().as_list() == [None, 1]
+            # Batch index of each proposal, shape B*16*16
+            proposals_batch = tf.reshape(tf.tile(
+                tf.expand_dims(tf.range(batch_size), axis=1),
+                [1, self.N3**self.dim]), (-1,))
             # assert rois.get_shape().as_list() == [None, 2]
             # assert roi_scores.get_shape().as_list() == [None, 1]
 
@@ -351,8 +420,10 @@ class PPN(object):
             classes_mask = compute_positives_ppn1(self.get_gt_pixels(),
                                                   self.N3,
                                                   self.dim1,
-                                                  self.dim2)
-            assert classes_mask.get_shape().as_list() == [self.N3**self.dim, 1]
+                                                  self.dim2,
+                                                  gt_batch=self.get_gt_batch(),
+                                                  batch_size=batch_size)
+            assert classes_mask.get_shape().as_list() == [None, 1]
             # FIXME Use Kazu's pixel index to limit the number of gt points for
             # which we compute a distance from a unique proposed point per pixel.
 
@@ -360,9 +431,10 @@ class PPN(object):
             # and the closest ground truth pixel
             # Don't forget to convert gt pixels coordinates to F5 coordinates
             closest_gt, closest_gt_distance, _ = assign_gt_pixels(
-                self.gt_pixels_placeholder, proposals, self.dim1, self.dim2)
-            assert closest_gt.get_shape().as_list() == [self.N3**self.dim]
-            assert closest_gt_distance.get_shape().as_list() == [self.N3**self.dim, 1]
+                self.gt_pixels_placeholder, proposals, self.dim1, self.dim2,
+                proposals_batch=proposals_batch)
+            assert closest_gt.get_shape().as_list() == [None]
+            assert closest_gt_distance.get_shape().as_list() == [None, 1]
             # assert closest_gt_label.get_shape().as_list() == [256, 1]
             self._predictions['ppn1_closest_gt'] = closest_gt
             self._predictions['ppn1_closest_gt_distance'] = closest_gt_distance
@@ -391,10 +463,10 @@ class PPN(object):
             self._losses['loss_ppn1_class'] = loss_ppn1_class
             self._predictions['accuracy_ppn1'] = accuracy_ppn1
 
-            return rois
+            return rois, rois_batch
         # --- END of Pixel Proposal Network 1 ---
 
-    def build_ppn2(self, rpn_pooling, rois):
+    def build_ppn2(self, rpn_pooling, rois, rois_batch):
         # =====================================================
         # ---         Pixel Proposal Network 2              ---
         # =====================================================
@@ -462,7 +534,8 @@ class PPN(object):
             closest_gt, closest_gt_distance, true_labels = assign_gt_pixels(
                 self.gt_pixels_placeholder,
                 proposals2,
-                self.dim1, self.dim2, rois=rois)
+                self.dim1, self.dim2, rois=rois,
+                proposals_batch=rois_batch)
             # assert closest_gt.get_shape().as_list() == [None]
             # assert closest_gt_distance.get_shape().as_list() == [None, 1]
             # assert true_labels.get_shape().as_list() == [None, 1]
@@ -586,6 +659,14 @@ class PPN(object):
         return tf.slice(self.gt_pixels_placeholder, [0, 0], [-1, self.dim],
                         name="gt_pixels_coord")
 
+    def get_gt_batch(self):
+        """
+        Batch index of gt pixels (last column of gt_pixels_placeholder)
+        with shape (None,)
+        """
+        return tf.cast(self.gt_pixels_placeholder[:, self.dim+1], tf.int32,
+                       name="gt_pixels_batch")
+
 
 if __name__ == "__main__":
     net = PPN()
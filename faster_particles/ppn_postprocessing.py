@@ -2,11 +2,124 @@
 # DBSCAN and NMS postprocessing for PPN
 
 import numpy as np
+import itertools
 import tensorflow as tf
 from sklearn.cluster import DBSCAN
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
 
 
 def filter_points(im_proposals, im_scores, eps):
+    """
+    DBSCAN postprocessing on point proposals, same results as
+    filter_points_dbscan: with min_samples=1, clusters are the connected
+    components of the graph linking proposals closer than eps (built with
+    a KD-tree). Returns the average proposal and score of each cluster and
+    the index of the first proposal of each cluster, with clusters ordered
+    by their first proposal like DBSCAN labels.
+    """
+    num_proposals = im_proposals.shape[0]
+    if num_proposals == 0:
+        return im_proposals, im_scores, np.zeros((0,), dtype=np.int64)
+    pairs = cKDTree(im_proposals).query_pairs(eps, output_type='ndarray')
+    graph = coo_matrix((np.ones((pairs.shape[0],), dtype=np.int8),
+                        (pairs[:, 0], pairs[:, 1])),
+                       shape=(num_proposals, num_proposals))
+    _, labels = connected_components(graph, directed=False)
+    # Number clusters by order of first proposal
+    _, index, labels = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(index)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+    labels, index = rank[labels.reshape((-1,))], index[order]
+
+    counts = np.bincount(labels).astype(np.float64)
+    new_proposals = np.stack([
+        np.bincount(labels, weights=im_proposals[:, d]) / counts
+        for d in range(im_proposals.shape[1])], axis=1)
+    new_scores = np.bincount(labels, weights=im_scores) / counts
+    return new_proposals.astype(im_proposals.dtype), \
+        new_scores.astype(im_scores.dtype), index.astype(np.int64)
+
+
+def voxel_graph(voxels, eps):
+    """
+    Neighbourhood graph of integer voxel coordinates: sparse symmetric
+    adjacency matrix (CSR, no self loops) of pairs of voxels at distance
+    <= eps. Voxels are hashed once, so that the graph can be shared by
+    several clusterings of the same event (see dbscan_graph).
+    Neighbours along the last axis have consecutive keys: for each offset
+    on the other axes, a single search finds the first candidate and the
+    following voxels are scanned.
+    """
+    voxels = np.asarray(voxels, dtype=np.int64)
+    num_voxels, dim = voxels.shape
+    if num_voxels == 0:
+        return csr_matrix((0, 0), dtype=np.int8)
+    r = int(np.floor(eps))
+    # Margin of r around voxels so that neighbour keys never wrap around
+    low = voxels.min(axis=0) - r
+    grid_shape = voxels.max(axis=0) - low + r + 1
+    keys = np.ravel_multi_index((voxels - low).T, grid_shape)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    strides = np.append(np.cumprod(grid_shape[::-1])[::-1][1:], 1)
+    rows, cols = [], []
+    for head in itertools.product(range(-r, r + 1), repeat=dim - 1):
+        head_norm = np.sum(np.square(head))
+        if head_norm > eps**2:
+            continue
+        r_last = int(np.floor(np.sqrt(eps**2 - head_norm)))
+        base = sorted_keys + np.dot(head, strides[:-1]).astype(np.int64)
+        start = np.searchsorted(sorted_keys, base - r_last)
+        for k in range(2 * r_last + 1):
+            positions = np.minimum(start + k, num_voxels - 1)
+            delta = sorted_keys[positions] - base
+            found = np.logical_and(np.abs(delta) <= r_last,
+                                   positions == start + k)
+            if head_norm == 0:
+                found = np.logical_and(found, delta != 0)
+            rows.append(order[found])
+            cols.append(order[positions[found]])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return csr_matrix((np.ones(rows.shape, dtype=np.int8), (rows, cols)),
+                      shape=(num_voxels, num_voxels))
+
+
+def dbscan_graph(graph, min_samples):
+    """
+    Same labels as sklearn DBSCAN (-1 for noise) from a precomputed
+    neighbourhood graph (see voxel_graph):
+    - core points have at least min_samples neighbours (including
+    themselves), clusters are connected components of core points,
+    numbered by their first core point;
+    - other points join the first cluster (lowest label) among their core
+    neighbours, like in the depth first search of sklearn.
+    """
+    num_points = graph.shape[0]
+    labels = -np.ones((num_points,), dtype=np.int64)
+    core = np.diff(graph.indptr) + 1 >= min_samples
+    if not np.any(core):
+        return labels
+    _, components = connected_components(graph[core][:, core], directed=False)
+    _, first, components = np.unique(components, return_index=True,
+                                     return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+    labels[core] = rank[components.reshape((-1,))]
+
+    graph = graph.tocoo()
+    border = np.logical_and(~core[graph.row], core[graph.col])
+    border_labels = np.full((num_points,), order.shape[0], dtype=np.int64)
+    np.minimum.at(border_labels, graph.row[border], labels[graph.col[border]])
+    border = np.logical_and(~core, border_labels < order.shape[0])
+    labels[border] = border_labels[border]
+    return labels
+
+
+def filter_points_dbscan(im_proposals, im_scores, eps):
     """
     DBSCAN postprocessing on point proposals.
     """
@@ -117,5 +230,115 @@ def nms_numpy(im_proposals, im_scores, threshold, size):
     return im_proposals, keep
 
 
+def nms_grid(im_proposals, im_scores, threshold, size):
+    """
+    Same greedy NMS as nms_numpy (same keep indices, in the same order) for
+    boxes of side 2*size+1 centered at each proposal.
+    Two boxes can only overlap if proposals are closer than 2*size+1 along
+    every axis: proposals are bucketed into cells of that side, so that a
+    kept proposal only needs to be compared to proposals in the 3^dim
+    neighbouring cells. Proposals without any neighbour are kept directly.
+    """
+    im_proposals = np.asarray(im_proposals)
+    im_scores = np.asarray(im_scores)
+    num_proposals, dim = im_proposals.shape
+    if num_proposals == 0:
+        return im_proposals, np.zeros((0,), dtype=np.int64)
+    lows = im_proposals - size
+    highs = im_proposals + size
+    areas = np.prod(highs - lows + 1, axis=1)
+
+    # Sort proposals by cell
+    cells = np.floor_divide(im_proposals, 2 * size + 1).astype(np.int64)
+    cells = cells - cells.min(axis=0) + 1  # margin for neighbour cells
+    grid_shape = cells.max(axis=0) + 2
+    keys = np.ravel_multi_index(cells.T, grid_shape)
+    cell_order = np.argsort(keys, kind='mergesort')
+    cell_keys, starts, counts = np.unique(keys[cell_order], return_index=True,
+                                          return_counts=True)
+    # Ranges of proposals in neighbour cells of each non empty cell
+    offsets = np.stack(np.meshgrid(*([[-1, 0, 1]] * dim), indexing='ij'),
+                       axis=-1).reshape((-1, dim))
+    strides = np.append(np.cumprod(grid_shape[::-1])[::-1][1:], 1)
+    offsets = np.dot(offsets, strides)
+    neighbour_keys = cell_keys[:, None] + offsets[None, :]
+    positions = np.minimum(np.searchsorted(cell_keys, neighbour_keys),
+                           len(cell_keys) - 1)
+    found = cell_keys[positions] == neighbour_keys
+    neighbour_counts = np.where(found, counts[positions], 0)
+    cell_index = np.searchsorted(cell_keys, keys)
+    isolated = np.sum(neighbour_counts, axis=1)[cell_index] == 1
+
+    order = im_scores.argsort()[::-1]
+    suppressed = np.zeros((num_proposals,), dtype=bool)
+    candidates = {}
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        if isolated[i]:
+            continue
+        c = cell_index[i]
+        if c not in candidates:
+            candidates[c] = np.concatenate([
+                cell_order[starts[p]:starts[p] + counts[p]]
+                for p in positions[c][found[c]]])
+        others = candidates[c]
+        xx = np.maximum(lows[i], lows[others])
+        yy = np.minimum(highs[i], highs[others])
+        w = np.maximum(0.0, yy - xx + 1)
+        inter = np.prod(w, axis=1)
+        ovr = inter / (areas[i] + areas[others] - inter)
+        suppressed[others[ovr > threshold]] = True
+
+    return im_proposals, np.array(keep, dtype=np.int64)
+
+
+def nms_tf(im_proposals, im_scores, threshold=0.01, size=6.0):
+    """
+    In-graph NMS equivalent to nms_numpy (no tf.py_func, so the graph can
+    be frozen and served). Returns keep indices in order of decreasing score.
+    - 2D: boxes of side 2*size+1 for tf.image.non_max_suppression.
+    - 3D: tf.while_loop over proposals sorted by score, each one suppressing
+    the next ones it overlaps with unless it is suppressed itself.
+    Proposals with equal scores may be visited in a different order than
+    in nms_numpy.
+    """
+    dim = im_proposals.get_shape().as_list()[-1]
+    num_proposals = tf.shape(im_proposals)[0]
+    if dim == 2:
+        # Half pixel margin reproduces the +1 in box sides of nms_numpy
+        boxes = tf.concat([im_proposals - size - 0.5,
+                           im_proposals + size + 0.5], axis=1)
+        keep = tf.image.non_max_suppression(boxes, im_scores, num_proposals,
+                                            iou_threshold=threshold)
+        return tf.cast(keep, tf.int64)
+
+    _, order = tf.nn.top_k(im_scores, k=num_proposals)
+    proposals = tf.gather(im_proposals, order)
+    lows, highs = proposals - size, proposals + size
+    areas = tf.reduce_prod(highs - lows + 1, axis=1)
+
+    def nms_tf_step(i, suppressed):
+        xx = tf.maximum(lows[i], lows)
+        yy = tf.minimum(highs[i], highs)
+        inter = tf.reduce_prod(tf.maximum(0.0, yy - xx + 1), axis=1)
+        ovr = inter / (areas[i] + areas - inter)
+        new_suppressed = tf.logical_and(ovr > threshold,
+                                        tf.range(num_proposals) > i)
+        new_suppressed = tf.logical_and(new_suppressed,
+                                        tf.logical_not(suppressed[i]))
+        return i + 1, tf.logical_or(suppressed, new_suppressed)
+
+    _, suppressed = tf.while_loop(
+        lambda i, suppressed: i < num_proposals,
+        nms_tf_step,
+        [tf.constant(0), tf.zeros((num_proposals,), dtype=tf.bool)],
+        back_prop=False)
+    keep = tf.boolean_mask(order, tf.logical_not(suppressed))
+    return tf.cast(keep, tf.int64)
+
+
 def nms(im_proposals, im_scores, threshold=0.01, size=6.0):
-    return tf.py_func(nms_numpy, [im_proposals, im_scores, threshold, size], (tf.float32, tf.int64))
+    return tf.py_func(nms_grid, [im_proposals, im_scores, threshold, size], (tf.float32, tf.int64))
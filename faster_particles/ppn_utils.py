@@ -18,30 +18,19 @@ def crop(patch_centers, N, data, use_smear=False, return_labels=True):
     image_size = data.shape[1]
     coords0 = np.clip(coords0 + smear, 0, image_size).astype(int)
     coords1 = np.clip(coords1 + smear, 0, image_size).astype(int)
-    crops = np.zeros((coords0.shape[0],) + (N,) * dim + (data.shape[-1],))
+    crops = np.zeros((coords0.shape[0],) + (N,) * dim + (data.shape[-1],),
+                     dtype=data.dtype)
     crops_labels = np.zeros_like(crops)
     for j in range(len(coords0)):
-        padding = []
+        # Copy directly into the (zero) preallocated crop instead of padding:
+        # pad before the data if the patch touches the lower border
+        source, destination = [0], [j]
         for d in range(dim):
             pad = np.maximum(N - (coords1[j, d] - coords0[j, d]), 0)
-            if coords0[j, d] == 0.0:
-                padding.append((pad, 0))
-            else:
-                padding.append((0, pad))
-        padding.append((0, 0))
-        if dim == 2:
-            crops[j] = np.pad(data[0,
-                                   coords0[j, 0]:coords1[j, 0],
-                                   coords0[j, 1]:coords1[j, 1],
-                                   :],
-                              padding, 'constant')
-        else:  # dim == 3
-            crops[j] = np.pad(data[0,
-                                   coords0[j, 0]:coords1[j, 0],
-                                   coords0[j, 1]:coords1[j, 1],
-                                   coords0[j, 2]:coords1[j, 2],
-                                   :],
-                              padding, 'constant')
+            start = pad if coords0[j, d] == 0.0 else 0
+            source.append(slice(coords0[j, d], coords1[j, d]))
+            destination.append(slice(start, start + coords1[j, d] - coords0[j, d]))
+        crops[tuple(destination)] = data[tuple(source)]
         if return_labels:
             indices = np.where(crops[j] > 0)
             # FIXME check that crop_labels still works with batch size
@@ -68,6 +57,71 @@ def crop(patch_centers, N, data, use_smear=False, return_labels=True):
     return crops, crops_labels
 
 
+def crop_sparse(patch_centers, N, coords, values, index=None):
+    """
+    Sparse counterpart of crop (without smearing nor labels): densify only
+    the patches of size N centered at patch_centers.
+    coords has shape (None, dim) and is given in data coordinates (same axis
+    order as the dense array), values has shape (None, channels).
+    index is an optional spatial index of coords (see
+    cropping.SpatialIndex) to visit only the voxels close to each patch.
+    Returns crops of shape (num_patches,) + (N,) * dim + (channels,)
+    """
+    dim = patch_centers.shape[1]
+    coords0 = np.floor(patch_centers - N/2.0).astype(int)  # bottom left corner
+    crops = np.zeros((coords0.shape[0],) + (N,) * dim + (values.shape[-1],),
+                     dtype=values.dtype)
+    coords = coords.astype(int)
+    for j in range(len(coords0)):
+        if index is None:
+            candidates = np.arange(coords.shape[0])
+        else:
+            candidates = index.candidates(coords0[j], coords0[j] + N - 1)
+        local_coords = coords[candidates] - coords0[j]
+        inside = np.all(np.logical_and(local_coords >= 0, local_coords < N),
+                        axis=1)
+        crops[(j,) + tuple(local_coords[inside].T)] = values[candidates[inside]]
+    return crops
+
+
+def sparse_to_dense(voxels, values, N, dim, batch_size=1):
+    """
+    Scatter sparse values into a dense array of shape
+    (batch_size,) + (N,) * dim.
+    voxels have shape (None, dim) or (None, dim + 1) with a batch index as
+    last column. Spatial coordinates are reversed with respect to the
+    dense array axes (LArCV convention, which cropping algorithms assume).
+    """
+    if voxels.shape[1] > dim:
+        batch_index = voxels[:, dim].astype(int)
+    else:
+        batch_index = np.zeros((voxels.shape[0],), dtype=int)
+    dense = np.zeros((batch_size,) + (N,) * dim, dtype=values.dtype)
+    dense[(batch_index,) + tuple(voxels[:, dim-1::-1].astype(int).T)] = values
+    return dense
+
+
+def densify_blob(blob, N, dim):
+    """
+    Returns a copy of a sparse blob (see cfg.SPARSE_BLOB) with dense `data`,
+    `labels` and `weight` arrays, as generated when SPARSE_BLOB is off.
+    """
+    dense_blob = dict(blob)
+    batch_size = len(blob['entries'])
+    dense_blob['data'] = sparse_to_dense(
+        blob['voxels'], blob['voxels_value'].astype(np.float32),
+        N, dim, batch_size=batch_size)[..., np.newaxis]
+    if 'voxels_labels' in blob:
+        dense_blob['labels'] = sparse_to_dense(
+            blob['voxels'], blob['voxels_labels'].astype(np.int32),
+            N, dim, batch_size=batch_size)
+    if 'weight_voxels' in blob:
+        dense_blob['weight'] = sparse_to_dense(
+            blob['weight_voxels'], blob['weight_value'].astype(np.float32),
+            N, dim, batch_size=batch_size)
+    return dense_blob
+
+
 def generate_anchors(im_shape, repeat=1):
     """
     Generate anchors = centers of pixels.
@@ -102,33 +156,35 @@ def pixels_transform_inv(pixels, deltas):
     return pred_pixels
 
 
-def top_R_pixels(proposals, scores, R=20, threshold=0.5):
+def top_R_pixels(proposals, scores, R=20, threshold=0.5, batch_size=None):
     """
-    Order by score and take the top R proposals above threshold.
-    Shapes are [N*N, 2] and [N*N, 1]
+    Order by score and take the top R proposals above threshold, for each
+    event of the batch. At least the best proposal of each event is kept.
+    Shapes are [B*N*N, 2] and [B*N*N, 1] where B = batch_size (1 if None).
+    If batch_size is given also returns the batch index of each proposal.
     """
     with tf.variable_scope("top_R_pixels"):
-        # Select top R pixel proposals
-        flat_scores = tf.squeeze(scores)  # shape N*N
-        R = min(R, flat_scores.get_shape().as_list()[0])
+        B = 1 if batch_size is None else batch_size
+        dim = proposals.get_shape().as_list()[-1]
+        # Shape B x N*N
+        flat_scores = tf.reshape(scores, tf.stack([B, -1]))
+        proposals = tf.reshape(proposals, tf.stack([B, -1, dim]))
+        R = tf.minimum(R, tf.shape(flat_scores)[1])
         # Output of tf.nn.top_k will be sorted in descending order
-        scores, keep = tf.nn.top_k(tf.squeeze(scores), k=R, sorted=True)
-        proposals = tf.gather(proposals, keep)
-        assert scores.get_shape().as_list() == [R]
-        assert keep.get_shape().as_list() == [R]
+        scores, keep = tf.nn.top_k(flat_scores, k=R, sorted=True)
+        batch_index = tf.tile(tf.expand_dims(tf.range(B), axis=1),
+                              tf.stack([1, R]))
+        rank = tf.tile(tf.expand_dims(tf.range(R), axis=0), tf.stack([B, 1]))
+        proposals = tf.gather_nd(proposals, tf.stack([batch_index, keep], axis=-1))
         # Select scores above threshold
-        keep2 = tf.where(tf.greater(scores, threshold))
-        assert keep2.get_shape().as_list() == [None, 1]
-        proposals_final = tf.gather(proposals, tf.reshape(keep2, (-1,)))
-        scores_final = tf.gather(scores, keep2)
-
-        proposals, scores = tf.cond(
-            tf.equal(tf.shape(proposals_final)[0], tf.constant(0)),
-            true_fn=lambda: (tf.slice(proposals, [0, 0], [1, -1]),
-                             tf.slice(scores, [0], [1])),
-            false_fn=lambda: (proposals_final, scores_final))
+        mask = tf.logical_or(tf.greater(scores, threshold), tf.equal(rank, 0))
+        proposals = tf.boolean_mask(proposals, mask)
+        scores = tf.boolean_mask(scores, mask)
+        batch_index = tf.boolean_mask(batch_index, mask)
         # assert proposals.get_shape().as_list() == [None, 2]
-        return proposals, scores
+        if batch_size is None:
+            return proposals, scores
+        return proposals, scores, batch_index
 
 
 def predicted_pixels(rpn_cls_prob, rpn_bbox_pred, anchors, im_shape):
@@ -166,10 +222,11 @@ def all_combinations(indices):
     return np.array(np.meshgrid(*indices)).T.reshape(-1, len(indices))
 
 
-def slice_rois(rois, dim2):
+def slice_rois(rois, dim2, batch_index=None):
     """
     rois shape = None, dim
     Transform ROI (1 pixel on F5) into 4x4 ROIs on F3 (using F5 coordinates)
+    If batch_index of rois is given, also returns batch index of new rois.
     """
     with tf.variable_scope("slice_rois"):
         dim = rois.get_shape().as_list()[-1]  # 2D or 3D
@@ -185,16 +242,22 @@ def slice_rois(rois, dim2):
         # rois = tf.transpose(tf.squeeze(tf.concat(tf.concat(all_rois, axis=1), axis=3)))
         rois = tf.reshape(tf.transpose(all_rois), (-1, dim)) # FIXME do we need to transpose?
         rois = tf.identity(rois / dim2, name="sliced_rois") # (shape nb rois * nb comb) x dim
-        return rois
+        if batch_index is None:
+            return rois
+        # rois are ordered by combination first
+        return rois, tf.tile(batch_index, [shifts.shape[-1]])
 
 
-def include_gt_pixels(rois, gt_pixels, dim1, dim2):
+def include_gt_pixels(rois, gt_pixels, dim1, dim2, rois_batch=None,
+                      gt_batch=None):
     """
     Rois: [None, 2] in F5 coordinates (floating point)
     These ROIs are 4x4 on F3 feature map. Include 3x3 F3 pixels around pixels
     containing ground truth points.
     gt_pixels: shape (None, 2)
     Return rois in F5 coordinates (round coordinates for rois, float for gt rois)
+    If batch indexes of rois and gt_pixels are given, also returns batch
+    index of final rois.
     """
     with tf.variable_scope("include_gt_pixels"):
         dim = gt_pixels.get_shape().as_list()[-1]  # 2D or 3D
@@ -221,25 +284,35 @@ def include_gt_pixels(rois, gt_pixels, dim1, dim2):
         # In the meantime, we will have some duplicates between rois and gt_pixels.
         rois = tf.concat([rois, gt_pixels_coord], axis=0, name="rois") # shape [None, 2]
         assert rois.get_shape().as_list()[-1] == dim and len(rois.get_shape().as_list()) == 2 # Shape [None, 2]
-        return rois
+        if rois_batch is None:
+            return rois
+        gt_batch = tf.reshape(tf.tile(tf.expand_dims(gt_batch, axis=1),
+                                      [1, 3**dim]), (-1,))
+        return rois, tf.concat([rois_batch, gt_batch], axis=0)
 
 
-def compute_positives_ppn1(gt_pixels, N3, dim1, dim2):
+def compute_positives_ppn1(gt_pixels, N3, dim1, dim2, gt_batch=None,
+                           batch_size=None):
     """
     Returns a mask corresponding to proposals shape = [N*N, 2]
     Positive = 1 = contains a ground truth pixel
     gt_pixels is shape [None, 2]
     Returns classes with shape (16*16,1)
+    If gt_batch (batch index of gt pixels) and batch_size are given,
+    returns classes with shape (batch_size*16*16, 1)
     """
     with tf.variable_scope("ppn1_compute_positives"):
         dim = gt_pixels.get_shape().as_list()[-1]
-        classes = tf.zeros(shape=(N3,)*dim)
         # Convert to F5 coordinates (16x16)
         # Shape = None, 2
         gt_pixels = tf.cast(tf.floor(gt_pixels / (dim1 * dim2)), tf.int32)
+        if gt_batch is None:
+            shape = tf.constant((N3,)*dim)
+        else:
+            shape = tf.stack([batch_size] + [N3]*dim)
+            gt_pixels = tf.concat([tf.expand_dims(gt_batch, axis=1), gt_pixels], axis=1)
         # Assign positive pixels based on gt_pixels
-        #classes = classes + tf.scatter_nd(gt_pixels, tf.constant(value=1.0, shape=tf.shape(gt_pixels)[0]), classes.shape)
-        classes = classes + tf.scatter_nd(gt_pixels, tf.fill((tf.shape(gt_pixels)[0],), 1.0), classes.shape)
+        classes = tf.scatter_nd(gt_pixels, tf.fill((tf.shape(gt_pixels)[0],), 1.0), shape)
         classes = tf.cast(tf.reshape(classes, shape=(-1, 1)), tf.int32)
         classes_mask = tf.cast(classes, tf.bool, name="ppn1_mask") # Turn classes into a mask
         return classes_mask
@@ -265,19 +338,68 @@ def compute_positives_ppn2(closest_gt_distance, threshold=2):
         return mask
 
 
-def assign_gt_pixels(gt_pixels_placeholder, proposals, dim1, dim2, rois=None):
+def closest_gt_chunked(proposals, gt_pixels, chunk_size,
+                       proposals_batch=None, gt_batch=None):
+    """
+    Index of the closest gt pixel for each proposal (restricted to gt pixels
+    of the same event if batch indexes are given).
+    Distances are computed by chunks of chunk_size proposals, one chunk at a
+    time, so that memory is O(chunk_size * nb gt pixels) instead of
+    O(nb proposals * nb gt pixels). No gradient flows through the indexes.
+    proposals shape [None, dim], gt_pixels shape [None, dim]
+    """
+    with tf.variable_scope("closest_gt_chunked"):
+        dim = proposals.get_shape().as_list()[-1]
+        n = tf.shape(proposals)[0]
+        num_chunks = (n + chunk_size - 1) // chunk_size
+        padding = num_chunks * chunk_size - n
+        proposals = tf.reshape(
+            tf.pad(tf.stop_gradient(proposals), [[0, padding], [0, 0]]),
+            tf.stack([num_chunks, chunk_size, dim]))
+        if proposals_batch is None:
+            proposals_batch = tf.zeros((n,), dtype=tf.int32)
+            gt_batch = tf.zeros((tf.shape(gt_pixels)[0],), dtype=tf.int32)
+        proposals_batch = tf.reshape(tf.pad(proposals_batch, [[0, padding]]),
+                                     tf.stack([num_chunks, chunk_size]))
+
+        def closest(chunk):
+            chunk_proposals, chunk_batch = chunk
+            # Shape chunk_size x nb gt pixels
+            distances = tf.sqrt(tf.reduce_sum(tf.pow(
+                tf.expand_dims(chunk_proposals, axis=1)
+                - tf.expand_dims(gt_pixels, axis=0), 2), axis=2))
+            same_event = tf.equal(tf.expand_dims(chunk_batch, axis=1),
+                                  tf.expand_dims(gt_batch, axis=0))
+            distances = tf.where(same_event, distances,
+                                 tf.fill(tf.shape(distances), np.inf))
+            return tf.argmin(distances, axis=1)
+
+        closest_gt = tf.map_fn(closest, (proposals, proposals_batch),
+                               dtype=tf.int64, parallel_iterations=1,
+                               back_prop=False)
+        return tf.reshape(closest_gt, (-1,))[:n]
+
+
+def assign_gt_pixels(gt_pixels_placeholder, proposals, dim1, dim2, rois=None,
+                     proposals_batch=None, chunk_size=4096):
     """
     Proposals shape: [A*N*N, 2] (N=16 or 64)
-    gt_pixels_placeholder is shape [None, 2+1]
+    gt_pixels_placeholder is shape [None, 2+1], or [None, 2+2] with a batch
+    index as last column if proposals_batch (batch index of proposals) is
+    given. A proposal is then only matched to gt pixels of the same event.
     Returns closest ground truth pixels for all pixels and corresponding distance
     -  closest_gt = index of closest gt pixel (of same class)
     - closest_gt_distance = index of closest gt pixel (of same class)
     - closest_gt_label = label of closest gt pixel (regardless of class)
+    The closest gt pixels are searched by chunks of chunk_size proposals
+    (see closest_gt_chunked). If chunk_size is None the full distance matrix
+    between proposals and gt pixels is computed at once instead.
     """
     with tf.variable_scope("assign_gt_pixels"):
         dim = proposals.get_shape().as_list()[-1]
         gt_pixels = tf.slice(gt_pixels_placeholder, [0, 0], [-1, dim])
-        gt_pixels = tf.expand_dims(gt_pixels, axis=0)
+        if proposals_batch is not None:
+            gt_batch = tf.cast(gt_pixels_placeholder[:, dim+1], tf.int32)
         # convert proposals to real image coordinates in order to compare with
         # ground truth pixels coordinates
         if rois is not None:  # means PPN2
@@ -287,44 +409,66 @@ def assign_gt_pixels(gt_pixels_placeholder, proposals, dim1, dim2, rois=None):
             # Convert from F5 coordinates
             proposals = proposals * dim1 * dim2
 
-        # Tile to have shape (A*N*N, None, 2)
-        all_gt_pixels = tf.tile(gt_pixels, tf.stack([tf.shape(proposals)[0], 1, 1]))
-        # assert all_gt_pixels.get_shape().as_list() == [None, None, dim]
-        # Reshape proposals to [A*N*N, 1, 2]
-        proposals = tf.expand_dims(proposals, axis=1)
-        distances = tf.sqrt(tf.reduce_sum(tf.pow(proposals - all_gt_pixels, 2), axis=2))
-        # distances.shape = [A*N*N, None]
-        #if rois is not None:
-        #   distances = distances + tf.scatter_nd(tf.cast(tf.where(all_gt_pixels_mask), tf.int32), tf.fill((tf.shape(tf.where(all_gt_pixels_mask))[0],), 10000.0), tf.shape(all_gt_pixels_mask))
-
-        # closest_gt.shape = [A*N*N,]
-        # closest_gt[i] = indice of closest gt in gt_pixels_placeholder
-        closest_gt = tf.argmin(distances, axis=1)
-        closest_gt_distance = tf.reduce_min(distances, axis=1, keepdims=True,
-                                            name="closest_gt_distance")
+        if chunk_size is not None:
+            # closest_gt.shape = [A*N*N,]
+            # closest_gt[i] = indice of closest gt in gt_pixels_placeholder
+            closest_gt = closest_gt_chunked(
+                proposals, gt_pixels, chunk_size,
+                proposals_batch=proposals_batch,
+                gt_batch=gt_batch if proposals_batch is not None else None)
+            # Distance to the closest gt pixel only, shape [A*N*N, 1]
+            closest_gt_distance = tf.sqrt(tf.reduce_sum(tf.pow(
+                proposals - tf.gather(gt_pixels, closest_gt), 2),
+                axis=1, keepdims=True))
+            if proposals_batch is not None:
+                # Events without any gt pixel
+                same_event = tf.equal(tf.gather(gt_batch, closest_gt),
+                                      proposals_batch)
+                closest_gt_distance = tf.where(
+                    same_event[:, tf.newaxis], closest_gt_distance,
+                    tf.fill(tf.shape(closest_gt_distance), np.inf))
+            closest_gt_distance = tf.identity(closest_gt_distance,
+                                              name="closest_gt_distance")
+        else:
+            gt_pixels = tf.expand_dims(gt_pixels, axis=0)
+            # Tile to have shape (A*N*N, None, 2)
+            all_gt_pixels = tf.tile(gt_pixels, tf.stack([tf.shape(proposals)[0], 1, 1]))
+            # assert all_gt_pixels.get_shape().as_list() == [None, None, dim]
+            # Reshape proposals to [A*N*N, 1, 2]
+            proposals = tf.expand_dims(proposals, axis=1)
+            distances = tf.sqrt(tf.reduce_sum(tf.pow(proposals - all_gt_pixels, 2), axis=2))
+            if proposals_batch is not None:
+                same_event = tf.equal(tf.expand_dims(proposals_batch, axis=1),
+                                      tf.expand_dims(gt_batch, axis=0))
+                distances = tf.where(same_event, distances,
+                                     tf.fill(tf.shape(distances), np.inf))
+            # distances.shape = [A*N*N, None]
+
+            # closest_gt.shape = [A*N*N,]
+            # closest_gt[i] = indice of closest gt in gt_pixels_placeholder
+            closest_gt = tf.argmin(distances, axis=1)
+            closest_gt_distance = tf.reduce_min(distances, axis=1, keepdims=True,
+                                                name="closest_gt_distance")
         gt_pixels_labels = tf.slice(gt_pixels_placeholder, [0, dim], [-1, 1])
-        closest_gt_label = tf.reshape(tf.gather_nd(
-            gt_pixels_labels,
-            tf.concat([tf.reshape(
-                tf.range(0, tf.shape(closest_gt_distance)[0]),
-                (-1, 1)),
-                       tf.cast(tf.reshape(closest_gt, (-1, 1)), tf.int32)],
-                      axis=1)
-            ), (-1, 1), name="closest_gt_label")
+        closest_gt_label = tf.reshape(tf.gather(gt_pixels_labels, closest_gt),
+                                      (-1, 1), name="closest_gt_label")
         return closest_gt, closest_gt_distance, closest_gt_label
 
 
-def crop_pool_layer(net, rois, dim2, dim):
+def crop_pool_layer(net, rois, dim2, dim, batch_index=None):
     """
     Crop and pool intermediate F3 layer.
-    Net.shape = [1, 64, 64, 256]
+    Net.shape = [B, 64, 64, 256]
     Rois.shape = [None, 2] # Could be less than R, assumes coordinates on F5
     Also assumes ROIs are 1x1 pixels on F3
+    batch_index: index in the batch of each ROI (default is 0)
     """
     with tf.variable_scope("crop_pool_layer"):
         # Convert rois from F5 coordinates to F3 coordinates (x4)
         rois = tf.cast(rois * dim2, tf.int32)
         nb_channels = net.get_shape().as_list()[-1]
-        indices = tf.concat([tf.fill([tf.shape(rois)[0], 1], 0), rois], axis=1)
+        if batch_index is None:
+            batch_index = tf.fill([tf.shape(rois)[0]], 0)
+        indices = tf.concat([tf.expand_dims(batch_index, axis=1), rois], axis=1)
         rois = tf.gather_nd(net, indices, name="crop_layer")
         return tf.reshape(rois, (-1,) + (1,) * dim + (nb_channels,))
@@ -0,0 +1,271 @@
+# *-* encoding: utf-8 *-*
+# Benchmarks of PPN building blocks
+# Usage: python benchmark.py [name of benchmark ...]
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+import time
+import sys
+
+from faster_particles.ppn_utils import assign_gt_pixels
+from faster_particles.cropping import Probabilistic, Grid
+from faster_particles.ppn_postprocessing import nms_numpy, nms_grid, \
+    filter_points, filter_points_dbscan
+
+
+def peak_memory(run_metadata):
+    """
+    Peak memory (in bytes) reached by allocators during a traced session run.
+    """
+    peak = 0
+    for device in run_metadata.step_stats.dev_stats:
+        for node in device.node_stats:
+            for memory in node.memory:
+                peak = max(peak, memory.peak_bytes)
+    return peak
+
+
+def assign_gt_pixels_test(dim=3, N_values=[1000, 10000, 100000],
+                          G_values=[100, 1000], chunk_size=4096,
+                          MAX_STEPS=10):
+    """
+    Compare dense and chunked assign_gt_pixels (forward and gradient with
+    respect to proposals) on N random proposals and G random gt pixels.
+    """
+    dim1, dim2 = 8.0, 4.0
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    results = []
+    for N in N_values:
+        for G in G_values:
+            tf.reset_default_graph()
+            proposals_np = np.random.rand(N, dim) * 16  # F5 coordinates
+            gt_pixels_np = np.concatenate([np.random.rand(G, dim) * 512,
+                                           np.random.randint(1, 3, (G, 1))],
+                                          axis=1)
+            proposals = tf.placeholder(tf.float32, shape=(None, dim))
+            gt_pixels = tf.placeholder(tf.float32, shape=(None, dim + 1))
+            feed_dict = {proposals: proposals_np, gt_pixels: gt_pixels_np}
+            outputs = {}
+            for name, size in [('dense', None), ('chunked', chunk_size)]:
+                with tf.variable_scope(name):
+                    closest_gt, closest_gt_distance, _ = assign_gt_pixels(
+                        gt_pixels, proposals, dim1, dim2, chunk_size=size)
+                    gradient = tf.gradients(tf.reduce_sum(closest_gt_distance),
+                                            proposals)[0]
+                    outputs[name] = [closest_gt, closest_gt_distance, gradient]
+
+            values = {}
+            with tf.Session() as sess:
+                for name in ['dense', 'chunked']:
+                    try:
+                        values[name] = sess.run(outputs[name], feed_dict=feed_dict)
+                        duration = 0
+                        for i in range(MAX_STEPS):
+                            start = time.time()
+                            sess.run(outputs[name], feed_dict=feed_dict)
+                            duration += time.time() - start
+                        duration /= MAX_STEPS
+                        run_metadata = tf.RunMetadata()
+                        sess.run(outputs[name], feed_dict=feed_dict,
+                                 options=run_options, run_metadata=run_metadata)
+                        memory = peak_memory(run_metadata) / 1024.0**2
+                    except tf.errors.ResourceExhaustedError:
+                        duration, memory = np.nan, np.nan
+                    print("N = %d, G = %d - %s: average duration = %f s, peak memory = %f MB" % (N, G, name, duration, memory))
+                    results.append([N, G, name == 'chunked', duration, memory])
+            if len(values) == 2:
+                print("Same closest gt: %s, same distances: %s, same gradient: %s" % (
+                    np.array_equal(values['dense'][0], values['chunked'][0]),
+                    np.allclose(values['dense'][1], values['chunked'][1]),
+                    np.allclose(values['dense'][2], values['chunked'][2])))
+
+    # Columns: N, G, chunked, duration, peak memory
+    print(np.array(results))
+
+
+def toy_event(num_voxels, N=768, dim=3, num_tracks=8):
+    """
+    Voxel coordinates of a few random noisy straight tracks.
+    """
+    tracks = []
+    length = num_voxels // num_tracks
+    for i in range(num_tracks):
+        start = np.random.rand(dim) * N
+        direction = np.random.randn(dim)
+        direction /= np.linalg.norm(direction)
+        tracks.append(start + np.arange(length)[:, None] * direction * 0.7
+                      + np.random.randn(length, dim))
+    coords = np.clip(np.concatenate(tracks), 0, N - 1).astype(np.int32)
+    return np.unique(coords, axis=0)
+
+
+def cropping_test(dim=3, num_voxels_values=[2000, 20000, 100000],
+                  MAX_STEPS=10):
+    """
+    Time per event of the probabilistic cropping with spatial index
+    compared to the brute force version, on toy events.
+    """
+    class Cfg(object):
+        IMAGE_SIZE = 768
+        SLICE_SIZE = 64
+        CORE_SIZE = 32
+        MAX_PATCHES = 1000
+        MIN_OVERLAP = 2
+        CORE_CONFIDENCE = 0.9
+        MIN_CORE_COVERAGE = 1
+
+    algorithm = Probabilistic(Cfg())
+    results = []
+    for num_voxels in num_voxels_values:
+        durations = {'index': 0.0, 'bruteforce': 0.0}
+        same = True
+        for step in range(MAX_STEPS):
+            coords = toy_event(num_voxels, N=Cfg.IMAGE_SIZE, dim=dim)
+            patches = {}
+            for name, crop in [('index', algorithm.crop),
+                               ('bruteforce', algorithm.crop_bruteforce)]:
+                np.random.seed(step)
+                start = time.time()
+                patches[name], _ = crop(coords)
+                durations[name] += (time.time() - start) / MAX_STEPS
+            same = same and np.array_equal(patches['index'], patches['bruteforce'])
+        print("%d voxels - index: %f s/event, brute force: %f s/event, same patches: %s" % (
+            num_voxels, durations['index'], durations['bruteforce'], same))
+        results.append([num_voxels, durations['index'], durations['bruteforce']])
+
+    # Columns: number of voxels, index duration, brute force duration
+    print(np.array(results))
+
+
+def reconcile_test(dim=3, num_events=10, num_voxels=20000, num_classes=3,
+                   noise=1.0):
+    """
+    Time and accuracy of average vs core weighted reconciliation of
+    UResNet crop predictions, on a fixed set of toy events cropped with
+    the grid algorithm. The simulated network is less accurate near the
+    patch borders: logits are the true one-hot labels, scaled down with the
+    distance to the patch center, plus gaussian noise.
+    """
+    class Cfg(object):
+        IMAGE_SIZE = 768
+        SLICE_SIZE = 64
+        CORE_SIZE = 32
+        NUM_CLASSES = num_classes
+        RECONCILE = 'average'
+        CORE_CONFIDENCE = 0.9
+        MIN_CORE_COVERAGE = 1
+
+    cfg = Cfg()
+    algorithm = Grid(cfg)
+    S = cfg.SLICE_SIZE
+    np.random.seed(0)
+    events = []
+    for event in range(num_events):
+        coords = toy_event(num_voxels, N=cfg.IMAGE_SIZE, dim=dim)
+        labels = np.random.randint(num_classes, size=coords.shape[0])
+        centers, sizes = algorithm.crop(coords)
+        batch_results = []
+        for center in centers:
+            local = coords - (center - S/2.0)
+            inside = np.all(np.logical_and(local >= 0, local < S), axis=1)
+            local = local[inside].astype(np.int64)
+            distance = np.amax(np.abs(local - S/2.0), axis=1) / (S/2.0)
+            logits = 3.0 * np.eye(num_classes)[labels[inside]] * (1.0 - distance[:, None]) \
+                + noise * np.random.randn(local.shape[0], num_classes)
+            result = {'predictions': np.zeros((S,) * dim),
+                      'scores': np.zeros((S,) * dim),
+                      'softmax': np.zeros((S,) * dim + (num_classes,))}
+            result['predictions'][tuple(local.T)] = 1
+            result['softmax'][tuple(local.T)] = np.exp(logits) / np.sum(np.exp(logits), axis=1, keepdims=True)
+            batch_results.append(result)
+        # Reconcile takes patch centers in reversed coordinates
+        events.append((coords, labels, batch_results, np.flip(centers, axis=1), sizes))
+
+    results = []
+    for mode in ['average', 'core']:
+        cfg.RECONCILE = mode
+        duration, accuracy = 0.0, 0.0
+        for coords, labels, batch_results, centers, sizes in events:
+            start = time.time()
+            final_results = algorithm.reconcile(batch_results, centers, sizes)
+            duration += (time.time() - start) / num_events
+            truth = np.zeros((cfg.IMAGE_SIZE,) * dim, dtype=np.int64)
+            truth[tuple(coords.T)] = labels
+            accuracy += np.mean(final_results['voxels_predictions'] == truth[tuple(final_results['voxels'].T)]) / num_events
+        print("%s: average duration = %f s/event, accuracy = %f" % (mode, duration, accuracy))
+        results.append([mode == 'core', duration, accuracy])
+
+    # Columns: core blending, duration, accuracy
+    print(np.array(results))
+
+
+def nms_test(num_proposals_values=[1000, 10000, 100000], threshold=0.01,
+             size=6.0, MAX_STEPS=3):
+    """
+    Time of the grid bucketed NMS compared to nms_numpy, in 2D and 3D, on
+    random proposals with random scores.
+    """
+    results = []
+    for dim, N in [(2, 768), (3, 192)]:
+        for num_proposals in num_proposals_values:
+            durations = {'grid': 0.0, 'numpy': 0.0}
+            same = True
+            for step in range(MAX_STEPS):
+                im_proposals = (np.random.rand(num_proposals, dim) * N).astype(np.float32)
+                im_scores = np.random.rand(num_proposals).astype(np.float32)
+                keep = {}
+                for name, f in [('grid', nms_grid), ('numpy', nms_numpy)]:
+                    start = time.time()
+                    _, keep[name] = f(im_proposals, im_scores, threshold, size)
+                    durations[name] += (time.time() - start) / MAX_STEPS
+                same = same and np.array_equal(keep['grid'], keep['numpy'])
+            print("%dD, %d proposals - grid: %f s, numpy: %f s, same keep: %s" % (
+                dim, num_proposals, durations['grid'], durations['numpy'], same))
+            results.append([dim, num_proposals, durations['grid'], durations['numpy']])
+
+    # Columns: dimension, number of proposals, grid duration, numpy duration
+    print(np.array(results))
+
+
+def filter_points_test(dim=3, N=768, num_proposals_values=[1000, 10000, 100000],
+                       MAX_STEPS=3):
+    """
+    Time of the KD-tree clustering of proposals compared to DBSCAN, on
+    random proposals (many clusters).
+    """
+    eps = 15.0 if dim == 3 else 20.0
+    results = []
+    for num_proposals in num_proposals_values:
+        durations = {'kdtree': 0.0, 'dbscan': 0.0}
+        same = True
+        for step in range(MAX_STEPS):
+            im_proposals = (np.random.rand(num_proposals, dim) * N).astype(np.float32)
+            im_scores = np.random.rand(num_proposals).astype(np.float32)
+            clusters = {}
+            for name, f in [('kdtree', filter_points), ('dbscan', filter_points_dbscan)]:
+                start = time.time()
+                clusters[name] = f(im_proposals, im_scores, eps)
+                durations[name] += (time.time() - start) / MAX_STEPS
+            same = same and np.array_equal(clusters['kdtree'][2], clusters['dbscan'][2]) \
+                and np.allclose(clusters['kdtree'][0], clusters['dbscan'][0], atol=1e-3)
+        print("%d proposals - kdtree: %f s, dbscan: %f s, same clusters: %s" % (
+            num_proposals, durations['kdtree'], durations['dbscan'], same))
+        results.append([num_proposals, durations['kdtree'], durations['dbscan']])
+
+    # Columns: number of proposals, kdtree duration, dbscan duration
+    print(np.array(results))
+
+
+if __name__ == '__main__':
+    benchmarks = {
+        'assign_gt_pixels': assign_gt_pixels_test,
+        'cropping': cropping_test,
+        'filter_points': filter_points_test,
+        'nms': nms_test,
+        'reconcile': reconcile_test
+    }
+    for name in (sys.argv[1:] or sorted(benchmarks)):
+        benchmarks[name]()
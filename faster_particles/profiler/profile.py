@@ -148,6 +148,8 @@ if __name__ == '__main__':
         CROP_ALGO = "proba"
         MAX_PATCHES = 500  # for proba algo
         MIN_OVERLAP = 2  # for proba algo
+        CORE_CONFIDENCE = 0.9  # for core reconcile
+        MIN_CORE_COVERAGE = 1  # for core reconcile
 
         # General settings
         OUTPUT_DIR = "output"
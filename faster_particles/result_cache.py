@@ -0,0 +1,165 @@
+# *-* encoding: utf-8 *-*
+# On-disk cache of network outputs per crop
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import os
+import glob
+import hashlib
+
+# Settings which change the outputs stored in the cache for a given checkpoint
+# and crop: data source, network, crop geometry and postprocessing.
+CACHE_SETTINGS = ['DATA_TYPE', 'DATA', 'TEST_DATA', 'DATA_3D', 'SEED',
+                  'IMAGE_SIZE', 'SLICE_SIZE', 'CROP_SIZE', 'ENABLE_CROP',
+                  'CROP_ALGO', 'NET', 'BASE_NET', 'NUM_CLASSES',
+                  'BASE_NUM_OUTPUTS', 'NUM_STRIDES', 'URESNET_ADD', 'SPARSE',
+                  'PPN1_INDEX', 'PPN2_INDEX', 'PPN1_SCORE_THRESHOLD',
+                  'PPN2_DISTANCE_THRESHOLD', 'R', 'MIN_SCORE',
+                  'POSTPROCESSING']
+
+
+def settings_hash(cfg):
+    """
+    Identify the values of CACHE_SETTINGS in cfg.
+    """
+    h = hashlib.sha1()
+    for name in CACHE_SETTINGS:
+        h.update(('%s=%r;' % (name, getattr(cfg, name, None))).encode('utf-8'))
+    return h.hexdigest()
+
+
+def checkpoint_hash(weights_files):
+    """
+    Identify a set of TF checkpoints by their content: hash of the `.index`
+    file of each checkpoint (it holds checksums of all tensors), or of the
+    file itself, or only of its path if it cannot be found.
+    """
+    h = hashlib.sha1()
+    for weights_file in weights_files:
+        if weights_file is None:
+            h.update(b'None')
+            continue
+        h.update(weights_file.encode('utf-8'))
+        for filename in [weights_file + '.index', weights_file]:
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    h.update(f.read())
+                break
+    return h.hexdigest()
+
+
+def cache_keys(cfg, batch_blobs, name, weights_hash, patch_centers=None,
+               patch_sizes=None):
+    """
+    Keys of the result cache for each crop of an event: network name,
+    checkpoint hash (see `checkpoint_hash`), settings hash (see
+    `settings_hash`), entry id, patch center and patch size.
+    """
+    settings = settings_hash(cfg)
+    keys = []
+    for j, blob in enumerate(batch_blobs):
+        if cfg.ENABLE_CROP:
+            center, size = patch_centers[j], patch_sizes[j]
+        else:
+            center, size = None, cfg.IMAGE_SIZE
+        keys.append((name, weights_hash, settings, blob['entries'], center,
+                     size))
+    return keys
+
+
+class ResultCache(object):
+    """
+    On-disk cache of the outputs of a network for each crop, so that
+    postprocessing, reconcile and metrics can be run again without running
+    the network.
+
+    A result (dict of numpy arrays) is stored in a `.npz` file named after
+    the hash of its key (see `cache_keys`): network name, checkpoint hash,
+    settings hash, entry id, patch center and patch size. Total size of the cache directory is bounded by
+    `max_size` (in MB): least recently used files are evicted first (last
+    use is tracked with the modification time of the files).
+    """
+
+    def __init__(self, directory, max_size=1024):
+        self.directory = directory
+        self.max_size = max_size * 1024**2
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # filename -> [last use, size]
+        self.files = {}
+        for filename in glob.glob(os.path.join(self.directory, '*.npz')):
+            stat = os.stat(filename)
+            self.files[filename] = [stat.st_mtime, stat.st_size]
+        self.size = sum([size for _, size in self.files.values()])
+        self.hits, self.misses = 0, 0
+
+    def filename(self, key):
+        """
+        key is a tuple of strings, numbers, lists or numpy arrays.
+        """
+        h = hashlib.sha1()
+        for part in key:
+            if part is not None:
+                part = np.asarray(part)
+                part = str(part.tolist()) if part.dtype.kind in 'biuf' else str(part)
+            h.update(repr(part).encode('utf-8'))
+        return os.path.join(self.directory, h.hexdigest() + '.npz')
+
+    def get(self, key):
+        """
+        Returns cached result for key, or None.
+        """
+        filename = self.filename(key)
+        if filename not in self.files:
+            self.misses += 1
+            return None
+        try:
+            with np.load(filename, allow_pickle=True) as f:
+                result = dict([(k, f[k][()] if f[k].ndim == 0 else f[k]) for k in f.files])
+        except (IOError, OSError, ValueError) as e:
+            print("WARNING Could not read cached result %s: %s" % (filename, e))
+            self.remove(filename)
+            self.misses += 1
+            return None
+        os.utime(filename, None)
+        self.files[filename][0] = os.stat(filename).st_mtime
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """
+        Store result (dict of numpy arrays) for key, then evict least
+        recently used results if the cache is too large.
+        """
+        filename = self.filename(key)
+        if filename in self.files:
+            self.remove(filename)
+        try:
+            np.savez(filename, **result)
+        except (IOError, OSError) as e:
+            print("WARNING Could not write cached result %s: %s" % (filename, e))
+            return
+        stat = os.stat(filename)
+        self.files[filename] = [stat.st_mtime, stat.st_size]
+        self.size += stat.st_size
+        if self.size > self.max_size:
+            for old_filename in sorted(self.files, key=lambda f: self.files[f][0]):
+                if self.size <= self.max_size or old_filename == filename:
+                    break
+                self.remove(old_filename)
+
+    def remove(self, filename):
+        if os.path.isfile(filename):
+            os.remove(filename)
+        self.size -= self.files.pop(filename)[1]
+
+    def summary(self):
+        """
+        One-line report of cache statistics.
+        """
+        return "Result cache %s - %d results, %f MB, %d hits, %d misses" % (
+            self.directory, len(self.files), self.size / 1024.0**2,
+            self.hits, self.misses)
@@ -0,0 +1,27 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for command line configuration
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+from faster_particles.config import PPNConfig
+
+
+class Test(unittest.TestCase):
+    def test_create_parsers(self):
+        # Conflicting option strings raise argparse.ArgumentError here
+        cfg = PPNConfig()
+        for script in ['train -o out -l log', 'demo', 'convert -o out']:
+            args = vars(cfg.parser.parse_args(script.split() + ['-d', 'display']))
+            self.assertEqual(args['script'], script.split()[0])
+
+    def test_demo_options(self):
+        cfg = PPNConfig()
+        args = vars(cfg.parser.parse_args(['demo', '-d', 'display', '-sb', '-shb']))
+        self.assertTrue(args['sparse_blob'])
+        self.assertTrue(args['shared_base'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for PPN postprocessing
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import numpy as np
+import tensorflow as tf
+from sklearn.cluster import DBSCAN
+from faster_particles.ppn_postprocessing import nms_numpy, nms_grid, nms_tf, \
+    filter_points, filter_points_dbscan, voxel_graph, dbscan_graph
+
+
+def random_proposals(num_proposals, dim, N=64):
+    im_proposals = (np.random.rand(num_proposals, dim) * N).astype(np.float32)
+    # Distinct scores: order of equal scores is implementation defined
+    im_scores = np.random.permutation(num_proposals).astype(np.float32) / num_proposals
+    return im_proposals, im_scores
+
+
+class Test(unittest.TestCase):
+    def nms_tf(self, dim, num_proposals=500, threshold=0.01, size=6.0):
+        tf.reset_default_graph()
+        proposals = tf.placeholder(tf.float32, shape=(None, dim))
+        scores = tf.placeholder(tf.float32, shape=(None,))
+        keep = nms_tf(proposals, scores, threshold=threshold, size=size)
+        with tf.Session() as sess:
+            for step in range(5):
+                im_proposals, im_scores = random_proposals(num_proposals, dim)
+                _, keep_np = nms_numpy(im_proposals, im_scores, threshold, size)
+                keep_tf = sess.run(keep, feed_dict={proposals: im_proposals,
+                                                    scores: im_scores})
+                self.assertTrue(np.array_equal(keep_tf, keep_np))
+
+    def test_nms_tf_2d(self):
+        self.nms_tf(2)
+
+    def test_nms_tf_3d(self):
+        self.nms_tf(3)
+
+    def test_nms_tf_threshold_3d(self):
+        self.nms_tf(3, threshold=0.3, size=3.0)
+
+    def test_nms_tf_empty_3d(self):
+        self.nms_tf(3, num_proposals=0)
+
+    def test_nms_grid(self):
+        for dim in [2, 3]:
+            for threshold in [0.01, 0.3]:
+                im_proposals, im_scores = random_proposals(1000, dim, N=256)
+                _, keep_np = nms_numpy(im_proposals, im_scores, threshold, 6.0)
+                _, keep_grid = nms_grid(im_proposals, im_scores, threshold, 6.0)
+                self.assertTrue(np.array_equal(keep_grid, keep_np))
+
+    def test_nms_grid_empty(self):
+        im_proposals, im_scores = random_proposals(0, 3)
+        _, keep = nms_grid(im_proposals, im_scores, 0.01, 6.0)
+        self.assertEqual(len(keep), 0)
+
+    def test_filter_points(self):
+        for dim, eps in [(2, 20.0), (3, 15.0)]:
+            im_proposals, im_scores = random_proposals(2000, dim, N=512)
+            proposals, scores, index = filter_points(im_proposals, im_scores, eps)
+            proposals_db, scores_db, index_db = filter_points_dbscan(im_proposals, im_scores, eps)
+            self.assertTrue(np.array_equal(index, index_db))
+            self.assertTrue(np.allclose(proposals, proposals_db, atol=1e-4))
+            self.assertTrue(np.allclose(scores, scores_db, atol=1e-5))
+
+    def test_dbscan_graph(self):
+        for dim, eps, N in [(2, 2.0, 128), (3, 2.5, 32)]:
+            voxels = np.argwhere(np.random.rand(*((N,) * dim)) < 0.3)
+            graph = voxel_graph(voxels, eps)
+            for min_samples in [1, 10]:
+                labels = DBSCAN(eps=eps, min_samples=min_samples).fit_predict(voxels)
+                self.assertTrue(np.array_equal(dbscan_graph(graph, min_samples), labels))
+            # Restriction of the graph to a subset of voxels
+            labels = DBSCAN(eps=eps, min_samples=10).fit_predict(voxels[100:])
+            self.assertTrue(np.array_equal(dbscan_graph(graph[100:, 100:], 10), labels))
+
+
+if __name__ == '__main__':
+    unittest.main()
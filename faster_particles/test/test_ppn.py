@@ -12,7 +12,7 @@ from faster_particles.ppn_utils import generate_anchors, \
     compute_positives_ppn1, compute_positives_ppn2, assign_gt_pixels, \
     include_gt_pixels, predicted_pixels, crop_pool_layer, \
     all_combinations, slice_rois, \
-    nms_step, nms
+    nms_step, nms, crop, crop_sparse, densify_blob
 
 
 def generate_anchors_np(im_shape, repeat=1):
@@ -273,6 +273,21 @@ class Test(unittest.TestCase):
         proposals_np = np.array([[1.0, 1.0, 0.43], [7, 75, 2.3], [98, 10, 45], [5, 34, 72]])
         return self.assign_gt_pixels(gt_pixels_np, proposals_np, dim1, dim2)
 
+    def test_assign_gt_pixels_chunked_3d(self):
+        dim1, dim2 = 8.0, 4.0
+        gt_pixels_np = np.concatenate([np.random.rand(20, 3)*512,
+                                       np.random.randint(1, 3, (20, 1))], axis=1)
+        proposals_np = np.random.rand(100, 3)*16
+        with tf.Session() as sess:
+            gt_pixels_tf = tf.constant(gt_pixels_np, dtype=tf.float32)
+            proposals_tf = tf.constant(proposals_np, dtype=tf.float32)
+            dense = assign_gt_pixels(gt_pixels_tf, proposals_tf, dim1, dim2, chunk_size=None)
+            chunked = assign_gt_pixels(gt_pixels_tf, proposals_tf, dim1, dim2, chunk_size=16)
+            dense, chunked = sess.run([dense, chunked])
+        self.assertTrue(np.array_equal(dense[0], chunked[0]))
+        self.assertTrue(np.allclose(dense[1], chunked[1]))
+        self.assertTrue(np.array_equal(dense[2], chunked[2]))
+
     def crop_pool_layer(self, net, rois_np, dim2, dim):
         rois = np.array(rois_np * dim2).astype(int)
         nb_channels = net.shape[-1]
@@ -298,6 +313,41 @@ class Test(unittest.TestCase):
         rois_np = np.random.rand(10, 3)*16
         return self.crop_pool_layer(net, rois_np, dim2, dim)
 
+    def test_crop_pool_layer_batch_3d(self):
+        dim2, dim = 4.0, 3
+        net = np.random.rand(3, 16, 16, 16, 8)
+        rois_np = np.random.rand(10, 3)*4
+        batch_np = np.random.randint(3, size=10)
+        indices = (rois_np * dim2).astype(int)
+        expected = net[(batch_np,) + tuple(indices.T)]
+        with tf.Session() as sess:
+            rois_tf = crop_pool_layer(tf.constant(net, dtype=tf.float32),
+                                      tf.constant(rois_np, dtype=tf.float32),
+                                      dim2, dim,
+                                      batch_index=tf.constant(batch_np, dtype=tf.int32))
+            rois_result = sess.run(rois_tf)
+        self.assertTrue(np.allclose(np.reshape(expected, rois_result.shape), rois_result))
+
+    def test_top_R_pixels_batch_2d(self):
+        R, threshold, B, N = 3, 0.5, 2, 4
+        proposals_np = np.random.rand(B*N*N, 2)*N
+        scores_np = np.random.rand(B*N*N, 1)
+        scores_np[N*N:] *= 0.5  # No score above threshold in event 1
+        with tf.Session() as sess:
+            rois, roi_scores, batch = top_R_pixels(
+                tf.constant(proposals_np, dtype=tf.float32),
+                tf.constant(scores_np, dtype=tf.float32),
+                R=R, threshold=threshold, batch_size=B)
+            rois_tf, roi_scores_tf, batch_tf = sess.run([rois, roi_scores, batch])
+        for b in range(B):
+            scores_b = scores_np[b*N*N:(b+1)*N*N, 0]
+            order = np.argsort(scores_b)[::-1][:R]
+            order = order[scores_b[order] > threshold]
+            if len(order) == 0:  # Keep best proposal anyway
+                order = [np.argmax(scores_b)]
+            self.assertTrue(np.allclose(rois_tf[batch_tf == b], proposals_np[b*N*N:(b+1)*N*N][order]))
+            self.assertTrue(np.allclose(roi_scores_tf[batch_tf == b], scores_b[order]))
+
     def test_all_combinations(self):
         return np.allclose(all_combinations(([0, 1], [0, 1])), np.array([[0, 0], [0, 1], [1, 0], [1, 1]]))
 
@@ -346,6 +396,40 @@ class Test(unittest.TestCase):
             result_np = sess.run(result)
             return np.allclose(result_np[-3], np.array([0, 1]))
 
+    def test_crop_sparse_3d(self):
+        N, patch_size = 40, 16
+        data = np.random.rand(1, N, N, N, 1).astype(np.float32)
+        data[data < 0.97] = 0.0
+        coords = np.argwhere(data[0, ..., 0] > 0)
+        values = data[0, ..., 0][tuple(coords.T)]
+        patch_centers = np.array([[3, 20, 39], [20.5, 20, 20], [0, 0, 0]])
+        for patch_center in patch_centers:
+            crops, _ = crop(patch_center[np.newaxis, :], patch_size, data,
+                            return_labels=False)
+            crops_sparse = crop_sparse(patch_center[np.newaxis, :],
+                                       patch_size, coords,
+                                       values[:, np.newaxis])
+            self.assertTrue(np.array_equal(crops, crops_sparse))
+            self.assertEqual(crops.dtype, np.float32)
+            self.assertEqual(crops_sparse.dtype, np.float32)
+
+    def test_densify_blob_3d(self):
+        N = 20
+        data = np.random.rand(1, N, N, N, 1).astype(np.float32)
+        data[data < 0.9] = 0.0
+        coords = np.argwhere(data[0, ..., 0] > 0)
+        blob = {
+            # Voxels are in reversed order with respect to dense axes
+            'voxels': np.flip(coords, axis=1),
+            'voxels_value': data[0, ..., 0][tuple(coords.T)],
+            'voxels_labels': np.ones((coords.shape[0],)),
+            'entries': [0]
+        }
+        dense_blob = densify_blob(blob, N, 3)
+        self.assertTrue(np.array_equal(dense_blob['data'], data))
+        self.assertTrue(np.array_equal(dense_blob['labels'],
+                                       (data[..., 0] > 0).astype(np.int32)))
+
 
 if __name__ == '__main__':
     unittest.main()
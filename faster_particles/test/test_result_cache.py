@@ -0,0 +1,53 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the inference results cache
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import shutil
+import tempfile
+import numpy as np
+from faster_particles.result_cache import ResultCache, cache_keys
+
+
+class MyCfg(object):
+    IMAGE_SIZE = 192
+    SLICE_SIZE = 64
+    ENABLE_CROP = False
+    DATA_TYPE = 'hdf5'
+    DATA = 'test.h5'
+    R = 20
+    MIN_SCORE = 0.0
+    POSTPROCESSING = 'nms'
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_settings_miss(self):
+        cfg = MyCfg()
+        cache = ResultCache(self.directory)
+        batch_blobs = [{'entries': np.array([3])}]
+        result = {'im_proposals': np.random.rand(10, 2)}
+        key = cache_keys(cfg, batch_blobs, 'ppn', 'abc')[0]
+        cache.put(key, result)
+        cached = cache.get(cache_keys(cfg, batch_blobs, 'ppn', 'abc')[0])
+        self.assertTrue(np.array_equal(cached['im_proposals'],
+                                       result['im_proposals']))
+        for name, value in [('POSTPROCESSING', 'dbscan'), ('MIN_SCORE', 0.5),
+                            ('R', 10), ('IMAGE_SIZE', 768),
+                            ('DATA', 'other.h5'), ('DATA_TYPE', 'csv')]:
+            cfg = MyCfg()
+            setattr(cfg, name, value)
+            key = cache_keys(cfg, batch_blobs, 'ppn', 'abc')[0]
+            self.assertIsNone(cache.get(key), name)
+        self.assertEqual((cache.hits, cache.misses), (1, 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the conversion of data to the sparse format
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import copy
+import os
+import shutil
+import tempfile
+import numpy as np
+import tables
+from faster_particles.data import HDF5Generator, SparseGenerator
+from faster_particles.data.sparsedata import convert
+
+
+class MyCfg(object):
+    IMAGE_SIZE = 16
+    DATA_3D = True
+    DATA_TYPE = 'hdf5'
+    DATA = ''
+    TEST_DATA = ''
+    OUTPUT_DIR = ''
+    MAX_STEPS = 100
+    BATCH_SIZE = 1
+    SEED = 123
+    NET = 'ppn'
+    CROP_SIZE = 8
+    SPARSE_BLOB = False
+    SHUFFLE = False
+    HDF5_CHUNK_SIZE = 4
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        np.random.seed(123)
+        N, num_events = MyCfg.IMAGE_SIZE, 6
+        data = np.random.rand(num_events, N, N, N).astype(np.float32)
+        data[data < 0.9] = 0.0
+        data[2] = 0.0  # empty event
+        labels = np.random.randint(0, 3, size=data.shape).astype(np.int32)
+        labels[data == 0] = 0
+
+        self.dense_file = os.path.join(self.directory, 'dense.h5')
+        with tables.open_file(self.dense_file, 'w') as f:
+            f.create_array(f.root, 'data', data)
+            f.create_array(f.root, 'label', labels)
+
+        self.sparse_file = os.path.join(self.directory, 'sparse.h5')
+        with tables.open_file(self.sparse_file, 'w') as f:
+            voxels = f.create_vlarray(f.root, 'voxels', tables.Int32Atom())
+            values = f.create_vlarray(f.root, 'voxels_value', tables.Float32Atom())
+            voxels_labels = f.create_vlarray(f.root, 'voxels_labels', tables.Int32Atom())
+            for i in range(num_events):
+                indices = np.where(data[i] > 0)
+                voxels.append(np.stack(indices).T.flatten())
+                values.append(data[i][indices])
+                voxels_labels.append(labels[i][indices])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def convert_and_compare(self, filename):
+        cfg = MyCfg()
+        cfg.DATA = filename
+        cfg.OUTPUT_DIR = os.path.join(self.directory, 'sparse')
+        convert(copy.copy(cfg))
+        for sparse_blob in [False, True]:
+            cfg.SPARSE_BLOB = sparse_blob
+            source = HDF5Generator(cfg, filelist=filename)
+            sparse = SparseGenerator(cfg, filelist=cfg.OUTPUT_DIR)
+            self.assertEqual(sparse.n, source.n)
+            for i in range(source.n):
+                blob, sparse_blob = source.forward(), sparse.forward()
+                self.assertEqual(sorted(blob.keys()), sorted(sparse_blob.keys()))
+                for k in blob:
+                    self.assertTrue(np.array_equal(blob[k], sparse_blob[k]),
+                                    "%s differs for event %d" % (k, i))
+
+    def test_convert_hdf5_dense(self):
+        self.convert_and_compare(self.dense_file)
+
+    def test_convert_hdf5_sparse(self):
+        self.convert_and_compare(self.sparse_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,13 +9,16 @@ import tensorflow as tf
 from tensorflow.python.client import timeline
 import os
 import sys
+import copy
 import numpy as np
 from functools import partial
 from inspect import getargspec
 
 from faster_particles.demo_ppn import load_weights
 from faster_particles.display_utils import draw_slicing
-from faster_particles.cropping import cropping_algorithms
+from faster_particles.cropping import cropping_algorithms, coverage_metrics
+from faster_particles.data import Prefetcher
+from faster_particles.ppn_utils import densify_blob
 
 
 class Trainer(object):
@@ -74,10 +77,11 @@ class Trainer(object):
                         )
                     }
                 if is_drawing and self.display is not None:
-                    N = self.cfg.IMAGE_SIZE
-                    self.cfg.IMAGE_SIZE = self.cfg.CROP_SIZE
+                    # Copy cfg: prefetching threads read cfg.IMAGE_SIZE
+                    display_cfg = copy.copy(self.cfg)
+                    display_cfg.IMAGE_SIZE = self.cfg.CROP_SIZE
                     self.display(blob_i,
-                                 self.cfg,
+                                 display_cfg,
                                  index=real_step,
                                  name='display_train',
                                  directory=os.path.join(
@@ -90,7 +94,6 @@ class Trainer(object):
                                      (1,) + (self.cfg.CROP_SIZE,) * self.dim
                                      )
                                  )
-                    self.cfg.IMAGE_SIZE = N
         else:
             # print(blob['entries'])
             # print(np.sum(blob['weight']), np.amin(blob['weight']), np.amax(blob['weight']))
@@ -111,18 +114,17 @@ class Trainer(object):
                 if self.cfg.NET == 'ppn':
                     result['dim1'] = self.train_net.dim1
                     result['dim2'] = self.train_net.dim2
+                # Copy cfg: prefetching threads read cfg.IMAGE_SIZE
+                display_cfg = copy.copy(self.cfg)
                 if self.cfg.ENABLE_CROP:
-                    N = self.cfg.IMAGE_SIZE
-                    self.cfg.IMAGE_SIZE = self.cfg.SLICE_SIZE
+                    display_cfg.IMAGE_SIZE = self.cfg.SLICE_SIZE
                 self.display(blob,
-                             self.cfg,
+                             display_cfg,
                              index=real_step,
                              name='display_train',
                              directory=os.path.join(self.cfg.DISPLAY_DIR,
                                                     'train'),
                              **result)
-                if self.cfg.ENABLE_CROP:
-                    self.cfg.IMAGE_SIZE = N
                 print("Done.")
 
         if real_step % 1000 == 0:
@@ -205,6 +207,19 @@ class Trainer(object):
         self.batch_size = self.cfg.BATCH_SIZE
         self.cfg.BATCH_SIZE = 1
 
+        def prepare(blob):
+            """
+            Cropping pre-processing, runs in the prefetching threads.
+            """
+            if self.cfg.ENABLE_CROP:
+                return (blob,) + crop_algorithm.process(blob)
+            if self.cfg.SPARSE_BLOB:
+                blob = densify_blob(blob, self.cfg.IMAGE_SIZE, self.dim)
+            return blob, [blob], None, None
+
+        train_data = Prefetcher(self.train_toydata, self.cfg, process=prepare)
+        test_data = Prefetcher(self.test_toydata, self.cfg, process=prepare)
+
         print("Start training...")
         real_step = 0
         for step in range(self.cfg.MAX_STEPS):
@@ -212,17 +227,26 @@ class Trainer(object):
             is_testing = step % 10 == 5
             is_drawing = step > 0 and step % 200 == 0
             if is_testing:
-                blob = self.test_toydata.forward()
+                blob, batch_blobs, patch_centers, patch_sizes = test_data.forward()
             else:
-                blob = self.train_toydata.forward()
+                blob, batch_blobs, patch_centers, patch_sizes = train_data.forward()
             if step % 10 == 0:
                 print("Iteration %d/%d" % (step, self.cfg.MAX_STEPS))
+                print(train_data.summary())
+                if self.cfg.ENABLE_CROP and hasattr(crop_algorithm, 'summary'):
+                    print(crop_algorithm.summary())
 
-            # Cropping pre-processing
-            # print(blob['entries'])
-            patch_centers, patch_sizes = None, None
             if self.cfg.ENABLE_CROP:
-                batch_blobs, patch_centers, patch_sizes = crop_algorithm.process(blob)
+                # Cheap coverage metrics, logged at every step
+                metrics = coverage_metrics(blob['voxels'], patch_centers,
+                                           patch_sizes, self.cfg.CORE_SIZE)
+                summary_writer = summary_writer_test if is_testing else summary_writer_train
+                summary_writer.add_summary(tf.Summary(value=[
+                    tf.Summary.Value(tag='cropping/%s' % key, simple_value=float(value))
+                    for key, value in metrics.items()]), step)
+                if is_drawing and 'data' not in blob:
+                    # Sparse blob: densify whole event for display only
+                    blob = densify_blob(blob, self.cfg.IMAGE_SIZE, self.dim)
                 if is_drawing:
                     draw_slicing(blob, self.cfg, patch_centers, patch_sizes,
                                  index=step, name='slices',
@@ -233,8 +257,6 @@ class Trainer(object):
                           crop_algorithm.compute_overlap(blob['voxels'],
                                                patch_centers,
                                                sizes=patch_sizes[:, np.newaxis]))
-            else:
-                batch_blobs = [blob]
 
             i = 0
             batch_results = []
@@ -242,7 +264,13 @@ class Trainer(object):
                 blobs = batch_blobs[i:i+self.batch_size]
                 miniblob = {}
                 for key in blobs[0]:
-                    miniblob[key] = np.concatenate([b[key] for b in blobs])
+                    if key == 'gt_pixels':
+                        # Add batch index column
+                        miniblob[key] = np.concatenate([
+                            np.concatenate([b[key], np.full((len(b[key]), 1), j)], axis=1)
+                            for j, b in enumerate(blobs)])
+                    else:
+                        miniblob[key] = np.concatenate([b[key] for b in blobs])
 
                 i += self.batch_size
                 real_step, result = self.process_blob(i, miniblob, real_step,
@@ -258,9 +286,11 @@ class Trainer(object):
                 for j in range(len(blobs)):
                     r = {}
                     for key in result:
-                        if key in ['im_proposals', 'im_scores', 'im_labels', 'rois']:
-                            r[key] = result[key]
-                        elif key in ['dim1', 'dim2']:
+                        if key in ['im_proposals', 'im_scores', 'im_labels']:
+                            r[key] = result[key][result['im_batch'] == j]
+                        elif key == 'rois':
+                            r[key] = result[key][result['rois_batch'] == j]
+                        elif key in ['dim1', 'dim2', 'im_batch', 'rois_batch']:
                             pass
                         else:
                             r[key] = result[key][j]
@@ -269,7 +299,8 @@ class Trainer(object):
             if self.cfg.ENABLE_CROP:
                 final_results = crop_algorithm.reconcile(batch_results,
                                                          patch_centers,
-                                                         patch_sizes)
+                                                         patch_sizes,
+                                                         dense=is_drawing)
 
                 if is_drawing:
                     self.display(blob,
@@ -280,6 +311,8 @@ class Trainer(object):
                                                         'train'),
                                  **final_results)
 
+        train_data.stop()
+        test_data.stop()
         summary_writer_train.close()
         summary_writer_test.close()
         print("Done.")